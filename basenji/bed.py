@@ -15,9 +15,8 @@
 
 import sys
 
-import pysam
-
 from basenji import dna_io
+from basenji import genome
 
 ################################################################################
 # bed.py
@@ -29,7 +28,7 @@ def make_bed_seqs(bed_file, fasta_file, seq_len, stranded=False):
   """Return BED regions as sequences and regions as a list of coordinate
   tuples, extended to a specified length."""
   """Extract and extend BED sequences to seq_len."""
-  fasta_open = pysam.Fastafile(fasta_file)
+  fasta_open = genome.open_fasta(fasta_file)
 
   seqs_dna = []
   seqs_coords = []
@@ -55,24 +54,19 @@ def make_bed_seqs(bed_file, fasta_file, seq_len, stranded=False):
     else:
       seqs_coords.append((chrm,seq_start,seq_end))
 
-    # initialize sequence
-    seq_dna = ''
-
-    # add N's for left over reach
+    # note N's for left over reach
     if seq_start < 0:
       print('Adding %d Ns to %s:%d-%s' % \
           (-seq_start,chrm,start,end), file=sys.stderr)
-      seq_dna = 'N'*(-seq_start)
-      seq_start = 0
 
-    # get dna
-    seq_dna += fasta_open.fetch(chrm, seq_start, seq_end).upper()
-
-    # add N's for right over reach
-    if len(seq_dna) < seq_len:
+    # note N's for right over reach
+    chrom_len = fasta_open.get_reference_length(chrm)
+    if seq_end > chrom_len:
       print('Adding %d Ns to %s:%d-%s' % \
-          (seq_len-len(seq_dna),chrm,start,end), file=sys.stderr)
-      seq_dna += 'N'*(seq_len-len(seq_dna))
+          (seq_end-max(seq_start,chrom_len),chrm,start,end), file=sys.stderr)
+
+    # get dna, padded with N's
+    seq_dna = genome.fetch_dna(fasta_open, chrm, seq_start, seq_end)
 
     # reverse complement
     if stranded and strand == '-':
@@ -18,6 +18,7 @@ import json
 import os
 import pdb
 import sys
+import tempfile
 
 from natsort import natsorted
 import numpy as np
@@ -55,8 +56,17 @@ def file_to_records(filename):
 
 class SeqDataset:
   def __init__(self, data_dir, split_label, batch_size, shuffle_buffer=32,
-               seq_length_crop=None, mode=tf.estimator.ModeKeys.EVAL, tfr_pattern=None):
-    """Initialize basic parameters; run compute_stats; run make_dataset."""
+               seq_length_crop=None, mode=tf.estimator.ModeKeys.EVAL, tfr_pattern=None,
+               parallel_read=False, cache=None):
+    """Initialize basic parameters; run compute_stats; run make_dataset.
+
+      Args:
+        parallel_read: For valid/test modes, read and parse TFRecords in
+                       parallel while preserving record order. Buffers
+                       whole files in memory per parallel reader.
+        cache: For valid/test modes, cache the records in memory (True or '')
+               or at the given file path, for cheap repeated passes.
+    """
 
     self.data_dir = data_dir
     self.split_label = split_label
@@ -65,6 +75,13 @@ class SeqDataset:
     self.seq_length_crop = seq_length_crop
     self.mode = mode
     self.tfr_pattern = tfr_pattern
+    self.parallel_read = parallel_read
+    if cache is True:
+      self.cache = ''
+    elif cache is False:
+      self.cache = None
+    else:
+      self.cache = cache
 
     # read data parameters
     data_stats_file = '%s/statistics.json' % self.data_dir
@@ -73,8 +90,10 @@ class SeqDataset:
     self.seq_length = data_stats['seq_length']
     
     self.seq_depth = data_stats.get('seq_depth',4)
+    self.seq_index = data_stats.get('seq_index', False)
     self.target_length = data_stats['target_length']
     self.num_targets = data_stats['num_targets']
+    self.seqs_per_tfr = data_stats.get('seqs_per_tfr', None)
     
     if self.tfr_pattern is None:
       self.tfr_path = '%s/tfrecords/%s-*.tfr' % (self.data_dir, self.split_label)
@@ -104,11 +123,18 @@ class SeqDataset:
       # decode sequence
       sequence = tf.io.decode_raw(parsed_features[TFR_INPUT], tf.uint8)
       if not raw:
-        sequence = tf.reshape(sequence, [self.seq_length, self.seq_depth])
+        if self.seq_index:
+          sequence = tf.reshape(sequence, [self.seq_length])
+        else:
+          sequence = tf.reshape(sequence, [self.seq_length, self.seq_depth])
         if self.seq_length_crop is not None:
           crop_len = (self.seq_length - self.seq_length_crop) // 2
-          sequence = sequence[crop_len:-crop_len,:]
-        sequence = tf.cast(sequence, tf.float32)
+          sequence = sequence[crop_len:-crop_len]
+        if self.seq_index:
+          # expand nucleotide indexes to one hot coding
+          sequence = tf.one_hot(sequence, self.seq_depth, dtype=tf.float32)
+        else:
+          sequence = tf.cast(sequence, tf.float32)
 
       # decode targets
       targets = tf.io.decode_raw(parsed_features[TFR_OUTPUT], tf.float16)
@@ -147,23 +173,55 @@ class SeqDataset:
 
     # valid/test
     else:
-      # flat mix files
-      dataset = dataset.flat_map(file_to_records)
+      if self.parallel_read:
+        # interleave whole files as blocks, preserving record order
+        dataset = dataset.interleave(map_func=file_to_records,
+          cycle_length=cycle_length,
+          block_length=self.file_records(tfr_files),
+          num_parallel_calls=tf.data.experimental.AUTOTUNE,
+          deterministic=True)
+      else:
+        # flat mix files
+        dataset = dataset.flat_map(file_to_records)
+
+      # cache records for repeated passes
+      if self.cache is not None:
+        dataset = dataset.cache(self.cache)
 
     # (no longer necessary in tf2?)
     # helper for training on single genomes in a multiple genome mode
     # if self.num_seqs > 0:
     #  dataset = dataset.map(self.generate_parser())
-    dataset = dataset.map(self.generate_parser())
+    if self.mode != tf.estimator.ModeKeys.TRAIN and self.parallel_read:
+      dataset = dataset.map(self.generate_parser(),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=True)
+    else:
+      dataset = dataset.map(self.generate_parser())
 
     # batch
     dataset = dataset.batch(self.batch_size)
 
+    # prefetch
+    if self.mode == tf.estimator.ModeKeys.TRAIN or self.parallel_read:
+      dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
     # hold on
     self.dataset = dataset
 
+  def file_records(self, tfr_files):
+    """Return the number of records per TFRecord file, which all but the
+       last file share. Read from statistics.json or count the first file."""
+    if self.seqs_per_tfr is None:
+      num_records = 0
+      if tfr_files:
+        for record in file_to_records(tfr_files[0]):
+          num_records += 1
+      self.seqs_per_tfr = max(1, num_records)
+    return self.seqs_per_tfr
+
 
-  def compute_stats(self):
+  def compute_stats(self, read_batch=64):
     """ Iterate over the TFRecords to count sequences, and infer
         seq_depth and num_targets."""
     with tf.name_scope('stats'):
@@ -171,32 +229,37 @@ class SeqDataset:
       dataset = tf.data.Dataset.list_files(self.tfr_path)
       dataset = dataset.flat_map(file_to_records)
       dataset = dataset.map(self.generate_parser(raw=True))
-      dataset = dataset.batch(1)
+      dataset = dataset.batch(read_batch)
 
     self.num_seqs = 0
     if self.num_targets is not None:
       targets_nonzero = np.zeros(self.num_targets, dtype='bool')
 
     # for (seq_raw, genome), targets_raw in dataset:
-    for seq_raw, targets_raw in dataset:
+    for seqs_raw, targets_raw in dataset:
+      num_batch = seqs_raw.shape[0]
+
       # infer seq_depth
-      seq_1hot = seq_raw.numpy().reshape((self.seq_length,-1))
-      if self.seq_depth is None:
-        self.seq_depth = seq_1hot.shape[-1]
+      seq_depth = seqs_raw.shape[-1] // self.seq_length
+      if self.seq_index:
+        assert(seq_depth == 1)
+      elif self.seq_depth is None:
+        self.seq_depth = seq_depth
       else:
-        assert(self.seq_depth == seq_1hot.shape[-1])
+        assert(self.seq_depth == seq_depth)
 
       # infer num_targets
-      targets1 = targets_raw.numpy().reshape(self.target_length,-1)
+      targets_batch = targets_raw.numpy().reshape((num_batch, self.target_length, -1))
+      targets_batch_nonzero = (targets_batch != 0).any(axis=(0,1))
       if self.num_targets is None:
-        self.num_targets = targets1.shape[-1]
-        targets_nonzero = ((targets1 != 0).sum(axis=0) > 0)
+        self.num_targets = targets_batch.shape[-1]
+        targets_nonzero = targets_batch_nonzero
       else:
-        assert(self.num_targets == targets1.shape[-1])
-        targets_nonzero = np.logical_or(targets_nonzero, (targets1 != 0).sum(axis=0) > 0)
+        assert(self.num_targets == targets_batch.shape[-1])
+        targets_nonzero = np.logical_or(targets_nonzero, targets_batch_nonzero)
 
       # count sequences
-      self.num_seqs += 1
+      self.num_seqs += num_batch
 
     # warn user about nonzero targets
     if self.num_seqs > 0:
@@ -207,8 +270,18 @@ class SeqDataset:
       print('%s has %d sequences with 0 targets' % (self.tfr_path, self.num_seqs), flush=True)
 
 
-  def numpy(self, return_inputs=True, return_outputs=True, step=1):
-    """ Convert TFR inputs and/or outputs to numpy arrays."""
+  def numpy(self, return_inputs=True, return_outputs=True, step=1,
+            target_slice=None, read_batch=64, mem_budget=None, memmap_dir=None):
+    """ Convert TFR inputs and/or outputs to numpy arrays.
+
+      Args:
+        step: Return every step'th target position.
+        target_slice: Return only these target indexes.
+        read_batch: Number of records to convert at once.
+        mem_budget: Back arrays larger than this many bytes with
+                    temporary np.memmap files.
+        memmap_dir: Directory for np.memmap files.
+    """
     with tf.name_scope('numpy'):
       # initialize dataset from TFRecords glob
       tfr_files = natsorted(glob.glob(self.tfr_path))
@@ -221,33 +294,58 @@ class SeqDataset:
       # read TF Records
       dataset = dataset.flat_map(file_to_records)
       dataset = dataset.map(self.generate_parser(raw=True))
-      dataset = dataset.batch(1)
+      dataset = dataset.batch(read_batch)
+      dataset = dataset.prefetch(1)
+
+    # determine output positions
+    seq_start, seq_end = 0, self.seq_length
+    if self.seq_length_crop is not None:
+      seq_start = (self.seq_length - self.seq_length_crop) // 2
+      seq_end = self.seq_length - seq_start
+    step_i = np.arange(0, self.target_length, step)
+    if target_slice is None:
+      num_targets = self.num_targets
+    else:
+      num_targets = len(target_slice)
 
     # initialize inputs and outputs
-    seqs_1hot = []
-    targets = []
+    if return_inputs:
+      seqs_1hot = empty_array((self.num_seqs, seq_end-seq_start, self.seq_depth),
+                              'uint8', mem_budget, memmap_dir)
+    if return_outputs:
+      targets = empty_array((self.num_seqs, len(step_i), num_targets),
+                            'float16', mem_budget, memmap_dir)
 
     # collect inputs and outputs
-    for seq_raw, targets_raw in dataset:
+    si = 0
+    for seqs_raw, targets_raw in dataset:
+      num_batch = seqs_raw.shape[0]
+
       # sequence
       if return_inputs:
-        seq_1hot = seq_raw.numpy().reshape((self.seq_length,-1))
-        if self.seq_length_crop is not None:
-          crop_len = (self.seq_length - self.seq_length_crop) // 2
-          seq_1hot = seq_1hot[crop_len:-crop_len,:]
-        seqs_1hot.append(seq_1hot)
+        seqs_batch = seqs_raw.numpy().reshape((num_batch, self.seq_length, -1))
+        seqs_batch = seqs_batch[:,seq_start:seq_end,:]
+        if self.seq_index:
+          seqs_batch = np.eye(self.seq_depth, dtype='uint8')[seqs_batch[:,:,0]]
+        seqs_1hot[si:si+num_batch] = seqs_batch
 
       # targets
       if return_outputs:
-        targets1 = targets_raw.numpy().reshape((self.target_length,-1))
+        targets_batch = targets_raw.numpy().reshape((num_batch, self.target_length, -1))
         if step > 1:
-          step_i = np.arange(0, self.target_length, step)
-          targets1 = targets1[step_i,:]
-        targets.append(targets1)
+          targets_batch = targets_batch[:,step_i,:]
+        if target_slice is not None:
+          targets_batch = targets_batch[:,:,target_slice]
+        targets[si:si+num_batch] = targets_batch
 
-    # make arrays
-    seqs_1hot = np.array(seqs_1hot)
-    targets = np.array(targets)
+      si += num_batch
+
+    # trim to sequences read
+    if si < self.num_seqs:
+      if return_inputs:
+        seqs_1hot = seqs_1hot[:si]
+      if return_outputs:
+        targets = targets[:si]
 
     # return
     if return_inputs and return_outputs:
@@ -256,3 +354,14 @@ class SeqDataset:
       return seqs_1hot
     else:
       return targets
+
+
+def empty_array(shape, dtype, mem_budget=None, memmap_dir=None):
+  """Allocate an array, backed by an anonymous temporary np.memmap
+     file if its size exceeds mem_budget bytes."""
+  nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+  if mem_budget is not None and nbytes > mem_budget:
+    memmap_file = tempfile.TemporaryFile(dir=memmap_dir)
+    return np.memmap(memmap_file, dtype=dtype, mode='w+', shape=shape)
+  else:
+    return np.zeros(shape, dtype=dtype)
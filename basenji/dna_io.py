@@ -26,6 +26,34 @@ import numpy as np
 # Methods to load the training data.
 ################################################################################
 
+# nucleotide byte -> index lookup table; anything other than ACGT maps to N
+DNA_LUT = np.full(256, 4, dtype='uint8')
+for _ni, _nt in enumerate('ACGT'):
+  DNA_LUT[ord(_nt)] = _ni
+  DNA_LUT[ord(_nt.lower())] = _ni
+
+# index -> nucleotide byte table for decoding
+DNA_CHARS = np.frombuffer(b'ACGTN', dtype='uint8')
+
+# index -> one hot tables; indexes beyond 3 are N
+HOT1_BOOL = np.vstack([np.eye(4, dtype='bool'), np.zeros((252,4), dtype='bool')])
+HOT1_UNIFORM = np.vstack([np.eye(4, dtype='float16'), np.full((252,4), 0.25, dtype='float16')])
+
+
+def dna_index(seq):
+  """ dna_index
+
+    Args:
+      seq:       nucleotide sequence, as str or bytes.
+
+    Returns:
+      seq_index: uint8 array of 0,1,2,3 for A,C,G,T and 4 for N.
+    """
+  if isinstance(seq, str):
+    seq = seq.encode('ascii', errors='replace')
+  return DNA_LUT[np.frombuffer(seq, dtype='uint8')]
+
+
 def dna_1hot(seq, seq_len=None, n_uniform=False):
   """ dna_1hot
 
@@ -50,66 +78,114 @@ def dna_1hot(seq, seq_len=None, n_uniform=False):
     else:
       seq_start = (seq_len - len(seq)) // 2
 
-  seq = seq.upper()
-
   # map nt's to a matrix len(seq)x4 of 0's and 1's.
-  if n_uniform:
-    seq_code = np.zeros((seq_len, 4), dtype='float16')
-  else:
-    seq_code = np.zeros((seq_len, 4), dtype='bool')
-    
-  for i in range(seq_len):
-    if i >= seq_start and i - seq_start < len(seq):
-      nt = seq[i - seq_start]
-      if nt == 'A':
-        seq_code[i, 0] = 1
-      elif nt == 'C':
-        seq_code[i, 1] = 1
-      elif nt == 'G':
-        seq_code[i, 2] = 1
-      elif nt == 'T':
-        seq_code[i, 3] = 1
-      else:
-        if n_uniform:
-          seq_code[i, :] = 0.25
-        else:
-          ni = random.randint(0,3)
-          seq_code[i, ni] = 1          
+  seq_index = dna_index(seq)
+  seq_code = index_1hot(seq_index, n_uniform=n_uniform)
+
+  # pad with zeros
+  if len(seq) < seq_len:
+    seq_code_pad = np.zeros((seq_len, 4), dtype=seq_code.dtype)
+    seq_code_pad[seq_start:seq_start + len(seq)] = seq_code
+    seq_code = seq_code_pad
 
   return seq_code
 
 
-def dna_1hot_index(seq):
+def dnas_1hot(seqs, seq_len=None, n_uniform=False):
+  """ dnas_1hot
+
+    Args:
+      seqs:      list of nucleotide sequences.
+      seq_len:   length to extend/trim sequences to,
+                 defaulting to the first sequence's length.
+      n_uniform: represent N's as 0.25, forcing float16,
+                 rather than sampling.
+
+    Returns:
+      seqs_code: batch by length by nucleotides array representation.
+    """
+  if seq_len is None and len(seqs) > 0:
+    seq_len = len(seqs[0])
+
+  if len(seqs) > 0 and all([len(seq) == seq_len for seq in seqs]):
+    # equal lengths: encode the whole batch from one buffer
+    seqs_bytes = ''.join(seqs) if isinstance(seqs[0], str) else b''.join(seqs)
+    seqs_index = dna_index(seqs_bytes).reshape((len(seqs), -1))
+    seqs_code = index_1hot(seqs_index, n_uniform=n_uniform)
+
+  else:
+    dtype = 'float16' if n_uniform else 'bool'
+    seqs_code = np.zeros((len(seqs), seq_len, 4), dtype=dtype)
+    for si, seq in enumerate(seqs):
+      seqs_code[si] = dna_1hot(seq, seq_len, n_uniform)
+
+  return seqs_code
+
+
+def dna_1hot_index(seq, n_sample=True):
   """ dna_1hot_index
 
     Args:
       seq:       nucleotide sequence.
+      n_sample:  sample N's randomly, rather than coding them as 4.
 
     Returns:
       seq_code:  index int array representation.
     """
-  seq_len = len(seq)
-  seq = seq.upper()
-
   # map nt's to a len(seq) of 0,1,2,3
-  seq_code = np.zeros(seq_len, dtype='uint8')
-    
-  for i in range(seq_len):
-    nt = seq[i]
-    if nt == 'A':
-      seq_code[i] = 0
-    elif nt == 'C':
-      seq_code[i] = 1
-    elif nt == 'G':
-      seq_code[i] = 2
-    elif nt == 'T':
-      seq_code[i] = 3
-    else:
-      seq_code[i] = random.randint(0,3)         
+  seq_code = dna_index(seq)
+
+  if n_sample:
+    index_sample_n(seq_code)
 
   return seq_code
 
 
+def index_sample_n(seq_index):
+  """ index_sample_n
+
+    Replace N's in a nucleotide index array, in place, with indexes
+    sampled in sequence order from the python RNG.
+
+    Args:
+      seq_index: uint8 array of 0,1,2,3 for A,C,G,T and 4 for N.
+
+    Returns:
+      seq_index: the same array, without N's.
+    """
+  n_i = np.flatnonzero(seq_index > 3)
+  if len(n_i) > 0:
+    seq_index[n_i] = [random.randint(0,3) for _ in range(len(n_i))]
+  return seq_index
+
+
+def index_1hot(seqs_index, n_uniform=False):
+  """ index_1hot
+
+    Expand nucleotide index arrays of any shape to one hot coding.
+
+    Args:
+      seqs_index: uint8 array of 0,1,2,3 for A,C,G,T and 4 for N.
+      n_uniform:  represent N's as 0.25, forcing float16,
+                  rather than sampling.
+
+    Returns:
+      seqs_code:  seqs_index.shape x 4 array representation.
+    """
+  if n_uniform:
+    seqs_code = np.take(HOT1_UNIFORM, seqs_index, axis=0)
+  else:
+    seqs_code = np.take(HOT1_BOOL, seqs_index, axis=0)
+
+    # sample N's, in sequence order, from the python RNG
+    n_i = np.nonzero(seqs_index > 3)
+    if len(n_i[0]) > 0:
+      ni = np.array([random.randint(0,3) for _ in range(len(n_i[0]))])
+      seqs_code[n_i + (ni,)] = True
+
+  return seqs_code
+
+
 def hot1_augment(Xb, fwdrc=True, shift=0):
   """ Transform a batch of one hot coded sequences to augment training.
 
@@ -187,22 +263,14 @@ def hot1_dna(seqs_1hot):
     singleton = True
     seqs_1hot = np.expand_dims(seqs_1hot, 0)
 
-  seqs = []
-  for si in range(seqs_1hot.shape[0]):
-    seq_list = ['A'] * seqs_1hot.shape[1]
-    for li in range(seqs_1hot.shape[1]):
-      if seqs_1hot[si, li, 0] == 1:
-        seq_list[li] = 'A'
-      elif seqs_1hot[si, li, 1] == 1:
-        seq_list[li] = 'C'
-      elif seqs_1hot[si, li, 2] == 1:
-        seq_list[li] = 'G'
-      elif seqs_1hot[si, li, 3] == 1:
-        seq_list[li] = 'T'
-      else:
-        seq_list[li] = 'N'
-
-    seqs.append(''.join(seq_list))
+  # first hot nucleotide per position, or N
+  seqs_hot = (seqs_1hot == 1)
+  seqs_index = seqs_hot.argmax(axis=-1)
+  seqs_index[~seqs_hot.any(axis=-1)] = 4
+
+  # decode rows in bulk
+  seqs_bytes = DNA_CHARS[seqs_index]
+  seqs = [seq_bytes.tobytes().decode('ascii') for seq_bytes in seqs_bytes]
 
   if singleton:
     seqs = seqs[0]
@@ -244,20 +312,14 @@ def hot1_insert(seq_1hot, pos, insert_seq):
   # reset
   seq_1hot[pos:pos + len(insert_seq), :] = 0
 
-  for i in range(len(insert_seq)):
-    nt = insert_seq[i]
-
-    # set
-    if nt == 'A':
-      seq_1hot[pos + i, 0] = 1
-    elif nt == 'C':
-      seq_1hot[pos + i, 1] = 1
-    elif nt == 'G':
-      seq_1hot[pos + i, 2] = 1
-    elif nt == 'T':
-      seq_1hot[pos + i, 3] = 1
-    else:
-      print('Invalid nucleotide insert %s' % nt, file=sys.stderr)
+  # set
+  insert_index = dna_index(insert_seq)
+  insert_valid = (insert_index < 4)
+  insert_pos = pos + np.flatnonzero(insert_valid)
+  seq_1hot[insert_pos, insert_index[insert_valid]] = 1
+
+  for nt in np.array(list(insert_seq))[~insert_valid]:
+    print('Invalid nucleotide insert %s' % nt, file=sys.stderr)
 
 
 def hot1_rc(seqs_1hot):
@@ -298,14 +360,9 @@ def hot1_set(seq_1hot, pos, nt):
   seq_1hot[pos, :] = 0
 
   # set
-  if nt == 'A':
-    seq_1hot[pos, 0] = 1
-  elif nt == 'C':
-    seq_1hot[pos, 1] = 1
-  elif nt == 'G':
-    seq_1hot[pos, 2] = 1
-  elif nt == 'T':
-    seq_1hot[pos, 3] = 1
+  ni = dna_index(nt)[0] if len(nt) == 1 else 4
+  if ni < 4:
+    seq_1hot[pos, ni] = 1
   else:
     print('Invalid nucleotide set %s' % nt, file=sys.stderr)
 
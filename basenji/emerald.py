@@ -15,9 +15,10 @@
 
 from __future__ import print_function
 
+import collections
 import pdb
 import os
-import subprocess
+import threading
 
 import numpy as np
 import pandas as pd
@@ -26,13 +27,23 @@ from pysam import VariantFile
 '''
 emerald.py
 
-Methods to query LD using emeraLD.
+Methods to query LD, computed in process from packed genotype bits
+in the manner of emeraLD.
 '''
 
+# set bits in each byte value
+POPCOUNT8 = np.array([bin(b).count('1') for b in range(256)], dtype='uint16')
+
 class EmeraldVCF:
-  def __init__(self, pop_vcf_stem):
+  def __init__(self, pop_vcf_stem, cache_regions=16, cache_window=1000000):
     self.pop_vcf_stem = pop_vcf_stem
 
+    # LRU cache of genotype windows
+    self.cache_regions = cache_regions
+    self.cache_window = cache_window
+    self.cache = collections.OrderedDict()
+    self.cache_lock = threading.Lock()
+
   def fetch(self, chrm, pos_start, pos_end, return_samples=False):
     vcf_file = '%s.%s.vcf.gz' % (self.pop_vcf_stem, chrm)
     vcf_open = VariantFile(vcf_file, drop_samples=(not return_samples))
@@ -42,7 +53,8 @@ class EmeraldVCF:
   def query_ld(self, snp_id, chrm, pos,
                ld_t=0.1, return_pos=False,
                max_ld_distance=1000000):
-    """Retrieve SNPs in LD with the given SNP."""
+    """Retrieve SNPs in LD with the given SNP, as unphased genotype
+       correlation r with r^2 >= ld_t."""
 
     chr_vcf_file = '%s.%s.vcf.gz' % (self.pop_vcf_stem, chrm)
     if not os.path.isfile(chr_vcf_file):
@@ -53,36 +65,29 @@ class EmeraldVCF:
         # determine search region
         ld_region_start = max(0, pos - max_ld_distance)
         ld_region_end = pos + max_ld_distance
-        region_str = '--region %s:%d-%d' % (chrm, ld_region_start, ld_region_end)
-
-        # construct emerald command
-        cmd  = 'emeraLD'
-        cmd += ' -i %s' % chr_vcf_file
-        cmd += ' --rsid %s' % snp_id
-        cmd += ' %s' % region_str
-        cmd += ' --threshold %f' % ld_t
-        cmd += ' --no-phase'
-        cmd += ' --extra'
-        cmd += ' --stdout'
-        cmd += ' 2> /dev/null'
+
+        # gather genotypes
+        region_pos, region_ids, region_gts, num_samples = \
+          self.region_genotypes(chrm, ld_region_start, ld_region_end)
 
         ld_snps = [snp_id]
         ld_r = [1.0]
         ld_pos = [pos]
 
-        # parse returned lines
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
-        for line in proc.stdout:
-            line = line.decode('UTF-8')
-            if not line.startswith('#'):
-                a = line.split()
-                ld_pos.append(int(a[4]))
-                ld_snps.append(a[5])
-                ld_r.append(float(a[7]))
-        proc.communicate()
+        # find query SNP
+        snp_indexes = np.nonzero(region_ids == snp_id)[0]
+        if len(snp_indexes) > 0:
+            snp_i = snp_indexes[0]
+            region_r = genotypes_r(region_gts, snp_i, num_samples)
+
+            ld_mask = (region_r**2 >= ld_t)
+            ld_mask[snp_i] = False
+            ld_pos += region_pos[ld_mask].tolist()
+            ld_snps += region_ids[ld_mask].tolist()
+            ld_r += region_r[ld_mask].tolist()
 
         # sort by position
-        sort_indexes = np.argsort(ld_pos)
+        sort_indexes = np.argsort(ld_pos, kind='stable')
         ld_snps = np.array(ld_snps)[sort_indexes]
         ld_r = np.array(ld_r)[sort_indexes]
 
@@ -96,3 +101,116 @@ class EmeraldVCF:
             ld_df['pos'] = np.array(ld_pos)[sort_indexes]
 
     return ld_df
+
+
+  def region_genotypes(self, chrm, pos_start, pos_end):
+    """Return positions, ids, packed genotypes, and the number of samples
+       for the variants in [pos_start, pos_end], from cached windows."""
+    wi_start = pos_start // self.cache_window
+    wi_end = pos_end // self.cache_window
+
+    windows = [self.window_genotypes(chrm, wi) for wi in range(wi_start, wi_end+1)]
+    region_pos = np.concatenate([w[0] for w in windows])
+    region_ids = np.concatenate([w[1] for w in windows])
+    region_gts = np.concatenate([w[2] for w in windows])
+
+    region_mask = (region_pos >= pos_start) & (region_pos <= pos_end)
+    num_samples = windows[0][3]
+    return region_pos[region_mask], region_ids[region_mask], \
+      region_gts[region_mask], num_samples
+
+
+  def window_genotypes(self, chrm, wi):
+    """Return the genotypes of a cache window, reading and caching
+       them if absent and evicting the least recently used."""
+    window_key = (chrm, wi)
+    with self.cache_lock:
+      if window_key in self.cache:
+        self.cache.move_to_end(window_key)
+        return self.cache[window_key]
+
+    window_gts = read_genotypes('%s.%s.vcf.gz' % (self.pop_vcf_stem, chrm),
+                                chrm, wi*self.cache_window, (wi+1)*self.cache_window)
+
+    with self.cache_lock:
+      self.cache[window_key] = window_gts
+      while len(self.cache) > self.cache_regions:
+        self.cache.popitem(last=False)
+
+    return window_gts
+
+
+def read_genotypes(vcf_file, chrm, pos_start, pos_end):
+  """Read variants with 1-based positions in [pos_start, pos_end) into
+     position and id arrays and a [variants, 2, samples/8] array of
+     alternative allele bits packed per haplotype, plus the number
+     of samples.
+
+  Missing alleles count as reference. Only variants starting in the
+  window are read, so that those overlapping its start, e.g. deletions,
+  belong to the previous window alone."""
+  vcf_open = VariantFile(vcf_file)
+  num_samples = len(vcf_open.header.samples)
+
+  var_pos = []
+  var_ids = []
+  var_gts = []
+  for rec in vcf_open.fetch(chrm, max(0, pos_start-1), max(0, pos_end-1)):
+    if rec.pos < pos_start or rec.pos >= pos_end:
+      continue
+
+    var_pos.append(rec.pos)
+    var_ids.append(rec.id if rec.id is not None else '.')
+
+    rec_fields = str(rec).rstrip('\n').split('\t', 9)
+    sample_gts = rec_fields[-1] if len(rec_fields) == 10 else ''
+
+    if rec_fields[8] == 'GT' and len(sample_gts) == 4*num_samples-1:
+      # diploid single character alleles, e.g. 0|1
+      gt_bytes = np.frombuffer(sample_gts.encode('UTF-8'), dtype='uint8')
+      hap_alleles = np.array([gt_bytes[0::4], gt_bytes[2::4]])
+      hap_alt = (hap_alleles != ord('0')) & (hap_alleles != ord('.'))
+    else:
+      hap_alt = np.zeros((2, num_samples), dtype='bool')
+      for si, sample in enumerate(rec.samples.values()):
+        for hi, allele in enumerate(sample['GT'][:2]):
+          hap_alt[hi, si] = allele is not None and allele > 0
+
+    var_gts.append(np.packbits(hap_alt, axis=-1))
+
+  vcf_open.close()
+
+  var_pos = np.array(var_pos, dtype='int64')
+  var_ids = np.array(var_ids, dtype='object')
+  if var_gts:
+    var_gts = np.array(var_gts)
+  else:
+    var_gts = np.zeros((0, 2, (num_samples+7)//8), dtype='uint8')
+
+  return var_pos, var_ids, var_gts, num_samples
+
+
+def genotypes_r(gts, snp_i, num_samples):
+  """Compute unphased genotype correlations between variant snp_i and
+     all variants in a packed [variants, 2, bytes] haplotype bit array."""
+  snp_gts = gts[snp_i]
+
+  # sum of allele dosages
+  hap_sums = POPCOUNT8[gts].sum(axis=-1, dtype='float64')
+  sum_x = hap_sums.sum(axis=1)
+
+  # sum of squared dosages adds twice the homozygous alternatives
+  sum_xx = sum_x + 2*POPCOUNT8[gts[:,0] & gts[:,1]].sum(axis=-1, dtype='float64')
+
+  # sum of dosage products over haplotype pairs
+  sum_xy = np.zeros(len(gts))
+  for hi in range(2):
+    for hj in range(2):
+      sum_xy += POPCOUNT8[gts[:,hi] & snp_gts[hj]].sum(axis=-1, dtype='float64')
+
+  cov_xy = sum_xy - sum_x*sum_x[snp_i]/num_samples
+  var_x = sum_xx - sum_x**2/num_samples
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    r = cov_xy / np.sqrt(var_x*var_x[snp_i])
+  return np.nan_to_num(r)
@@ -15,15 +15,27 @@
 
 from __future__ import print_function
 
+import os
+import shutil
 import sys
+
+import numpy as np
 import pysam
 
+from basenji import dna_io
+
 ################################################################################
 # genome.py
 #
 # Methods to interact with genome information.
 ################################################################################
 
+# nucleotides fetched per block when building a genome cache
+CACHE_BLOCK_NT = 2**24
+
+# packed byte -> four nucleotide indexes, lowest bits first
+UNPACK_LUT = np.array([[(b >> 2*j) & 3 for j in range(4)] for b in range(256)], dtype='uint8')
+
 
 def load_chromosomes(genome_file):
   """ Load genome segments from either a FASTA file or
@@ -119,3 +131,231 @@ def split_contigs(chrom_segments, gaps_file):
         chrom_segments[chrom].append((pos1, pos2))
 
   return chrom_segments
+
+
+################################################################################
+# genome cache
+#
+# A FASTA decoded once into 2-bit packed nucleotide indexes, with N's and
+# other non-ACGT characters kept as sorted runs, and memory-mapped
+# read-only so that concurrent worker processes share one copy in the
+# page cache.
+################################################################################
+
+class GenomeCache:
+  """Memory-mapped 2-bit genome, fetched as nucleotide indexes.
+
+    The cache directory holds seq.npy, each chromosome's packed bytes
+    starting at a byte boundary; n_starts.npy and n_ends.npy, the N runs
+    in those concatenated coordinates; and chroms.txt, a table of names,
+    lengths, and offsets. fetch mirrors pysam.Fastafile, so the cache
+    drops in wherever an open FASTA is expected.
+
+    Args:
+      fasta_file: genome FASTA file
+      cache_dir: cache directory, defaulting to fasta_file.cache
+  """
+  def __init__(self, fasta_file, cache_dir=None):
+    if cache_dir is None:
+      cache_dir = cache_path(fasta_file)
+    self.cache_dir = cache_dir
+
+    self.references = []
+    lengths = []
+    offsets = []
+    for line in open('%s/chroms.txt' % cache_dir):
+      a = line.split()
+      self.references.append(a[0])
+      lengths.append(int(a[1]))
+      offsets.append(int(a[2]))
+    self.lengths = tuple(lengths)
+    self.offsets = tuple(offsets)
+    self.chrom_index = {chrm:ci for ci, chrm in enumerate(self.references)}
+
+    self.seq = np.load('%s/seq.npy' % cache_dir, mmap_mode='r')
+    self.n_starts = np.load('%s/n_starts.npy' % cache_dir, mmap_mode='r')
+    self.n_ends = np.load('%s/n_ends.npy' % cache_dir, mmap_mode='r')
+
+  @classmethod
+  def build(cls, fasta_file, cache_dir=None):
+    """Build the cache for fasta_file unless a current one exists,
+       and return it opened."""
+    if cache_dir is None:
+      cache_dir = cache_path(fasta_file)
+    if not cache_current(fasta_file, cache_dir):
+      build_cache(fasta_file, cache_dir)
+    return cls(fasta_file, cache_dir)
+
+  def close(self):
+    self.seq = None
+    self.n_starts = None
+    self.n_ends = None
+
+  def get_reference_length(self, reference):
+    return self.lengths[self.chrom_index[reference]]
+
+  def fetch(self, reference, start=None, end=None):
+    """Return the uppercase sequence, clipped to the chromosome
+       like pysam.Fastafile.fetch."""
+    chrom_len = self.get_reference_length(reference)
+    start = 0 if start is None else min(max(start, 0), chrom_len)
+    end = chrom_len if end is None else min(max(end, start), chrom_len)
+    return self.fetch_dna(reference, start, end)
+
+  def fetch_dna(self, chrm, start, end):
+    """Return the uppercase sequence, padded with N's beyond
+       the chromosome."""
+    seq_index = self.fetch_index(chrm, start, end)
+    return dna_io.DNA_CHARS[seq_index].tobytes().decode('ascii')
+
+  def fetch_index(self, chrm, start, end):
+    """Return uint8 nucleotide indexes for [start,end), with 4 for N's,
+       including positions beyond the chromosome."""
+    ci = self.chrom_index[chrm]
+    chrom_len = self.lengths[ci]
+    offset = self.offsets[ci]
+    seq_index = np.full(end - start, 4, dtype='uint8')
+
+    # clip to the chromosome
+    cstart = min(max(start, 0), chrom_len)
+    cend = min(max(end, cstart), chrom_len)
+    if cstart < cend:
+      # unpack bytes
+      gstart = offset + cstart
+      gend = offset + cend
+      seq_bytes = self.seq[gstart >> 2:(gend + 3) >> 2]
+      codes = np.take(UNPACK_LUT, seq_bytes, axis=0).reshape(-1)
+      codes = codes[gstart & 3:(gstart & 3) + cend - cstart]
+
+      # mask N runs
+      ri = np.searchsorted(self.n_ends, gstart, side='right')
+      rj = np.searchsorted(self.n_starts, gend, side='left')
+      if ri < rj:
+        seq_len = cend - cstart
+        n_starts = np.clip(self.n_starts[ri:rj] - gstart, 0, seq_len)
+        n_ends = np.clip(self.n_ends[ri:rj] - gstart, 0, seq_len)
+        n_depth = np.bincount(n_starts, minlength=seq_len+1)
+        n_depth -= np.bincount(n_ends, minlength=seq_len+1)
+        codes[np.cumsum(n_depth[:-1]) > 0] = 4
+
+      seq_index[cstart - start:cend - start] = codes
+
+    return seq_index
+
+  def fetch_1hot(self, chrm, start, end, n_uniform=False):
+    """Return the one hot coding for [start,end), padded with N's."""
+    return dna_io.index_1hot(self.fetch_index(chrm, start, end), n_uniform)
+
+
+def build_cache(fasta_file, cache_dir):
+  """Decode fasta_file into a GenomeCache directory, writing to
+     a temporary directory moved into place once complete."""
+  fasta_open = pysam.Fastafile(fasta_file)
+  references = list(fasta_open.references)
+  lengths = list(fasta_open.lengths)
+
+  # start each chromosome at a byte boundary
+  offsets = np.cumsum([0] + [4*((cl + 3) // 4) for cl in lengths])
+  num_bytes = offsets[-1] // 4
+
+  tmp_dir = '%s.tmp%d' % (cache_dir, os.getpid())
+  os.makedirs(tmp_dir, exist_ok=True)
+  seq = np.lib.format.open_memmap('%s/seq.npy' % tmp_dir, mode='w+',
+                                  dtype='uint8', shape=(max(num_bytes,1),))
+
+  n_starts = []
+  n_ends = []
+  for chrm, chrom_len, offset in zip(references, lengths, offsets):
+    for bstart in range(0, chrom_len, CACHE_BLOCK_NT):
+      bend = min(bstart + CACHE_BLOCK_NT, chrom_len)
+      seq_index = dna_io.dna_index(fasta_open.fetch(chrm, bstart, bend))
+
+      # N runs
+      n_diff = np.diff(np.concatenate([[0], seq_index == 4, [0]]).astype('int8'))
+      n_starts.append(offset + bstart + np.flatnonzero(n_diff == 1))
+      n_ends.append(offset + bstart + np.flatnonzero(n_diff == -1))
+
+      # pack four nucleotides per byte
+      codes = np.zeros(4*((bend - bstart + 3) // 4), dtype='uint8')
+      codes[:bend - bstart] = seq_index & 3
+      codes = codes.reshape((-1, 4))
+      packed = codes[:,0] | (codes[:,1] << 2) | (codes[:,2] << 4) | (codes[:,3] << 6)
+      pstart = (offset + bstart) // 4
+      seq[pstart:pstart + len(packed)] = packed
+
+  seq.flush()
+  del seq
+  fasta_open.close()
+
+  # merge runs split across blocks
+  n_starts = np.concatenate(n_starts + [np.zeros(0, dtype='int64')]).astype('int64')
+  n_ends = np.concatenate(n_ends + [np.zeros(0, dtype='int64')]).astype('int64')
+  run_join = np.flatnonzero(n_starts[1:] == n_ends[:-1])
+  n_starts = np.delete(n_starts, run_join + 1)
+  n_ends = np.delete(n_ends, run_join)
+  np.save('%s/n_starts.npy' % tmp_dir, n_starts)
+  np.save('%s/n_ends.npy' % tmp_dir, n_ends)
+
+  # chromosome table, written last
+  with open('%s/chroms.txt' % tmp_dir, 'w') as chroms_out:
+    for chrm, chrom_len, offset in zip(references, lengths, offsets):
+      print('%s\t%d\t%d' % (chrm, chrom_len, offset), file=chroms_out)
+
+  # move into place, yielding to a concurrent build
+  if os.path.isdir(cache_dir):
+    shutil.rmtree(cache_dir, ignore_errors=True)
+  try:
+    os.rename(tmp_dir, cache_dir)
+  except OSError:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def cache_current(fasta_file, cache_dir=None):
+  """Return whether a complete cache newer than fasta_file exists."""
+  if cache_dir is None:
+    cache_dir = cache_path(fasta_file)
+  chroms_file = '%s/chroms.txt' % cache_dir
+  return os.path.isfile(chroms_file) and \
+    os.path.getmtime(chroms_file) >= os.path.getmtime(fasta_file)
+
+
+def cache_path(fasta_file):
+  return '%s.cache' % fasta_file
+
+
+def open_fasta(fasta_file, cache=False):
+  """Open a genome FASTA, through its GenomeCache if current.
+
+    Args:
+      fasta_file: genome FASTA file
+      cache: build the cache if it isn't current
+
+    Returns:
+      GenomeCache or pysam.Fastafile
+  """
+  if cache:
+    return GenomeCache.build(fasta_file)
+  elif cache_current(fasta_file):
+    return GenomeCache(fasta_file)
+  else:
+    return pysam.Fastafile(fasta_file)
+
+
+def fetch_dna(fasta_open, chrm, start, end):
+  """Return the uppercase sequence for [start,end) from a GenomeCache
+     or pysam.Fastafile, padded with N's beyond the chromosome."""
+  if isinstance(fasta_open, GenomeCache):
+    return fasta_open.fetch_dna(chrm, start, end)
+
+  seq_dna = 'N'*max(0, min(end, 0) - start)
+  seq_dna += fasta_open.fetch(chrm, max(start, 0), max(end, 0)).upper()
+  seq_dna += 'N'*(end - start - len(seq_dna))
+  return seq_dna
+
+
+def fetch_index(fasta_open, chrm, start, end):
+  """Return uint8 nucleotide indexes for [start,end) from a GenomeCache
+     or pysam.Fastafile, with 4 for N's, including beyond the chromosome."""
+  if isinstance(fasta_open, GenomeCache):
+    return fasta_open.fetch_index(chrm, start, end)
+  return dna_io.dna_index(fetch_dna(fasta_open, chrm, start, end))
@@ -0,0 +1,154 @@
+# Copyright 2017 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+
+import numpy as np
+
+################################################################################
+# intervals.py
+#
+# In-process interval overlap queries on sorted NumPy arrays, in place of
+# bedtools intersect. Intervals are BED-style, 0-based and half-open, and
+# overlap when they share at least one nucleotide.
+################################################################################
+
+class IntervalIndex:
+  """Index of intervals, sorted by start per chromosome.
+
+    Queries bound each interval's candidates with a binary search on the
+    starts from above, and on the running maximum of the ends from below,
+    so windows and other non-nested intervals yield only true overlaps.
+
+    Args:
+      chroms: interval chromosomes
+      starts: interval starts
+      ends: interval ends
+  """
+  def __init__(self, chroms, starts, ends):
+    self.chroms = np.asarray(chroms, dtype='str')
+    self.starts = np.asarray(starts, dtype='int64')
+    self.ends = np.asarray(ends, dtype='int64')
+
+    # per chromosome arrays
+    self.chrom_arrays = {}
+    for chrom, chrom_indexes in group_chroms(self.chroms):
+      order = np.argsort(self.starts[chrom_indexes], kind='stable')
+      chrom_indexes = chrom_indexes[order]
+      chrom_starts = self.starts[chrom_indexes]
+      chrom_ends = self.ends[chrom_indexes]
+      chrom_max_ends = np.maximum.accumulate(chrom_ends)
+      self.chrom_arrays[chrom] = (chrom_starts, chrom_ends,
+                                  chrom_max_ends, chrom_indexes)
+
+  @classmethod
+  def from_bed(cls, bed_file):
+    """Index the intervals in the first three columns of a BED file."""
+    chroms, starts, ends = read_bed_intervals(bed_file)
+    return cls(chroms, starts, ends)
+
+  def __len__(self):
+    return len(self.starts)
+
+  def overlap_pairs(self, chroms, starts, ends):
+    """Return all overlapping (query, interval) index pairs, as two
+       arrays sorted by query index and then interval start."""
+    chroms = np.asarray(chroms, dtype='str')
+    starts = np.asarray(starts, dtype='int64')
+    ends = np.asarray(ends, dtype='int64')
+
+    query_pairs = []
+    interval_pairs = []
+    for chrom, query_indexes in group_chroms(chroms):
+      if chrom not in self.chrom_arrays:
+        continue
+      chrom_starts, chrom_ends, chrom_max_ends, chrom_indexes = self.chrom_arrays[chrom]
+      query_starts = starts[query_indexes]
+      query_ends = ends[query_indexes]
+
+      # candidate ranges
+      lo = np.searchsorted(chrom_max_ends, query_starts, side='right')
+      hi = np.searchsorted(chrom_starts, query_ends, side='left')
+      counts = np.maximum(hi - lo, 0)
+
+      # expand ranges to candidate pairs
+      num_pairs = counts.sum()
+      pair_queries = np.repeat(np.arange(len(query_indexes)), counts)
+      pair_offsets = np.arange(num_pairs) - np.repeat(np.cumsum(counts) - counts, counts)
+      pair_intervals = np.repeat(lo, counts) + pair_offsets
+
+      # filter to overlaps
+      overlap = chrom_ends[pair_intervals] > query_starts[pair_queries]
+      query_pairs.append(query_indexes[pair_queries[overlap]])
+      interval_pairs.append(chrom_indexes[pair_intervals[overlap]])
+
+    if len(query_pairs) == 0:
+      return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+
+    query_pairs = np.concatenate(query_pairs)
+    interval_pairs = np.concatenate(interval_pairs)
+    order = np.argsort(query_pairs, kind='stable')
+    return query_pairs[order], interval_pairs[order]
+
+  def overlaps(self, chroms, starts, ends):
+    """Return a boolean array marking queries overlapping any interval."""
+    query_pairs, _ = self.overlap_pairs(chroms, starts, ends)
+    query_overlaps = np.zeros(len(starts), dtype='bool')
+    query_overlaps[query_pairs] = True
+    return query_overlaps
+
+
+def group_chroms(chroms):
+  """Yield (chrom, indexes) for each chromosome in a string array."""
+  order = np.argsort(chroms, kind='stable')
+  chroms_sorted = chroms[order]
+  uchroms, ustarts = np.unique(chroms_sorted, return_index=True)
+  uends = np.append(ustarts[1:], len(chroms_sorted))
+  for chrom, cs, ce in zip(uchroms, ustarts, uends):
+    yield chrom, order[cs:ce]
+
+
+def group_pairs(pairs_a, pairs_b, num_a):
+  """Return a list for each index in [0, num_a) of its paired b indexes,
+     for pairs sorted by a."""
+  counts = np.bincount(pairs_a, minlength=num_a)
+  offsets = np.concatenate([[0], np.cumsum(counts)]).tolist()
+  pairs_b = pairs_b.tolist()
+  return [pairs_b[offsets[i]:offsets[i+1]] for i in range(num_a)]
+
+
+def sort_pairs(pairs_a, pairs_b):
+  """Sort pairs by a and then b, for non-negative indexes."""
+  if len(pairs_a) == 0:
+    return pairs_a, pairs_b
+  pair_keys = pairs_a * (pairs_b.max() + 1) + pairs_b
+  order = np.argsort(pair_keys)
+  return pairs_a[order], pairs_b[order]
+
+
+def read_bed_intervals(bed_file):
+  """Read chromosome, start, and end arrays from a BED file."""
+  chroms = []
+  starts = []
+  ends = []
+  for line in open(bed_file):
+    a = line.split()
+    if len(a) < 3 or a[0].startswith('#') or a[0] in ['track', 'browser']:
+      continue
+    chroms.append(a[0])
+    starts.append(int(a[1]))
+    ends.append(int(a[2]))
+  chroms = np.array(chroms, dtype='str')
+  starts = np.array(starts, dtype='int64')
+  ends = np.array(ends, dtype='int64')
+  return chroms, starts, ends
@@ -635,30 +635,8 @@ class SwitchReverseTriu(tf.keras.layers.Layer):
     ut_len = x_ut.shape[1]
     if type(ut_len) == tf.compat.v1.Dimension:
       ut_len = ut_len.value
-    seq_len = int(np.sqrt(2*ut_len + 0.25) - 0.5)
-    seq_len += self.diagonal_offset
 
-    # get triu indexes
-    ut_indexes = np.triu_indices(seq_len, self.diagonal_offset)
-    assert(len(ut_indexes[0]) == ut_len)
-
-    # construct a ut matrix of ut indexes
-    mat_ut_indexes = np.zeros(shape=(seq_len,seq_len), dtype='int')
-    mat_ut_indexes[ut_indexes] = np.arange(ut_len)
-
-    # make lower diag mask
-    mask_ut = np.zeros(shape=(seq_len,seq_len), dtype='bool')
-    mask_ut[ut_indexes] = True
-    mask_ld = ~mask_ut
-
-    # construct a matrix of symmetric ut indexes
-    mat_indexes = mat_ut_indexes + np.multiply(mask_ld, mat_ut_indexes.T)
-
-    # reverse complement
-    mat_rc_indexes = mat_indexes[::-1,::-1]
-
-    # extract ut order
-    rc_ut_order = mat_rc_indexes[ut_indexes]
+    rc_ut_order = triu_rc_order(ut_len, self.diagonal_offset)
 
     return tf.keras.backend.switch(reverse,
                                    tf.gather(x_ut, rc_ut_order, axis=1),
@@ -668,6 +646,35 @@ class SwitchReverseTriu(tf.keras.layers.Layer):
     config['diagonal_offset'] = self.diagonal_offset
     return config
     
+def triu_rc_order(ut_len, diagonal_offset):
+  """Return the order of upper triangular entries after reverse
+     complementing the underlying sequence."""
+  seq_len = int(np.sqrt(2*ut_len + 0.25) - 0.5)
+  seq_len += diagonal_offset
+
+  # get triu indexes
+  ut_indexes = np.triu_indices(seq_len, diagonal_offset)
+  assert(len(ut_indexes[0]) == ut_len)
+
+  # construct a ut matrix of ut indexes
+  mat_ut_indexes = np.zeros(shape=(seq_len,seq_len), dtype='int')
+  mat_ut_indexes[ut_indexes] = np.arange(ut_len)
+
+  # make lower diag mask
+  mask_ut = np.zeros(shape=(seq_len,seq_len), dtype='bool')
+  mask_ut[ut_indexes] = True
+  mask_ld = ~mask_ut
+
+  # construct a matrix of symmetric ut indexes
+  mat_indexes = mat_ut_indexes + np.multiply(mask_ld, mat_ut_indexes.T)
+
+  # reverse complement
+  mat_rc_indexes = mat_indexes[::-1,::-1]
+
+  # extract ut order
+  rc_ut_order = mat_rc_indexes[ut_indexes]
+  return rc_ut_order
+
 class EnsembleShift(tf.keras.layers.Layer):
   """Expand tensor to include shifts of one hot encoded DNA sequence."""
   def __init__(self, shifts=[0], pad='uniform'):
@@ -694,6 +701,93 @@ class EnsembleShift(tf.keras.layers.Layer):
     })
     return config
 
+class EnsembleBatch(tf.keras.layers.Layer):
+  """Average a model's predictions, of each of its outputs, over shifted
+     and reverse complemented copies of a sequence batch, stacked along
+     the batch dimension into model calls of at most max_batch sequences."""
+  def __init__(self, model, shifts=[0], rc=False, preds_triu=False,
+               diagonal_offset=2, max_batch=None):
+    super(EnsembleBatch, self).__init__()
+    self.model = model
+    self.shifts = shifts
+    self.rc = rc
+    self.preds_triu = preds_triu
+    self.diagonal_offset = diagonal_offset
+    self.max_batch = max_batch
+
+  def call(self, seq_1hot):
+    batch_size = tf.shape(seq_1hot)[0]
+
+    # stack augmented copies
+    seqs_1hot = [shift_sequence(seq_1hot, shift) for shift in self.shifts]
+    if self.rc:
+      seqs_1hot += [tf.reverse(tf.gather(seq, [3, 2, 1, 0], axis=-1), axis=[1])
+                    for seq in seqs_1hot]
+    num_copies = len(seqs_1hot)
+    preds = self.predict_batched(tf.concat(seqs_1hot, axis=0))
+
+    # average each output
+    preds_avg = []
+    for preds_oi, output in zip(preds, self.model.outputs):
+      # [copies, batch, ...]
+      preds_shape = tf.concat([[num_copies, batch_size], tf.shape(preds_oi)[1:]], axis=0)
+      preds_oi = tf.reshape(preds_oi, preds_shape)
+
+      # reverse reverse complement predictions
+      if self.rc:
+        num_fwd = len(self.shifts)
+        if self.preds_triu:
+          ut_len = output.shape[1]
+          preds_rev = tf.gather(preds_oi[num_fwd:], triu_rc_order(ut_len, self.diagonal_offset), axis=2)
+        else:
+          rev_axes = list(range(2, len(output.shape)))
+          preds_rev = tf.reverse(preds_oi[num_fwd:], axis=rev_axes)
+        preds_oi = tf.concat([preds_oi[:num_fwd], preds_rev], axis=0)
+
+      preds_avg_oi = tf.reduce_mean(preds_oi, axis=0)
+      preds_avg_oi.set_shape(seq_1hot.shape[:1].concatenate(output.shape[1:]))
+      preds_avg.append(preds_avg_oi)
+
+    if len(preds_avg) == 1:
+      return preds_avg[0]
+    else:
+      return preds_avg
+
+  def predict_batched(self, seqs_1hot):
+    """Predict each of the model's outputs, as a list."""
+    if self.max_batch is None:
+      return tf.nest.flatten(self.model(seqs_1hot, training=False))
+
+    # pad to whole chunks
+    num_seqs = tf.shape(seqs_1hot)[0]
+    num_chunks = (num_seqs + self.max_batch - 1) // self.max_batch
+    pad_seqs = num_chunks*self.max_batch - num_seqs
+    seqs_1hot = tf.pad(seqs_1hot, [[0, pad_seqs], [0, 0], [0, 0]])
+
+    # predict chunks in sequence
+    seqs_shape = tf.concat([[num_chunks, self.max_batch], tf.shape(seqs_1hot)[1:]], axis=0)
+    chunks_preds = tf.map_fn(lambda x: tf.nest.flatten(self.model(x, training=False)),
+                             tf.reshape(seqs_1hot, seqs_shape),
+                             fn_output_signature=[output.dtype for output in self.model.outputs],
+                             parallel_iterations=1)
+
+    preds = []
+    for chunks_preds_oi in chunks_preds:
+      preds_shape = tf.concat([[-1], tf.shape(chunks_preds_oi)[2:]], axis=0)
+      preds.append(tf.reshape(chunks_preds_oi, preds_shape)[:num_seqs])
+    return preds
+
+  def get_config(self):
+    config = super().get_config().copy()
+    config.update({
+      'shifts': self.shifts,
+      'rc': self.rc,
+      'preds_triu': self.preds_triu,
+      'diagonal_offset': self.diagonal_offset,
+      'max_batch': self.max_batch
+    })
+    return config
+
 class StochasticShift(tf.keras.layers.Layer):
   """Stochastically shift a one hot encoded DNA sequence."""
   def __init__(self, shift_max=0, pad='uniform'):
@@ -734,25 +828,41 @@ def shift_sequence(seq, shift, pad_value=0.25):
       raise ValueError('input sequence should be rank 3')
   input_shape = seq.shape
 
-  pad = pad_value * tf.ones_like(seq[:, 0:tf.abs(shift), :])
-
-  def _shift_right(_seq):
-    # shift is positive
-    sliced_seq = _seq[:, :-shift:, :]
-    return tf.concat([pad, sliced_seq], axis=1)
-
-  def _shift_left(_seq):
-    # shift is negative
-    sliced_seq = _seq[:, -shift:, :]
-    return tf.concat([sliced_seq, pad], axis=1)
+  # gather shifted positions, keeping static shapes for XLA
+  seq_len = tf.shape(seq)[1]
+  shift_i = tf.range(seq_len) - tf.cast(shift, tf.int32)
+  valid = (shift_i >= 0) & (shift_i < seq_len)
+  sseq = tf.gather(seq, tf.clip_by_value(shift_i, 0, seq_len-1), axis=1)
 
-  sseq = tf.cond(tf.greater(shift, 0),
-                 lambda: _shift_right(seq),
-                 lambda: _shift_left(seq))
+  # fill vacated positions with padding
+  pad = tf.cast(pad_value, seq.dtype) * tf.ones_like(sseq)
+  sseq = tf.where(valid[tf.newaxis,:,tf.newaxis], sseq, pad)
   sseq.set_shape(input_shape)
 
   return sseq
 
+############################################################
+# Target slicing
+############################################################
+
+class DenseSlice(tf.keras.layers.Layer):
+  '''Apply a Dense layer for a subset of its units, gathering those
+     kernel columns from its variables at call time.'''
+  def __init__(self, dense, units_slice):
+    super(DenseSlice, self).__init__()
+    self.dense = dense
+    self.units_slice = list(units_slice)
+  def call(self, x):
+    kernel = tf.gather(self.dense.kernel, self.units_slice, axis=-1)
+    outputs = tf.tensordot(x, kernel, [[x.shape.rank-1], [0]])
+    if self.dense.use_bias:
+      outputs += tf.gather(self.dense.bias, self.units_slice)
+    return self.dense.activation(outputs)
+  def get_config(self):
+    config = super().get_config().copy()
+    config['units_slice'] = self.units_slice
+    return config
+
 ############################################################
 # Factorization
 ############################################################
@@ -139,6 +139,8 @@ class SeqAUC(tf.keras.metrics.AUC):
 
 class PearsonR(tf.keras.metrics.Metric):
   def __init__(self, num_targets, summarize=True, name='pearsonr', **kwargs):
+    # accumulate in float32, regardless of precision policy
+    kwargs.setdefault('dtype', 'float32')
     super(PearsonR, self).__init__(name=name, **kwargs)
     self._summarize = summarize
     self._shape = (num_targets,)
@@ -201,6 +203,8 @@ class PearsonR(tf.keras.metrics.Metric):
 
 class R2(tf.keras.metrics.Metric):
   def __init__(self, num_targets, summarize=True, name='r2', **kwargs):
+    # accumulate in float32, regardless of precision policy
+    kwargs.setdefault('dtype', 'float32')
     super(R2, self).__init__(name=name, **kwargs)
     self._summarize = summarize
     self._shape = (num_targets,)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 from optparse import OptionParser
 import glob
+import multiprocessing
 import pdb
 import os
 import random
+import shutil
 
 import h5py
 import numpy as np
@@ -17,13 +19,21 @@ sad5.py
 Interfaces to normalized and population-adjusted SAD scores.
 '''
 
+# values per stat chunk, by default, as whole rows of targets
+STAT_CHUNK_VALUES = 2**17
+
+# SNPs per chunk of the target-major copies, one target per chunk
+STAT_T_CHUNK_SNPS = 2**14
+
 class SAD5:
     def __init__(self, sad_h5_file, sad_key='SAD',
                  compute_norm=True, recompute_norm=False):
         self.sad_h5_file = sad_h5_file
         self.sad_h5_open = h5py.File(self.sad_h5_file, 'r')
 
+        self.sad_key = sad_key
         self.sad_matrix = self.sad_h5_open[sad_key]
+        self.sad_matrix_t = self.sad_h5_open.get('%s_T' % sad_key)
         self.num_snps, self.num_targets = self.sad_matrix.shape
 
         self.target_ids = np.array([tl.decode('UTF-8') for tl in self.sad_h5_open['target_ids']])
@@ -41,63 +51,91 @@ class SAD5:
             if recompute_norm or not 'target_cauchy_fit_loc' in self.sad_h5_open:
                 self.fit_cauchy()
 
-            # make target-specific fit cauchy's
-            target_cauchy_fit_params = zip(self.sad_h5_open['target_cauchy_fit_loc'],
-                                           self.sad_h5_open['target_cauchy_fit_scale'])
-            self.target_cauchy_fit = [cauchy(*cp) for cp in target_cauchy_fit_params]
+            # read target-specific fit cauchy parameters
+            self.target_cauchy_fit_loc = self.sad_h5_open['target_cauchy_fit_loc'][:]
+            self.target_cauchy_fit_scale = self.sad_h5_open['target_cauchy_fit_scale'][:]
 
             # choose normalizing values, if not present
             if recompute_norm or not 'target_cauchy_norm_loc' in self.sad_h5_open:
                 self.norm_cauchy()
 
-            # make target-specific normalizing cauchy's
-            target_cauchy_norm_params = zip(self.sad_h5_open['target_cauchy_norm_loc'],
-                                            self.sad_h5_open['target_cauchy_norm_scale'])
-            self.target_cauchy_norm = [cauchy(*cp) for cp in target_cauchy_norm_params]
+            # read target-specific normalizing cauchy parameters
+            self.target_cauchy_norm_loc = self.sad_h5_open['target_cauchy_norm_loc'][:]
+            self.target_cauchy_norm_scale = self.sad_h5_open['target_cauchy_norm_scale'][:]
 
 
     def __getitem__(self, si_ti):
-        """Return normalized scores for the given SNP and target indexes."""
+        """Return normalized scores for the given SNP and target indexes.
+
+        SNPs and targets may each be an integer, slice, or list/array of
+        indexes, e.g. sad5[si], sad5[si_list], sad5[si0:si1, ti_list].
+        Scores pass through each target's fit Cauchy CDF and its
+        normalizing Cauchy PPF, in closed form across all targets at once.
+        """
+        if isinstance(si_ti, tuple):
+            si, ti = si_ti
+        else:
+            si, ti = si_ti, slice(None)
 
+        sad = self.read_sad(si)[...,ti].astype('float64')
+
+        # fit cauchy CDF
+        fit_loc = self.target_cauchy_fit_loc[ti]
+        fit_scale = self.target_cauchy_fit_scale[ti]
+        sad_q = 0.5 + np.arctan((sad - fit_loc) / fit_scale) / np.pi
+
+        # buffer from the tails
         cdf_buf = 1e-5
-        if isinstance(si_ti, slice):
-            print('SAD5 slice is not implemented.', file=sys.stderr)
-            exit(1)
+        sad_q = np.where(sad_q > 0.5, sad_q-cdf_buf, sad_q+cdf_buf)
 
-        # single target
-        elif isinstance(si_ti, tuple):
-            si, ti = si_ti
-            sad_st = self.sad_matrix[si,ti].astype('float32')
-            sad_st_q = self.target_cauchy_fit[ti].cdf(sad_st)
-            if sad_st_q > 0.5:
-                sad_st_q -= cdf_buf
-            else:
-                sad_st_q += cdf_buf
-            sad_norm = self.target_cauchy_norm[ti].ppf(sad_st_q)
-
-        elif isinstance(si_ti, (list,np.ndarray)):
-            si = si_ti
-            sad_s = self.sad_matrix[si,:].astype('float32')
-            sad_norm = np.zeros(sad_s.shape)
-            for ti in range(self.num_targets):
-                sad_s_q = self.target_cauchy_fit[ti].cdf(sad_s[:,ti])
-                sad_s_q = np.where(sad_s_q > 0.5, sad_s_q-cdf_buf, sad_s_q+cdf_buf)
-                sad_norm[:,ti] = self.target_cauchy_norm[ti].ppf(sad_s_q)
-
-        # single SNP, multiple targets
-        else:
-            si = si_ti
-            sad_s = self.sad_matrix[si,:].astype('float32')
-            sad_norm = np.zeros(sad_s.shape)
-            for ti in range(self.num_targets):
-                sad_s_q = self.target_cauchy_fit[ti].cdf(sad_s[ti])
-                sad_s_q = np.where(sad_s_q > 0.5, sad_s_q-cdf_buf, sad_s_q+cdf_buf)
-                sad_norm[ti] = self.target_cauchy_norm[ti].ppf(sad_s_q)
+        # normalizing cauchy PPF
+        norm_loc = self.target_cauchy_norm_loc[ti]
+        norm_scale = self.target_cauchy_norm_scale[ti]
+        sad_norm = norm_loc + norm_scale*np.tan(np.pi*(sad_q - 0.5))
 
         return sad_norm
 
 
-    def fit_cauchy(self, sample=131072):
+    def read_sad(self, si):
+        """Read SAD rows for an integer, slice, or list/array of SNP
+           indexes, in the order given."""
+        if isinstance(si, (list,np.ndarray)):
+            si = np.asarray(si, dtype='int64')
+            if len(si) == 0:
+                return np.zeros((0,self.num_targets), dtype=self.sad_matrix.dtype)
+
+            # HDF5 requires increasing, unique indexes
+            si_unique, si_inverse = np.unique(si, return_inverse=True)
+            return self.sad_matrix[si_unique,:][si_inverse]
+
+        else:
+            return self.sad_matrix[si]
+
+
+    def read_targets(self, ti):
+        """Read SAD columns for an integer, slice, or list/array of target
+           indexes, in the order given, from the target-major copy when
+           the file has one."""
+        if isinstance(ti, (list,np.ndarray)):
+            ti = np.asarray(ti, dtype='int64')
+            if len(ti) == 0:
+                return np.zeros((self.num_snps,0), dtype=self.sad_matrix.dtype)
+
+            # HDF5 requires increasing, unique indexes
+            ti_unique, ti_inverse = np.unique(ti, return_inverse=True)
+            if self.sad_matrix_t is not None:
+                return self.sad_matrix_t[ti_unique,:].T[:,ti_inverse]
+            else:
+                return self.sad_matrix[:,ti_unique][:,ti_inverse]
+
+        elif self.sad_matrix_t is not None:
+            return self.sad_matrix_t[ti].T
+
+        else:
+            return self.sad_matrix[:,ti]
+
+
+    def fit_cauchy(self, sample=131072, processes=None):
         """Fit target-specific Cauchy distributions, and save to HDF5"""
 
         # sample SNPs
@@ -109,24 +147,14 @@ class SAD5:
         # read SNPs
         sad = self.sad_matrix[ri,:].astype('float32')
 
-        # initialize fit parameters
-        target_cauchy_fit_loc = np.zeros(self.num_targets)
-        target_cauchy_fit_scale = np.zeros(self.num_targets)
-
         # fit parameters
-        for ti in range(self.num_targets):
-            print(' Fitting t%d' % ti, flush=True)
-            cp = cauchy.fit(sad[:,ti])
-            target_cauchy_fit_loc[ti] = cp[0]
-            target_cauchy_fit_scale[ti] = cp[1]
+        target_cauchy_fit_loc, target_cauchy_fit_scale = fit_cauchy_targets(sad, processes)
 
         # write to HDF5
-        self.sad_h5_open.close()
-        self.sad_h5_open = h5py.File(self.sad_h5_file, 'r+')
+        self.reopen('r+')
         self.sad_h5_open.create_dataset('target_cauchy_fit_loc', data=target_cauchy_fit_loc)
         self.sad_h5_open.create_dataset('target_cauchy_fit_scale', data=target_cauchy_fit_scale)
-        self.sad_h5_open.close()
-        self.sad_h5_open = h5py.File(self.sad_h5_file, 'r')
+        self.reopen('r')
 
 
     def norm_cauchy(self, target_sets=['CAGE']):
@@ -167,12 +195,17 @@ class SAD5:
             target_cauchy_norm_scale[target_set_indexes] = target_set_scale
 
         # write to HDF5
-        self.sad_h5_open.close()
-        self.sad_h5_open = h5py.File(self.sad_h5_file, 'r+')
+        self.reopen('r+')
         self.sad_h5_open.create_dataset('target_cauchy_norm_loc', data=target_cauchy_norm_loc)
         self.sad_h5_open.create_dataset('target_cauchy_norm_scale', data=target_cauchy_norm_scale)
+        self.reopen('r')
+
+    def reopen(self, mode='r'):
+        """Reopen the HDF5 file, e.g. in r+ mode to write fits."""
         self.sad_h5_open.close()
-        self.sad_h5_open = h5py.File(self.sad_h5_file, 'r')
+        self.sad_h5_open = h5py.File(self.sad_h5_file, mode)
+        self.sad_matrix = self.sad_h5_open[self.sad_key]
+        self.sad_matrix_t = self.sad_h5_open.get('%s_T' % self.sad_key)
 
     def pos(self, snp_i):
         return self.sad_h5_open['pos'][snp_i]
@@ -192,22 +225,23 @@ class SAD5:
 
 class ChrSAD5:
     def __init__(self, sad_h5_path, population='EUR', index_chr=False,
-                 **sad5_kw_args):
+                 rebuild_index=False, **sad5_kw_args):
         self.index_chr = index_chr
         self.sad_h5_path = sad_h5_path
 
         self.set_population(population)
         self.open_chr_sad5(**sad5_kw_args)
         self.target_info()
-        self.index_snps()
+        self.index_snps(rebuild_index)
 
 
-    def fit_cauchy(self, sample=131072):
+    def fit_cauchy(self, sample=131072, processes=None):
         """Fit target-specific Cauchy distributions, and save to HDF5"""
 
         # sample SNPs
-        sample_snps = random.sample(list(self.snp_indexes.values()),
-                                   sample)
+        sample_i = random.sample(range(len(self.index_ids)), sample)
+        sample_chrs = self.index_chr_names[self.index_chrs[sample_i]]
+        sample_snps = zip(sample_chrs, self.index_rows[sample_i])
 
         # sort by chr
         chr_sample_snps = {}
@@ -223,21 +257,13 @@ class ChrSAD5:
             sad.append(self.chr_sad5[ci].sad_matrix[csnps])
         sad = np.concatenate(sad).astype('float32')
 
-        # initialize fit parameters
-        self.target_cauchy_fit_loc = np.zeros(self.num_targets)
-        self.target_cauchy_fit_scale = np.zeros(self.num_targets)
-
         # fit parameters
-        for ti in range(self.num_targets):
-            print(' Fitting t%d' % ti, flush=True)
-            cp = cauchy.fit(sad[:,ti])
-            self.target_cauchy_fit_loc[ti] = cp[0]
-            self.target_cauchy_fit_scale[ti] = cp[1]
+        self.target_cauchy_fit_loc, self.target_cauchy_fit_scale = \
+            fit_cauchy_targets(sad, processes)
 
         # write to HDF5
         for chrm, sad5 in self.chr_sad5.items():
-            sad5.sad_h5_open.close()
-            sad5.sad_h5_open = h5py.File(sad5.sad_h5_file, 'r+')
+            sad5.reopen('r+')
             if 'target_cauchy_fit_loc' in sad5.sad_h5_open:
                 del sad5.sad_h5_open['target_cauchy_fit_loc']
                 del sad5.sad_h5_open['target_cauchy_fit_scale']
@@ -245,27 +271,74 @@ class ChrSAD5:
                                             data=self.target_cauchy_fit_loc)
             sad5.sad_h5_open.create_dataset('target_cauchy_fit_scale',
                                             data=self.target_cauchy_fit_scale)
-            sad5.sad_h5_open.close()
-            sad5.sad_h5_open = h5py.File(sad5.sad_h5_file, 'r')
+            sad5.reopen('r')
+
+
+    def index_snps(self, rebuild=False):
+        """Memory map the SNP index at sad_h5_path/snp_index, building it
+           first if absent or older than any sad.h5.
+
+        The index holds all SNP ids in sorted order, with each id's
+        chromosome and sad.h5 row, for binary search by id, plus each
+        chromosome's rows sorted by position."""
+        index_dir = '%s/snp_index' % self.sad_h5_path
+        index_files = ['%s/%s.npy' % (index_dir, name) for name in
+                       ['ids', 'chrs', 'rows', 'pos', 'pos_rows', 'pos_offsets']]
+
+        if not rebuild and os.path.isfile(index_files[-1]):
+            index_time = os.path.getmtime(index_files[-1])
+            sad_times = [os.path.getmtime(sad5.sad_h5_file) for sad5 in self.chr_sad5.values()]
+            rebuild = max(sad_times) > index_time
+        else:
+            rebuild = True
+
+        if rebuild:
+            write_snp_index(index_dir, self.chr_sad5)
+
+        self.index_ids, self.index_chrs, self.index_rows, \
+            self.index_pos, self.index_pos_rows, index_pos_offsets = \
+            [np.load(index_file, mmap_mode='r') for index_file in index_files]
+
+        with open('%s/chrs.txt' % index_dir) as chrs_open:
+            self.index_chr_names = np.array(chrs_open.read().split())
+
+        # chromosome ranges in the position index
+        self.index_pos_range = {}
+        for ci, chrm in enumerate(self.index_chr_names):
+            self.index_pos_range[chrm] = tuple(index_pos_offsets[ci:ci+2])
+
 
+    def snps_chr_index(self, snp_ids):
+        """Return chromosome and row arrays for snp_ids, with None and -1
+           for SNPs not in the index."""
+        snp_ids = np.array([snp_id.encode('UTF-8') for snp_id in snp_ids], dtype='S')
 
-    def index_snps(self):
-        """Hash RSID's to HDF5 index."""
-        self.snp_indexes = {}
+        # search, taking the last of repeated ids
+        found = np.char.str_len(snp_ids) <= self.index_ids.dtype.itemsize
+        snp_ids = snp_ids.astype(self.index_ids.dtype)
+        ii = np.searchsorted(self.index_ids, snp_ids, side='right') - 1
+        ii = np.maximum(ii, 0)
+        if len(self.index_ids) > 0:
+            found &= (self.index_ids[ii] == snp_ids)
+        else:
+            found[:] = False
+
+        snp_chrs = np.where(found, self.index_chr_names[self.index_chrs[ii]], None)
+        snp_rows = np.where(found, self.index_rows[ii], -1)
+        return snp_chrs, snp_rows
 
-        # for each chromosome
-        for ci in self.chr_sad5:
-            # hash SNP ids to indexes
-            snps = self.chr_sad5[ci].snps()
-            for i, snp_id in enumerate(snps):
-                snp_id = snp_id.decode('UTF-8')
-                if self.index_chr:
-                    self.snp_indexes[snp_id] = (ci,i)
-                else:
-                    self.snp_indexes[snp_id] = i
 
-            # clean up
-            del snps
+    def snps_pos_index(self, chrm, pos):
+        """Return rows for SNPs at the given chromosome position."""
+        if chrm.startswith('chr'):
+            chrm = chrm[3:]
+        if chrm not in self.index_pos_range:
+            return np.zeros(0, dtype='int64')
+        pos_start, pos_end = self.index_pos_range[chrm]
+        chr_pos = self.index_pos[pos_start:pos_end]
+        pi = np.searchsorted(chr_pos, pos, side='left')
+        pj = np.searchsorted(chr_pos, pos, side='right')
+        return np.array(self.index_pos_rows[pos_start+pi:pos_start+pj], dtype='int64')
 
 
     def norm_cauchy(self, target_sets=['CAGE']):
@@ -301,8 +374,7 @@ class ChrSAD5:
 
         # write to HDF5
         for chrm, sad5 in self.chr_sad5.items():
-            sad5.sad_h5_open.close()
-            sad5.sad_h5_open = h5py.File(sad5.sad_h5_file, 'r+')
+            sad5.reopen('r+')
             if 'target_cauchy_norm_loc' in sad5.sad_h5_open:
                 del sad5.sad_h5_open['target_cauchy_norm_loc']
                 del sad5.sad_h5_open['target_cauchy_norm_scale']
@@ -310,8 +382,7 @@ class ChrSAD5:
                                             data=self.target_cauchy_norm_loc)
             sad5.sad_h5_open.create_dataset('target_cauchy_norm_scale',
                                             data=self.target_cauchy_norm_scale)
-            sad5.sad_h5_open.close()
-            sad5.sad_h5_open = h5py.File(sad5.sad_h5_file, 'r')
+            sad5.reopen('r')
 
 
     def open_chr_sad5(self, **sad5_kw_args):
@@ -327,20 +398,15 @@ class ChrSAD5:
         if chrm.startswith('chr'):
             chrm = chrm[3:]
 
-        if snp_id in self.snp_indexes:
-            snp_i = self.snp_indexes[snp_id]
-
+        snp_chr, snp_i = self.snp_chr_index(snp_id)
+        if snp_chr is not None:
             # retrieve LD variants
             ld_df = self.emerald_vcf.query_ld(snp_id, chrm, pos, ld_t=ld_t)
 
-            # retrieve scores for LD snps
-            ld_snp_indexes = np.zeros(ld_df.shape[0], dtype='uint32')
-            for si, ld_snp_id in enumerate(ld_df.snp):
-                if self.index_chr:
-                    _, ld_snp_i = self.snp_indexes[ld_snp_id]
-                else:
-                    ld_snp_i = self.snp_indexes[ld_snp_id]
-                ld_snp_indexes[si] = ld_snp_i
+            # retrieve scores for LD snps in the index
+            _, ld_snp_indexes = self.snps_chr_index(ld_df.snp)
+            ld_df = ld_df[ld_snp_indexes >= 0]
+            ld_snp_indexes = ld_snp_indexes[ld_snp_indexes >= 0]
             snps_scores = self.chr_sad5[chrm][ld_snp_indexes]
 
             # (1xN)(NxT) = (1xT)
@@ -361,16 +427,14 @@ class ChrSAD5:
             raise ValueError('Population %s not found' % population)
 
     def snp_chr_index(self, snp_id):
-        if not self.index_chr:
-            raise RuntimeError('SNPs not indexed to retrieve chromosome')
+        snp_chrs, snp_rows = self.snps_chr_index([snp_id])
+        if snp_chrs[0] is None:
+            return None, None
         else:
-            return self.snp_indexes.get(snp_id, (None,None))
+            return snp_chrs[0], int(snp_rows[0])
 
     def snp_index(self, snp_id):
-        if self.index_chr:
-            chrm, snp_i = self.snp_indexes[snp_id]
-        else:
-            snp_i = self.snp_indexes.get(snp_id, None)
+        chrm, snp_i = self.snp_chr_index(snp_id)
         return snp_i
 
     def snp_pos(self, snp_i, chrm):
@@ -382,3 +446,148 @@ class ChrSAD5:
         self.target_ids = self.chr_sad5[chrm].target_ids
         self.target_labels = self.chr_sad5[chrm].target_labels
         self.num_targets = len(self.target_ids)
+
+
+def fit_cauchy_targets(sad, processes=None):
+    """Fit a Cauchy distribution to each column of SNPs x targets sad,
+       across a process pool. Return loc and scale arrays."""
+    num_targets = sad.shape[1]
+    target_cauchy_fit_loc = np.zeros(num_targets)
+    target_cauchy_fit_scale = np.zeros(num_targets)
+
+    with multiprocessing.Pool(processes) as pool:
+        target_sads = (sad[:,ti] for ti in range(num_targets))
+        for ti, cp in enumerate(pool.imap(cauchy.fit, target_sads)):
+            print(' Fitting t%d' % ti, flush=True)
+            target_cauchy_fit_loc[ti] = cp[0]
+            target_cauchy_fit_scale[ti] = cp[1]
+
+    return target_cauchy_fit_loc, target_cauchy_fit_scale
+
+
+def write_snp_index(index_dir, chr_sad5):
+    """Write sorted SNP id and position indexes for a dict of
+       chromosome SAD5's, as .npy files to memory map, to a temporary
+       directory moved into place once complete."""
+    tmp_dir = '%s.tmp%d' % (index_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    chr_names = sorted(chr_sad5.keys())
+
+    ids, chrs, rows = [], [], []
+    pos, pos_rows, pos_offsets = [], [], [0]
+    for ci, chrm in enumerate(chr_names):
+        sad5 = chr_sad5[chrm]
+        chr_ids = sad5.snps()
+        ids.append(chr_ids)
+        chrs.append(np.full(len(chr_ids), ci, dtype='uint16'))
+        rows.append(np.arange(len(chr_ids), dtype='uint32'))
+
+        chr_pos = sad5.sad_h5_open['pos'][:]
+        chr_pos_order = np.argsort(chr_pos, kind='stable')
+        pos.append(chr_pos[chr_pos_order])
+        pos_rows.append(chr_pos_order.astype('uint32'))
+        pos_offsets.append(pos_offsets[-1] + len(chr_pos))
+
+    # drop h5py string metadata, which npy can't store
+    ids = np.concatenate(ids)
+    ids = ids.astype(np.dtype((np.bytes_, ids.dtype.itemsize)))
+    id_order = np.argsort(ids, kind='stable')
+
+    np.save('%s/ids.npy' % tmp_dir, ids[id_order])
+    np.save('%s/chrs.npy' % tmp_dir, np.concatenate(chrs)[id_order])
+    np.save('%s/rows.npy' % tmp_dir, np.concatenate(rows)[id_order])
+    np.save('%s/pos.npy' % tmp_dir, np.concatenate(pos))
+    np.save('%s/pos_rows.npy' % tmp_dir, np.concatenate(pos_rows))
+    with open('%s/chrs.txt' % tmp_dir, 'w') as chrs_out:
+        print('\n'.join(chr_names), file=chrs_out)
+
+    # written last to mark a complete index
+    np.save('%s/pos_offsets.npy' % tmp_dir, np.array(pos_offsets, dtype='int64'))
+
+    # move into place, yielding to a concurrent build
+    if os.path.isdir(index_dir):
+        shutil.rmtree(index_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def stat_h5_opts(shape, chunks=None, compression=None):
+    """Return h5py create_dataset keywords for a float16 [SNPs, targets]
+       stat, contiguous unless given chunks or compression.
+
+    Args:
+      shape: (SNPs, targets)
+      chunks: chunk shape, defaulting to blocks of whole target rows
+      compression: gzip, lzf, or blosc, which requires hdf5plugin
+    """
+    opts = {'shape':tuple(shape), 'dtype':'float16'}
+    if (chunks is None and compression is None) or 0 in shape:
+        return opts
+
+    if chunks is None:
+        chunks = (STAT_CHUNK_VALUES // max(1, shape[1]), shape[1])
+    opts['chunks'] = tuple([int(min(max(1, c), d)) for c, d in zip(chunks, shape)])
+
+    if compression == 'blosc':
+        import hdf5plugin
+        opts.update(hdf5plugin.Blosc(cname='lz4', clevel=5,
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+    elif compression is not None:
+        opts['compression'] = compression
+        opts['shuffle'] = True
+
+    return opts
+
+
+def stat_h5_cache(shape, chunks=None):
+    """Return h5py.File chunk cache keywords holding a full row of stat
+       chunks, so that SNP blocks written across a chunk's rows are
+       compressed once, when it's complete."""
+    if chunks is None:
+        return {}
+    num_chunk_cols = -(-shape[1] // chunks[1])
+    row_bytes = 2 * chunks[0] * chunks[1] * num_chunk_cols
+    return {'rdcc_nbytes': max(2**20, 2*row_bytes),
+            'rdcc_nslots': max(10007, 100*num_chunk_cols),
+            'rdcc_w0': 1}
+
+
+def create_dataset_like(h5_open, key, shape, dtype, dcpl, chunks=None):
+    """Create a dataset with the filters, e.g. compression, and fill value
+       of a dataset creation property list, as from
+       dataset.id.get_create_plist(), but the given shape and chunks."""
+    if 0 in shape:
+        return h5_open.create_dataset(key, shape=shape, dtype=dtype)
+    dcpl = dcpl.copy()
+    if chunks is not None:
+        dcpl.set_chunk(tuple([int(c) for c in chunks]))
+    space = h5py.h5s.create_simple(tuple([int(d) for d in shape]))
+    tid = h5py.h5t.py_create(np.dtype(dtype))
+    h5py.h5d.create(h5_open.id, key.encode('UTF-8'), tid, space, dcpl=dcpl)
+    return h5_open[key]
+
+
+def write_stat_transpose(h5_open, key, dcpl=None, block_values=2**26):
+    """Write a target-major [targets, SNPs] copy of an [SNPs, targets]
+       stat as key_T, for fast single-target reads.
+
+    The copy holds one target per chunk, compressed like the stat, or
+    the dataset creation property list dcpl when the stat is virtual.
+    The stat is read in blocks of SNP rows that fill whole chunks.
+    """
+    stat_dataset = h5_open[key]
+    num_snps, num_targets = stat_dataset.shape
+    if dcpl is None:
+        dcpl = stat_dataset.id.get_create_plist()
+
+    t_chunks = (1, min(max(1, num_snps), STAT_T_CHUNK_SNPS))
+    t_dataset = create_dataset_like(h5_open, '%s_T' % key, (num_targets, num_snps),
+                                    stat_dataset.dtype, dcpl, t_chunks)
+
+    block_chunks = max(1, block_values // (max(1, num_targets) * STAT_T_CHUNK_SNPS))
+    block_snps = block_chunks * STAT_T_CHUNK_SNPS
+    for si in range(0, num_snps, block_snps):
+        sj = min(si + block_snps, num_snps)
+        t_dataset[:,si:sj] = stat_dataset[si:sj].T
@@ -35,6 +35,8 @@ class SeqNN():
     self.build_model()
     self.ensemble = None
     self.embed = None
+    self.model_multi = None
+    self.gradient_fns = {}
 
   def set_defaults(self):
     # only necessary for my bespoke parameters
@@ -137,6 +139,10 @@ class SeqNN():
         else:
           current = layers.SwitchReverse()([current, reverse_bool])
 
+      # output float32 under mixed precision
+      if current.dtype != tf.float32:
+        current = tf.keras.layers.Activation('linear', dtype='float32')(current)
+
       # save head output
       self.head_output.append(current)
 
@@ -188,9 +194,28 @@ class SeqNN():
                                   outputs=conv_layer.output)
 
 
-  def build_ensemble(self, ensemble_rc=False, ensemble_shifts=[0]):
-    """ Build ensemble of models computing on augmented input sequences. """
-    if ensemble_rc or len(ensemble_shifts) > 1:
+  def build_ensemble(self, ensemble_rc=False, ensemble_shifts=[0],
+                     ensemble_batch=None):
+    """ Build ensemble of models computing on augmented input sequences.
+
+    Args:
+      ensemble_rc:     Average forward and reverse complement predictions.
+      ensemble_shifts: Average predictions of these shifts.
+      ensemble_batch:  Stack augmented copies along the batch dimension
+                       into model calls of at most this many sequences,
+                       or 0 for one call, rather than call per copy.
+    """
+    # ensemble the shared trunk model's outputs, if built
+    model = self.model if self.model_multi is None else self.model_multi
+
+    if ensemble_batch is not None and (ensemble_rc or len(ensemble_shifts) > 1):
+      sequence = tf.keras.Input(shape=(self.seq_length, 4), name='sequence')
+      preds_avg = layers.EnsembleBatch(model, ensemble_shifts, ensemble_rc,
+                                       self.preds_triu, getattr(self, 'diagonal_offset', 2),
+                                       max_batch=(ensemble_batch or None))(sequence)
+      self.ensemble = tf.keras.Model(inputs=sequence, outputs=preds_avg)
+
+    elif ensemble_rc or len(ensemble_shifts) > 1:
       # sequence input
       sequence = tf.keras.Input(shape=(self.seq_length, 4), name='sequence')
       sequences = [sequence]
@@ -206,14 +231,20 @@ class SeqNN():
         sequences_rev = [(seq,tf.constant(False)) for seq in sequences]
 
       # predict each sequence
-      if self.preds_triu:
-        preds = [layers.SwitchReverseTriu(self.diagonal_offset)
-                  ([self.model(seq), rp]) for (seq,rp) in sequences_rev]
-      else:
-        preds = [layers.SwitchReverse()([self.model(seq), rp]) for (seq,rp) in sequences_rev]
+      preds = [tf.nest.flatten(model(seq)) for (seq,rp) in sequences_rev]
 
-      # create layer
-      preds_avg = tf.keras.layers.Average()(preds)      
+      # switch and average each output
+      preds_avg = []
+      for oi in range(len(preds[0])):
+        if self.preds_triu:
+          preds_oi = [layers.SwitchReverseTriu(self.diagonal_offset)
+                      ([sp[oi], rp]) for sp, (seq,rp) in zip(preds, sequences_rev)]
+        else:
+          preds_oi = [layers.SwitchReverse()([sp[oi], rp])
+                      for sp, (seq,rp) in zip(preds, sequences_rev)]
+        preds_avg.append(tf.keras.layers.Average()(preds_oi))
+      if self.model_multi is None:
+        preds_avg = preds_avg[0]
 
       # create meta model
       self.ensemble = tf.keras.Model(inputs=sequence, outputs=preds_avg)
@@ -222,17 +253,63 @@ class SeqNN():
   def build_slice(self, target_slice=None):
     if target_slice is not None:
       if len(target_slice) < self.num_targets():
-        # sequence input
-        sequence = tf.keras.Input(shape=(self.seq_length, 4), name='sequence')
+        # replace model
+        self.model = tf.keras.Model(inputs=self.model.inputs,
+                                    outputs=self.slice_output(0, target_slice))
 
-        # predict
-        predictions = self.model(sequence)
 
-        # slice
-        predictions_slice = tf.gather(predictions, target_slice, axis=-1)
+  def build_multi(self, head_indexes=None, target_slices=None):
+    """ Build a model computing the trunk once for several outputs,
+        each a head, optionally sliced to a subset of its targets.
 
-        # replace model
-        self.model = tf.keras.Model(inputs=sequence, outputs=predictions_slice)
+    Args:
+      head_indexes:  Head of each output, defaulting to all heads.
+      target_slices: Target indexes of each output, or None for all.
+
+    predict_model returns it, ensembled if build_ensemble follows.
+    """
+    if head_indexes is None:
+      head_indexes = list(range(len(self.models)))
+    if target_slices is None:
+      target_slices = [None]*len(head_indexes)
+
+    outputs = [self.slice_output(hi, ts) for hi, ts in zip(head_indexes, target_slices)]
+    self.model_multi = tf.keras.Model(inputs=self.models[0].inputs, outputs=outputs)
+    return self.model_multi
+
+
+  def slice_output(self, head_i, target_slice=None):
+    """ Return the head's output for target_slice, computing only
+        those targets' units when the final layer is Dense. """
+    current = self.head_output[head_i]
+    if target_slice is None:
+      return current
+    target_slice = list(target_slice)
+
+    # find final layer, within any float32 cast and reverse switch
+    layer = current._keras_history.layer
+    cast_float32 = isinstance(layer, tf.keras.layers.Activation) and \
+      layer.activation is tf.keras.activations.linear and layer.dtype == 'float32'
+    if cast_float32:
+      current = layer.input
+      layer = current._keras_history.layer
+
+    switch_reverse = None
+    if isinstance(layer, layers.SwitchReverse):
+      switch_reverse = layer
+      current, reverse_bool = layer.input
+      layer = current._keras_history.layer
+
+    if not isinstance(layer, tf.keras.layers.Dense):
+      # slice full predictions
+      return tf.gather(self.head_output[head_i], target_slice, axis=-1)
+
+    current = layers.DenseSlice(layer, target_slice)(layer.input)
+    if switch_reverse is not None:
+      current = layers.SwitchReverse()([current, reverse_bool])
+    if cast_float32:
+      current = tf.keras.layers.Activation('linear', dtype='float32')(current)
+    return current
 
 
   def evaluate(self, seq_data, head_i=0, loss='poisson'):
@@ -281,8 +358,98 @@ class SeqNN():
     return weights
 
 
+  def gradients(self, seqs_1hot, head_i=0, pos_slice=None, seq_slice=None,
+                target_groups=None, group_size=16, batch_size=8,
+                dtype='float32'):
+    """ Compute input gradients of predictions summed across positions.
+
+    Args:
+      seqs_1hot:     [seqs, seq_length, 4] one hot coded sequences.
+      head_i:        Model head.
+      pos_slice:     Prediction positions to sum, or all.
+      seq_slice:     Sequence positions to return gradients for, or all.
+      target_groups: Lists of target indexes whose predictions are summed
+                     into one output each, or None for every target.
+      group_size:    Outputs per backward pass, each on its own copy of
+                     the batch's sequences.
+      batch_size:    Sequences per GradientTape pass, before copies.
+      dtype:         Returned gradients type.
+
+    Returns:
+      grads:         [seqs, seq_slice, 4, outputs] gradients, from one
+                     backward pass per group_size outputs for each batch.
+    """
+    model = self.predict_model(head_i)
+    num_targets = model.output_shape[-1]
+    if pos_slice is None:
+      pos_slice = slice(None)
+    if seq_slice is None:
+      seq_slice = slice(None)
+
+    # target weights of each output
+    if target_groups is None:
+      output_weights = np.eye(num_targets, dtype='float32')
+    else:
+      output_weights = np.zeros((num_targets, len(target_groups)), dtype='float32')
+      for gi, target_group in enumerate(target_groups):
+        output_weights[target_group,gi] = 1
+    num_outputs = output_weights.shape[1]
+    group_size = min(group_size, num_outputs)
+
+    # reuse traced functions across calls
+    fn_key = (id(model), pos_slice.start, pos_slice.stop,
+              seq_slice.start, seq_slice.stop)
+    if fn_key not in self.gradient_fns:
+      @tf.function
+      def batch_gradients(x, group_weights):
+        # copy each sequence once per output of the group
+        group_len = tf.shape(group_weights)[1]
+        x_group = tf.repeat(x, group_len, axis=0)
+        with tf.GradientTape() as tape:
+          tape.watch(x_group)
+          preds = model(x_group, training=False)
+          preds_sum = tf.reduce_sum(preds[:,pos_slice], axis=1)
+          outputs_sum = tf.matmul(preds_sum, group_weights)
+
+          # sum each copy's own output, for one backward pass
+          outputs_sum = tf.reshape(outputs_sum, [-1, group_len, group_len])
+          outputs_sum = tf.linalg.diag_part(outputs_sum)
+        grads = tape.gradient(outputs_sum, x_group)
+
+        # [batch, seq_length, 4, group_size]
+        grads = tf.reshape(grads, [-1, group_len] + grads.shape[1:].as_list())
+        return tf.transpose(grads[:,:,seq_slice], [0,2,3,1])
+      self.gradient_fns[fn_key] = batch_gradients
+    batch_gradients = self.gradient_fns[fn_key]
+
+    grads = []
+    for si in range(0, len(seqs_1hot), batch_size):
+      # pad to a fixed batch size, to trace once
+      x = np.asarray(seqs_1hot[si:si+batch_size], dtype='float32')
+      batch_len = x.shape[0]
+      if batch_len < batch_size:
+        x_pad = np.zeros((batch_size-batch_len,)+x.shape[1:], dtype='float32')
+        x = np.concatenate([x, x_pad])
+      x = tf.constant(x)
+
+      grads_batch = []
+      for gi in range(0, num_outputs, group_size):
+        # pad to a fixed group size, to trace once
+        group_weights = np.zeros((num_targets, group_size), dtype='float32')
+        group_len = min(group_size, num_outputs - gi)
+        group_weights[:,:group_len] = output_weights[:,gi:gi+group_len]
+
+        grads_group = batch_gradients(x, tf.constant(group_weights)).numpy()
+        grads_batch.append(grads_group[:batch_len,...,:group_len].astype(dtype))
+      grads.append(np.concatenate(grads_batch, axis=-1))
+
+    return np.concatenate(grads)
+
+
   def num_targets(self, head_i=None):
     if head_i is None:
+      if self.model_multi is not None:
+        return sum([output.shape[-1] for output in self.model_multi.outputs])
       return self.model.output_shape[-1]
     else:
       return self.models[head_i].output_shape[-1]
@@ -290,13 +457,7 @@ class SeqNN():
 
   def predict(self, seq_data, head_i=0, generator=False, **kwargs):
     """ Predict targets for SeqDataset. """
-    # choose model
-    if self.embed is not None:
-      model = self.embed
-    elif self.ensemble is not None:
-      model = self.ensemble
-    else:
-      model = self.models[head_i]
+    model = self.predict_model(head_i)
 
     dataset = getattr(seq_data, 'dataset', None)
     if dataset is None:
@@ -308,6 +469,21 @@ class SeqNN():
       return model.predict(dataset, **kwargs)
 
 
+  def predict_model(self, head_i=0):
+    """ Choose the model that predict computes. """
+    if self.embed is not None:
+      return self.embed
+    elif self.ensemble is not None:
+      return self.ensemble
+    elif self.model_multi is not None:
+      return self.model_multi
+    elif head_i == 0:
+      # first head, as sliced
+      return self.model
+    else:
+      return self.models[head_i]
+
+
   def restore(self, model_file, trunk=False):
     """ Restore weights from saved model. """
     if trunk:
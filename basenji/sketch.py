@@ -0,0 +1,119 @@
+# Copyright 2020 Calico LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import numpy as np
+
+'''
+sketch.py
+
+Mergeable streaming quantile sketches.
+'''
+
+class QuantileSketch:
+  """Per-column quantile sketch of a stream of [rows, columns] arrays.
+
+  Values are counted in logarithmically spaced buckets of their absolute
+  value, separately for each sign (as in DDSketch), so every quantile is
+  returned within relative error rel_acc, and sketches built with the same
+  parameters merge exactly by adding counts. Absolute values below
+  min_value count as zero; those above max_value share the last bucket.
+
+  Args:
+    num_cols: Number of columns, e.g. targets.
+    rel_acc: Relative accuracy of returned quantiles.
+    min_value: Smallest absolute value distinguished from zero.
+    max_value: Largest absolute value resolved (float16 max by default).
+  """
+  def __init__(self, num_cols, rel_acc=0.005, min_value=1e-7, max_value=65504):
+    self.num_cols = num_cols
+    self.rel_acc = rel_acc
+    self.min_value = min_value
+    self.max_value = max_value
+
+    self.gamma = (1 + rel_acc) / (1 - rel_acc)
+    self.log_gamma = np.log(self.gamma)
+    self.num_mags = int(np.ceil(np.log(max_value / min_value) / self.log_gamma))
+
+    # negative buckets by descending magnitude, zero, positive ascending
+    self.num_buckets = 2*self.num_mags + 1
+    self.counts = np.zeros((num_cols, self.num_buckets), dtype='uint32')
+
+  def update(self, values):
+    """Add a [rows, num_cols] array of values."""
+    values = np.nan_to_num(np.asarray(values, dtype='float64'))
+    values = values.reshape((-1, self.num_cols))
+
+    # magnitude bucket
+    abs_values = np.abs(values)
+    nonzero = abs_values >= self.min_value
+    mags = np.log(np.maximum(abs_values, self.min_value) / self.min_value)
+    mags = np.floor(mags / self.log_gamma).astype('int64')
+    mags = np.clip(mags, 0, self.num_mags-1)
+
+    # signed bucket
+    buckets = np.where(values > 0, self.num_mags + 1 + mags,
+                       self.num_mags - 1 - mags)
+    buckets = np.where(nonzero, buckets, self.num_mags)
+
+    cols = np.broadcast_to(np.arange(self.num_cols), buckets.shape)
+    np.add.at(self.counts, (cols.ravel(), buckets.ravel()), 1)
+
+  def merge(self, other):
+    """Add the counts of a sketch with the same parameters."""
+    assert(self.counts.shape == other.counts.shape)
+    assert(self.rel_acc == other.rel_acc)
+    assert(self.min_value == other.min_value)
+    self.counts += other.counts
+
+  def bucket_values(self):
+    """Return the representative value of each bucket."""
+    mag_values = self.min_value * self.gamma**np.arange(self.num_mags)
+    mag_values *= 2*self.gamma / (1 + self.gamma)
+    return np.concatenate([-mag_values[::-1], [0], mag_values])
+
+  def quantiles(self, qs):
+    """Return [num_cols, len(qs)] quantiles for qs in [0,1], at the
+       ranks np.percentile would interpolate from."""
+    qs = np.asarray(qs)
+    bucket_values = self.bucket_values()
+
+    col_quantiles = np.zeros((self.num_cols, len(qs)))
+    for ci in range(self.num_cols):
+      cum_counts = np.cumsum(self.counts[ci], dtype='int64')
+      if cum_counts[-1] > 0:
+        ranks = np.round(qs * (cum_counts[-1] - 1))
+        qi = np.searchsorted(cum_counts, ranks, side='right')
+        col_quantiles[ci] = bucket_values[qi]
+      else:
+        col_quantiles[ci] = np.nan
+
+    return col_quantiles
+
+  def write(self, h5_open, key):
+    """Write counts and parameters to an open HDF5 file."""
+    h5_open.create_dataset(key, data=self.counts, compression='gzip')
+    h5_open[key].attrs['rel_acc'] = self.rel_acc
+    h5_open[key].attrs['min_value'] = self.min_value
+    h5_open[key].attrs['max_value'] = self.max_value
+
+  @classmethod
+  def read(cls, h5_open, key):
+    """Read a sketch written by write."""
+    counts = h5_open[key]
+    sketch = cls(counts.shape[0],
+                 rel_acc=counts.attrs['rel_acc'],
+                 min_value=counts.attrs['min_value'],
+                 max_value=counts.attrs['max_value'])
+    sketch.counts[:] = counts
+    return sketch
@@ -14,6 +14,8 @@
 # =========================================================================
 from __future__ import print_function
 import pdb
+import queue
+import threading
 
 import numpy as np
 import tensorflow as tf
@@ -24,21 +26,45 @@ from basenji import dna_io
 class PredStreamGen:
   """ Interface to acquire predictions via a buffered stream mechanism
         rather than getting them all at once and using excessive memory.
-        Accepts generator and constructs stream batches from it. """
-  def __init__(self, model, seqs_gen, batch_size, stream_seqs=64, verbose=False):
+        Accepts generator and constructs stream batches from it.
+
+      A producer thread draws sequences from the generator into fixed
+        size batches on a bounded queue, while a persistent tf.function
+        predicts them, dispatching each batch before fetching the
+        previous one's predictions. Predictions for the current chunk
+        of stream_seqs sequences remain available by index.
+
+      Models with several outputs, e.g. SeqNN.build_multi heads, give a
+        list of each output's predictions by index, or with concat_outputs,
+        their concatenation along the target axis. """
+  def __init__(self, model, seqs_gen, batch_size, stream_seqs=64,
+               prefetch_batches=4, concat_outputs=False, verbose=False):
+    # choose Keras model, e.g. from SeqNN
+    if hasattr(model, 'predict_model'):
+      model = model.predict_model()
     self.model = model
+    self.concat_outputs = concat_outputs
+    self.predict_batch = tf.function(self.predict_outputs)
+
     self.seqs_gen = seqs_gen
-    self.stream_seqs = stream_seqs
     self.batch_size = batch_size
+    self.stream_batches = max(1, int(np.ceil(stream_seqs / batch_size)))
+    self.stream_seqs = self.stream_batches * batch_size
     self.verbose = verbose
 
     self.stream_start = 0
     self.stream_end = 0
 
+    # start producer
+    self.batch_queue = queue.Queue(maxsize=prefetch_batches)
+    self.stream_done = False
+    self.producer = threading.Thread(target=self.produce_batches, daemon=True)
+    self.producer.start()
+
 
   def __getitem__(self, i):
     # acquire predictions, if needed
-    if i >= self.stream_end:
+    while i >= self.stream_end:
       # update start
       self.stream_start = self.stream_end
 
@@ -46,28 +72,92 @@ class PredStreamGen:
         print('Predicting from %d' % self.stream_start, flush=True)
 
       # predict
-      self.stream_preds = self.model.predict(self.make_dataset())
+      self.stream_preds = self.predict_stream()
 
       # update end
-      self.stream_end = self.stream_start + self.stream_preds.shape[0]
-
-    return self.stream_preds[i - self.stream_start]
-
-  def make_dataset(self):
-    """ Construct Dataset object for this stream chunk. """
-    seqs_1hot = []
-    stream_end = self.stream_start+self.stream_seqs
-    for si in range(self.stream_start, stream_end):
-      try:
-        seqs_1hot.append(self.seqs_gen.__next__())
-      except StopIteration:
-        continue
-
-    seqs_1hot = np.array(seqs_1hot)
-
-    dataset = tf.data.Dataset.from_tensor_slices((seqs_1hot,))
-    dataset = dataset.batch(self.batch_size)
-    return dataset
+      stream_len = self.stream_preds[0].shape[0]
+      self.stream_end = self.stream_start + stream_len
+
+      if stream_len == 0:
+        raise IndexError('Prediction stream ended before index %d' % i)
+
+    preds = [sp[i - self.stream_start] for sp in self.stream_preds]
+    if self.multi_output():
+      return preds
+    else:
+      return preds[0]
+
+  def multi_output(self):
+    return len(self.model.outputs) > 1 and not self.concat_outputs
+
+  def predict_outputs(self, x):
+    """ Predict a batch, as a list of outputs. """
+    preds = tf.nest.flatten(self.model(x, training=False))
+    if self.concat_outputs and len(preds) > 1:
+      preds = [tf.concat(preds, axis=-1)]
+    return preds
+
+  def produce_batches(self):
+    """ Fill the queue with batches drawn from the generator, followed
+        by None, or the exception raised. """
+    try:
+      batch = []
+      for seq_1hot in self.seqs_gen:
+        batch.append(seq_1hot)
+        if len(batch) == self.batch_size:
+          self.batch_queue.put(np.array(batch, dtype='float32'))
+          batch = []
+      if batch:
+        self.batch_queue.put(np.array(batch, dtype='float32'))
+      self.batch_queue.put(None)
+    except Exception as e:
+      self.batch_queue.put(e)
+
+  def next_batch(self):
+    """ Return the next batch from the producer, or None at the end. """
+    if self.stream_done:
+      return None
+    batch = self.batch_queue.get()
+    if isinstance(batch, Exception):
+      self.stream_done = True
+      raise batch
+    if batch is None:
+      self.stream_done = True
+    return batch
+
+  def predict_stream(self):
+    """ Predict the next chunk of stream_seqs sequences, as a list
+        of outputs. """
+    stream_preds = []
+    pending = None
+
+    for bi in range(self.stream_batches):
+      batch = self.next_batch()
+      if batch is None:
+        break
+
+      # pad to a fixed batch size, to trace once
+      batch_len = batch.shape[0]
+      if batch_len < self.batch_size:
+        batch_pad = np.zeros((self.batch_size-batch_len,)+batch.shape[1:], dtype=batch.dtype)
+        batch = np.concatenate([batch, batch_pad])
+
+      # dispatch this batch before fetching the last
+      batch_preds = self.predict_batch(tf.constant(batch))
+      if pending is not None:
+        stream_preds.append([bp.numpy()[:pending[1]] for bp in pending[0]])
+      pending = (batch_preds, batch_len)
+
+    if pending is not None:
+      stream_preds.append([bp.numpy()[:pending[1]] for bp in pending[0]])
+
+    if stream_preds:
+      return [np.concatenate(sp) for sp in zip(*stream_preds)]
+    else:
+      output_shapes = [tuple(output.shape[1:]) for output in self.model.outputs]
+      if self.concat_outputs and len(output_shapes) > 1:
+        output_shapes = [output_shapes[0][:-1] + (sum(shape[-1] for shape in output_shapes),)]
+      return [np.zeros((0,)+shape, dtype='float32') for shape in output_shapes]
 
 
 class PredStreamIter:
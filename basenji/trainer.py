@@ -13,6 +13,7 @@
 # limitations under the License.
 # =========================================================================
 """SeqNN trainer"""
+from concurrent.futures import ThreadPoolExecutor
 import time
 from packaging import version
 import pdb
@@ -26,6 +27,12 @@ from tensorflow.python.framework import dtypes
 from basenji import layers
 from basenji import metrics
 
+def set_precision(params):
+  """Set the Keras precision policy from params 'precision', e.g.
+     float32, mixed_float16, or mixed_bfloat16, before building models."""
+  tf.keras.mixed_precision.set_global_policy(params.get('precision', 'float32'))
+
+
 class Trainer:
   def __init__(self, params, train_data, eval_data, out_dir):
     self.params = params
@@ -38,6 +45,14 @@ class Trainer:
     self.out_dir = out_dir
     self.compiled = False
 
+    # precision and compilation
+    self.precision = self.params.get('precision', 'float32')
+    self.loss_scale = (self.precision == 'mixed_float16')
+    self.xla = self.params.get('xla', False)
+
+    # micro-batches per optimizer step
+    self.accumulate_steps = self.params.get('accumulate_steps', 1)
+
     # loss
     self.loss = self.params.get('loss','poisson').lower()
     if self.loss == 'mse':
@@ -74,9 +89,14 @@ class Trainer:
         num_targets = model.output_shape[-1]
         model_metrics = [metrics.PearsonR(num_targets), metrics.R2(num_targets)]
       
+      compile_kwargs = {}
+      if self.xla:
+        compile_kwargs['jit_compile'] = True
+
       model.compile(loss=self.loss_fn,
                     optimizer=self.optimizer,
-                    metrics=model_metrics)
+                    metrics=model_metrics,
+                    **compile_kwargs)
     self.compiled = True
 
   def fit_keras(self, seqnn_model):
@@ -111,10 +131,14 @@ class Trainer:
       validation_steps=self.eval_epoch_batches[0])
 
   def fit2(self, seqnn_model):
+    """Train on any number of datasets, one per model/head, through
+       one combined input pipeline and one compiled train step, and
+       evaluate the heads' validation sets in parallel."""
     if not self.compiled:
       self.compile(seqnn_model)
 
     assert(len(seqnn_model.models) >= self.num_datasets)
+    models = seqnn_model.models[:self.num_datasets]
 
     ################################################################
     # prep
@@ -122,55 +146,23 @@ class Trainer:
     # metrics
     train_loss, train_r, train_r2 = [], [], []
     for di in range(self.num_datasets):
-      num_targets = seqnn_model.models[di].output_shape[-1]
+      num_targets = models[di].output_shape[-1]
       train_loss.append(tf.keras.metrics.Mean())
       train_r.append(metrics.PearsonR(num_targets))
       train_r2.append(metrics.R2(num_targets))
 
-    # generate decorated train steps
-    """
-    train_steps = []
-    for di in range(self.num_datasets):
-      model = seqnn_model.models[di]
-
-      @tf.function
-      def train_step(x, y):
-        with tf.GradientTape() as tape:
-          pred = model(x, training=tf.constant(True))
-          loss = self.loss_fn(y, pred) + sum(model.losses)
-        train_loss[di](loss)
-        train_r[di](y, pred)
-        train_r2[di](y, pred)
-        gradients = tape.gradient(loss, model.trainable_variables)
-        self.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
-
-      train_steps.append(train_step)
-    """
-    @tf.function
-    def train_step0(x, y):
-      with tf.GradientTape() as tape:
-        pred = seqnn_model.models[0](x, training=tf.constant(True))
-        loss = self.loss_fn(y, pred) + sum(seqnn_model.models[0].losses)
-      train_loss[0](loss)
-      train_r[0](y, pred)
-      train_r2[0](y, pred)
-      gradients = tape.gradient(loss, seqnn_model.models[0].trainable_variables)
-      self.optimizer.apply_gradients(zip(gradients, seqnn_model.models[0].trainable_variables))
-
-    if self.num_datasets > 1:
-      @tf.function
-      def train_step1(x, y):
-        with tf.GradientTape() as tape:
-          pred = seqnn_model.models[1](x, training=tf.constant(True))
-          loss = self.loss_fn(y, pred) + sum(seqnn_model.models[1].losses)
-        train_loss[1](loss)
-        train_r[1](y, pred)
-        train_r2[1](y, pred)
-        gradients = tape.gradient(loss, seqnn_model.models[1].trainable_variables)
-        self.optimizer.apply_gradients(zip(gradients, seqnn_model.models[1].trainable_variables))
+    # generate decorated train step
+    train_step = self.make_multi_train_step(models, train_loss, train_r, train_r2)
+
+    # combined dataset iterator
+    train_iter = iter(self.make_multi_dataset(models))
+    epoch_batches = len(self.dataset_indexes)
+
+    def evaluate(di):
+      return models[di].evaluate(self.eval_data[di].dataset, verbose=0)
 
     # improvement variables
-    valid_best = [np.inf]*self.num_datasets
+    valid_best = [-np.inf]*self.num_datasets
     unimproved = [0]*self.num_datasets
 
     ################################################################
@@ -180,38 +172,32 @@ class Trainer:
       if ei >= self.train_epochs_min and np.min(unimproved) > self.patience:
         break
       else:
-        # shuffle datasets
-        np.random.shuffle(self.dataset_indexes)
-
-        # get iterators
-        train_data_iters = [iter(td.dataset) for td in self.train_data]
-
         # train
         t0 = time.time()
-        for di in self.dataset_indexes:
-          x, y = next(train_data_iters[di])
-          # train_steps[di](x, y)
-          if di == 0:
-            train_step0(x, y)
-          else:
-            train_step1(x, y)
+        for si in range(epoch_batches):
+          x, y, di = next(train_iter)
+          train_step(x, y, di)
+        train_time = time.time() - t0
+
+        # evaluate validation sets in parallel
+        with ThreadPoolExecutor(self.num_datasets) as executor:
+          valid_stats = list(executor.map(evaluate, range(self.num_datasets)))
 
-        print('Epoch %d - %ds' % (ei, (time.time()-t0)))
+        print('Epoch %d - %ds' % (ei, train_time))
         for di in range(self.num_datasets):
           print('  Data %d' % di, end='')
-          model = seqnn_model.models[di]
+          model = models[di]
 
           # print training accuracy
           print(' - train_loss: %.4f' % train_loss[di].result().numpy(), end='')
           print(' - train_r: %.4f' %  train_r[di].result().numpy(), end='')
-          print(' - train_r: %.4f' %  train_r2[di].result().numpy(), end='')
+          print(' - train_r2: %.4f' %  train_r2[di].result().numpy(), end='')
 
           # print validation accuracy
-          valid_stats = model.evaluate(self.eval_data[di].dataset, verbose=0)
-          print(' - valid_loss: %.4f' % valid_stats[0], end='')
-          print(' - valid_r: %.4f' % valid_stats[1], end='')
-          print(' - valid_r2: %.4f' % valid_stats[2], end='')
-          early_stop_stat = valid_stats[1]
+          print(' - valid_loss: %.4f' % valid_stats[di][0], end='')
+          print(' - valid_r: %.4f' % valid_stats[di][1], end='')
+          print(' - valid_r2: %.4f' % valid_stats[di][2], end='')
+          early_stop_stat = valid_stats[di][1]
 
           # checkpoint
           model.save('%s/model%d_check.h5' % (self.out_dir, di))
@@ -231,7 +217,6 @@ class Trainer:
           train_r[di].reset_states()
           train_r2[di].reset_states()
 
-        
   def fit_tape(self, seqnn_model):
     if not self.compiled:
       self.compile(seqnn_model)
@@ -243,15 +228,7 @@ class Trainer:
     train_r = metrics.PearsonR(num_targets)
     train_r2 = metrics.R2(num_targets)
     
-    @tf.function
-    def train_step(x, y):
-      with tf.GradientTape() as tape:
-        pred = model(x, training=tf.constant(True))
-        loss = self.loss_fn(y, pred) + sum(model.losses)
-      train_loss(loss)
-      train_r(y, pred)
-      gradients = tape.gradient(loss, model.trainable_variables)
-      self.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+    train_step = self.make_train_step(model, train_loss, train_r)
 
     # improvement variables
     valid_best = -np.inf
@@ -295,18 +272,190 @@ class Trainer:
         train_loss.reset_states()
         train_r.reset_states()
 
+  def make_train_step(self, model, train_loss, train_r, train_r2=None):
+    """Return a compiled train step for model, updating the metrics,
+       scaling the loss for float16 gradients and compiling with XLA
+       as configured.
+
+    With accumulate_steps N > 1, each call accumulates the micro-batch
+    gradients averaged over N, so they sum to the mean gradient over the
+    N micro-batches, including regularization, and every Nth call applies
+    them. BatchNorm statistics remain per micro-batch."""
+    def compute_gradients(x, y):
+      return self.compute_gradients(model, x, y, train_loss, train_r, train_r2)
+
+    def train_step(x, y):
+      gradients = compute_gradients(x, y)
+      self.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+
+    tf_function = self.make_tf_function()
+
+    if self.accumulate_steps == 1:
+      return tf_function(train_step)
+
+    # gradient accumulators
+    accum_gradients = [tf.Variable(tf.zeros_like(tv), trainable=False)
+                       for tv in model.trainable_variables]
+
+    def accumulate_step(x, y):
+      gradients = compute_gradients(x, y)
+      for ag, g in zip(accum_gradients, gradients):
+        ag.assign_add(g / self.accumulate_steps)
+
+    def apply_step():
+      self.optimizer.apply_gradients(zip(accum_gradients, model.trainable_variables))
+      for ag in accum_gradients:
+        ag.assign(tf.zeros_like(ag))
+
+    accumulate_step = tf_function(accumulate_step)
+    apply_step = tf_function(apply_step)
+    micro_steps = [0]
+
+    def train_step_accum(x, y):
+      accumulate_step(x, y)
+      micro_steps[0] += 1
+      if micro_steps[0] % self.accumulate_steps == 0:
+        apply_step()
+
+    return train_step_accum
+
+  def make_multi_train_step(self, models, train_loss, train_r, train_r2):
+    """Return a compiled train step(x, y, di) for the list of models,
+       dispatching on the int32 dataset/head index di, for targets
+       zero-padded to the largest target length and count.
+
+    With accumulate_steps N > 1, micro-batch gradients from all heads
+    accumulate into one set per variable, shared trunk variables included,
+    and every Nth call applies them to all models' variables."""
+    # unique variables across models
+    variables = {}
+    for model in models:
+      for tv in model.trainable_variables:
+        variables[tv.ref()] = tv
+    variables = [vr.deref() for vr in variables]
+
+    # create optimizer state outside the dispatch branches
+    if hasattr(self.optimizer, 'build'):
+      self.optimizer.build(variables)
+
+    if self.accumulate_steps > 1:
+      variable_index = {tv.ref(): vi for vi, tv in enumerate(variables)}
+      accum_gradients = [tf.Variable(tf.zeros_like(tv), trainable=False)
+                         for tv in variables]
+
+    def make_branch(di, x, y):
+      model = models[di]
+      target_length, num_targets = model.output_shape[1:]
+      def branch():
+        y_di = y[:, :target_length, :num_targets]
+        gradients = self.compute_gradients(model, x, y_di,
+          train_loss[di], train_r[di], train_r2[di])
+        if self.accumulate_steps == 1:
+          self.optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        else:
+          for tv, g in zip(model.trainable_variables, gradients):
+            accum_gradients[variable_index[tv.ref()]].assign_add(g / self.accumulate_steps)
+      return branch
+
+    def train_step(x, y, di):
+      branches = [make_branch(mi, x, y) for mi in range(len(models))]
+      tf.switch_case(di, branches)
+
+    tf_function = self.make_tf_function()
+    train_step = tf_function(train_step)
+
+    if self.accumulate_steps == 1:
+      return train_step
+
+    def apply_step():
+      self.optimizer.apply_gradients(zip(accum_gradients, variables))
+      for ag in accum_gradients:
+        ag.assign(tf.zeros_like(ag))
+
+    apply_step = tf_function(apply_step)
+    micro_steps = [0]
+
+    def train_step_accum(x, y, di):
+      train_step(x, y, di)
+      micro_steps[0] += 1
+      if micro_steps[0] % self.accumulate_steps == 0:
+        apply_step()
+
+    return train_step_accum
+
+  def compute_gradients(self, model, x, y, train_loss, train_r, train_r2=None):
+    """Compute unscaled gradients of the loss on (x, y) for model's
+       trainable variables, updating the train metrics."""
+    with tf.GradientTape() as tape:
+      pred = model(x, training=tf.constant(True))
+      loss = self.loss_fn(y, pred) + sum(model.losses)
+      if self.loss_scale:
+        scaled_loss = self.optimizer.get_scaled_loss(loss)
+    train_loss(loss)
+    train_r(y, pred)
+    if train_r2 is not None:
+      train_r2(y, pred)
+    if self.loss_scale:
+      gradients = tape.gradient(scaled_loss, model.trainable_variables)
+      gradients = self.optimizer.get_unscaled_gradients(gradients)
+    else:
+      gradients = tape.gradient(loss, model.trainable_variables)
+    return gradients
+
+  def make_tf_function(self):
+    """Return tf.function, compiling with XLA if configured."""
+    if self.xla:
+      return lambda fn: tf.function(fn, jit_compile=True)
+    else:
+      return tf.function
+
+  def make_multi_dataset(self, models):
+    """Combine the train datasets into one prefetched pipeline of
+       (x, y, di) batches, choosing datasets in the per-epoch proportions
+       of dataset_indexes, reshuffled each epoch, with targets zero-padded
+       to the largest target length and count across models."""
+    target_length = max([model.output_shape[1] for model in models])
+    num_targets = max([model.output_shape[2] for model in models])
+
+    def make_tag_batch(di):
+      def tag_batch(x, y):
+        y_shape = tf.shape(y)
+        y_pad = [[0, 0],
+                 [0, target_length - y_shape[1]],
+                 [0, num_targets - y_shape[2]]]
+        y = tf.pad(y, y_pad)
+        y = tf.ensure_shape(y, [None, target_length, num_targets])
+        return x, y, tf.constant(di, dtype=tf.int32)
+      return tag_batch
+
+    datasets = []
+    for di, td in enumerate(self.train_data):
+      datasets.append(td.dataset.map(make_tag_batch(di)))
+
+    choices = tf.data.Dataset.from_tensor_slices(self.dataset_indexes.astype('int64'))
+    choices = choices.shuffle(len(self.dataset_indexes), reshuffle_each_iteration=True)
+    choices = choices.repeat()
+
+    dataset = tf.data.Dataset.choose_from_datasets(datasets, choices)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset
+
   def make_optimizer(self):
-    # schedule (currently OFF)
+    # schedule, in optimizer steps of accumulate_steps batches
     initial_learning_rate = self.params.get('learning_rate', 0.01)
-    if False:
-      lr_schedule = keras.optimizers.schedules.ExponentialDecay(
+    if 'decay_steps' in self.params:
+      lr_schedule = tf.keras.optimizers.schedules.ExponentialDecay(
         initial_learning_rate,
-        decay_steps=self.params.get('decay_steps', 100000),
+        decay_steps=self.params['decay_steps'],
         decay_rate=self.params.get('decay_rate', 0.96),
         staircase=True)
     else:
       lr_schedule = initial_learning_rate
 
+    warmup_steps = self.params.get('warmup_steps', 0)
+    if warmup_steps > 0:
+      lr_schedule = WarmUp(initial_learning_rate, warmup_steps, lr_schedule)
+
     if version.parse(tf.__version__) < version.parse('2.2'):
       clip_norm_default = 1000000
     else:
@@ -317,14 +466,14 @@ class Trainer:
     optimizer_type = self.params.get('optimizer', 'sgd').lower()
     if optimizer_type == 'adam':
       self.optimizer = tf.keras.optimizers.Adam(
-          lr=lr_schedule,
+          learning_rate=lr_schedule,
           beta_1=self.params.get('adam_beta1',0.9),
           beta_2=self.params.get('adam_beta2',0.999),
           clipnorm=clip_norm)
 
     elif optimizer_type in ['sgd', 'momentum']:
       self.optimizer = tf.keras.optimizers.SGD(
-          lr=lr_schedule,
+          learning_rate=lr_schedule,
           momentum=self.params.get('momentum', 0.99),
           clipnorm=clip_norm)
 
@@ -332,6 +481,36 @@ class Trainer:
       print('Cannot recognize optimization algorithm %s' % optimizer_type)
       exit(1)
 
+    # scale loss to keep float16 gradients in range
+    if self.params.get('precision', 'float32') == 'mixed_float16':
+      self.optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self.optimizer)
+
+class WarmUp(tf.keras.optimizers.schedules.LearningRateSchedule):
+  """Linearly increase the learning rate to initial_learning_rate over
+     warmup_steps, then follow the wrapped schedule or constant from
+     the end of warmup."""
+  def __init__(self, initial_learning_rate, warmup_steps, decay_schedule):
+    super(WarmUp, self).__init__()
+    self.initial_learning_rate = initial_learning_rate
+    self.warmup_steps = warmup_steps
+    self.decay_schedule = decay_schedule
+
+  def __call__(self, step):
+    step = tf.cast(step, tf.float32)
+    warmup_lr = self.initial_learning_rate * (step + 1) / self.warmup_steps
+    if callable(self.decay_schedule):
+      decay_lr = self.decay_schedule(step - self.warmup_steps)
+    else:
+      decay_lr = tf.constant(self.decay_schedule, dtype=tf.float32)
+    return tf.where(step < self.warmup_steps, warmup_lr, decay_lr)
+
+  def get_config(self):
+    return {
+      'initial_learning_rate': self.initial_learning_rate,
+      'warmup_steps': self.warmup_steps,
+      'decay_schedule': self.decay_schedule
+    }
+
 class EarlyStoppingMin(tf.keras.callbacks.EarlyStopping):
   """Stop training when a monitored quantity has stopped improving.
   Arguments:
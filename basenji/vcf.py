@@ -14,23 +14,29 @@
 # =========================================================================
 
 from __future__ import print_function
+import csv
 import gzip
+import io
 import os
 import pdb
 import subprocess
 import sys
-import tempfile
 
 import numpy as np
 import pandas as pd
 import pysam
 
 import basenji.dna_io
+from basenji import genome
+from basenji import intervals
 """vcf.py
 
 Methods and classes to support .vcf SNP analysis.
 """
 
+# bytes of VCF lines to parse at once
+VCF_CHUNK_BYTES = 2**26
+
 
 def cap_allele(allele, cap=5):
   """ Cap the length of an allele in the figures """
@@ -50,63 +56,15 @@ def intersect_seqs_snps(vcf_file, gene_seqs, vision_p=1):
     Out
      seqs_snps: list of list mapping segment indexes to overlapping SNP indexes
     """
+  seq_chroms = [gs.chrom for gs in gene_seqs]
+  seq_starts = [gs.start for gs in gene_seqs]
+  seq_ends = [gs.end for gs in gene_seqs]
+  seq_pairs, snp_pairs, _ = intersect_vcf_intervals(vcf_file,
+      seq_chroms, seq_starts, seq_ends, vision_p)
 
-  # print segments to BED
-  # hash segments to indexes
-  seq_temp = tempfile.NamedTemporaryFile()
-  seq_bed_file = seq_temp.name
-  seq_bed_out = open(seq_bed_file, 'w')
-  seq_indexes = {}
-  for si in range(len(gene_seqs)):
-    gs = gene_seqs[si]
-    gene_seq_key = (gs.chrom, gs.start)
-    seq_indexes[gene_seq_key] = si
-    print('%s\t%d\t%d' % (gs.chrom, gs.start, gs.end), file=seq_bed_out)
-  seq_bed_out.close()
-
-  # hash SNPs to indexes
-  snp_indexes = {}
-  si = 0
-
-  vcf_in = open(vcf_file)
-  line = vcf_in.readline()
-  while line[0] == '#':
-    line = vcf_in.readline()
-  while line:
-    a = line.split()
-    snp_id = a[2]
-    if snp_id in snp_indexes:
-      raise Exception('Duplicate SNP id %s will break the script' % snp_id)
-    snp_indexes[snp_id] = si
-    si += 1
-    line = vcf_in.readline()
-  vcf_in.close()
-
-  # initialize list of lists
-  seqs_snps = []
-  for _ in range(len(gene_seqs)):
-    seqs_snps.append([])
-
-  # intersect
-  p = subprocess.Popen(
-      'bedtools intersect -wo -a %s -b %s' % (vcf_file, seq_bed_file),
-      shell=True,
-      stdout=subprocess.PIPE)
-  for line in p.stdout:
-    line = line.decode('UTF-8')
-    a = line.split()
-    pos = int(a[1])
-    snp_id = a[2]
-    seq_chrom = a[-4]
-    seq_start = int(a[-3])
-    seq_end = int(a[-2])
-    seq_key = (seq_chrom, seq_start)
-
-    vision_buffer = (seq_end - seq_start) * (1 - vision_p) // 2
-    if seq_start + vision_buffer < pos < seq_end - vision_buffer:
-      seqs_snps[seq_indexes[seq_key]].append(snp_indexes[snp_id])
-
-  p.communicate()
+  # order by sequence
+  seq_pairs, snp_pairs = intervals.sort_pairs(seq_pairs, snp_pairs)
+  seqs_snps = intervals.group_pairs(seq_pairs, snp_pairs, len(gene_seqs))
 
   return seqs_snps
 
@@ -122,64 +80,77 @@ def intersect_snps_seqs(vcf_file, seq_coords, vision_p=1):
     Out
      snp_segs: list of list mapping SNP indexes to overlapping sequence indexes
     """
-  # print segments to BED
-  # hash segments to indexes
-  seg_temp = tempfile.NamedTemporaryFile()
-  seg_bed_file = seg_temp.name
-  seg_bed_out = open(seg_bed_file, 'w')
-  segment_indexes = {}
+  seq_chroms = [sc[0] for sc in seq_coords]
+  seq_starts = [sc[1] for sc in seq_coords]
+  seq_ends = [sc[2] for sc in seq_coords]
+  seq_pairs, snp_pairs, num_snps = intersect_vcf_intervals(vcf_file,
+      seq_chroms, seq_starts, seq_ends, vision_p)
 
-  for si in range(len(seq_coords)):
-    segment_indexes[seq_coords[si]] = si
-    print('%s\t%d\t%d' % seq_coords[si], file=seg_bed_out)
+  # order by SNP
+  snp_pairs, seq_pairs = intervals.sort_pairs(snp_pairs, seq_pairs)
+  snp_segs = intervals.group_pairs(snp_pairs, seq_pairs, num_snps)
 
-  seg_bed_out.close()
+  return snp_segs
 
-  # hash SNPs to indexes
-  snp_indexes = {}
-  si = 0
 
-  vcf_in = open(vcf_file)
-  line = vcf_in.readline()
-  while line[0] == '#':
-    line = vcf_in.readline()
-  while line:
+def intersect_vcf_intervals(vcf_file, seq_chroms, seq_starts, seq_ends,
+                            vision_p=1):
+  """ Intersect a VCF file with sequence intervals, keeping SNPs strictly
+      inside the visible center vision_p proportion of each sequence.
+
+    In
+     vcf_file:
+     seq_chroms, seq_starts, seq_ends: sequence coordinates
+     vision_p: proportion of sequences visible to center genes.
+
+    Out
+     seq_pairs: sequence indexes of overlapping pairs
+     snp_pairs: SNP indexes, in VCF order, of overlapping pairs
+     num_snps: number of VCF SNPs
+    """
+  seq_starts = np.array(seq_starts, dtype='int64')
+  seq_ends = np.array(seq_ends, dtype='int64')
+
+  # read SNP positions
+  snp_ids = set()
+  snp_chroms = []
+  snp_pos = []
+  snp_ref_lens = []
+  if vcf_file.endswith('.gz'):
+    vcf_in = gzip.open(vcf_file, 'rt')
+  else:
+    vcf_in = open(vcf_file)
+  for line in vcf_in:
+    if line[0] == '#':
+      continue
     a = line.split()
     snp_id = a[2]
-    if snp_id in snp_indexes:
+    if snp_id in snp_ids:
       raise Exception('Duplicate SNP id %s will break the script' % snp_id)
-    snp_indexes[snp_id] = si
-    si += 1
-    line = vcf_in.readline()
+    snp_ids.add(snp_id)
+    snp_chroms.append(a[0])
+    snp_pos.append(int(a[1]))
+    snp_ref_lens.append(len(a[3]))
   vcf_in.close()
+  snp_pos = np.array(snp_pos, dtype='int64')
+  snp_ref_lens = np.array(snp_ref_lens, dtype='int64')
 
-  # initialize list of lists
-  snp_segs = []
-  for i in range(len(snp_indexes)):
-    snp_segs.append([])
-
-  # intersect
-  p = subprocess.Popen(
-      'bedtools intersect -wo -a %s -b %s' % (vcf_file, seg_bed_file),
-      shell=True,
-      stdout=subprocess.PIPE)
-  for line in p.stdout:
-    line = line.decode('UTF-8')
-    a = line.split()
-    pos = int(a[1])
-    snp_id = a[2]
-    seg_chrom = a[-4]
-    seg_start = int(a[-3])
-    seg_end = int(a[-2])
-    seg_key = (seg_chrom, seg_start, seg_end)
+  # intersect reference alleles with sequences
+  seq_index = intervals.IntervalIndex(seq_chroms, seq_starts, seq_ends)
+  snp_pairs, seq_pairs = seq_index.overlap_pairs(snp_chroms,
+      snp_pos - 1, snp_pos - 1 + snp_ref_lens)
 
-    vision_buffer = (seg_end - seg_start) * (1 - vision_p) // 2
-    if seg_start + vision_buffer < pos < seg_end - vision_buffer:
-      snp_segs[snp_indexes[snp_id]].append(segment_indexes[seg_key])
+  # filter to visible positions
+  pair_starts = seq_starts[seq_pairs]
+  pair_ends = seq_ends[seq_pairs]
+  vision_buffer = (pair_ends - pair_starts) * (1 - vision_p) // 2
+  pair_pos = snp_pos[snp_pairs]
+  visible = (pair_starts + vision_buffer < pair_pos)
+  visible &= (pair_pos < pair_ends - vision_buffer)
+  seq_pairs = seq_pairs[visible]
+  snp_pairs = snp_pairs[visible]
 
-  p.communicate()
-
-  return snp_segs
+  return seq_pairs, snp_pairs, len(snp_pos)
 
 
 def snp_seq1(snp, seq_len, genome_open):
@@ -188,7 +159,7 @@ def snp_seq1(snp, seq_len, genome_open):
     Attrs:
         snp [SNP] :
         seq_len (int) : sequence length to code
-        genome_open (File) : open genome FASTA file
+        genome_open (File) : open genome FASTA file or GenomeCache
 
     Return:
         seq_vecs_list [array] : list of one hot coded sequences surrounding the
@@ -205,15 +176,8 @@ def snp_seq1(snp, seq_len, genome_open):
   seq_end = snp.pos + right_len + max(0,
                                       len(snp.ref_allele) - snp.longest_alt())
 
-  # extract sequence as BED style
-  if seq_start < 0:
-    seq = 'N'*(1-seq_start) + genome_open.fetch(snp.chr, 0, seq_end).upper()
-  else:
-    seq = genome_open.fetch(snp.chr, seq_start - 1, seq_end).upper()
-
-  # extend to full length
-  if len(seq) < seq_end - seq_start:
-    seq += 'N' * (seq_end - seq_start - len(seq))
+  # extract sequence as BED style, padded with N's
+  seq = genome.fetch_dna(genome_open, snp.chr, seq_start - 1, seq_end)
 
   # verify that ref allele matches ref sequence
   seq_ref = seq[left_len:left_len + len(snp.ref_allele)]
@@ -290,7 +254,7 @@ def snps_seq1(snps, seq_len, genome_fasta, return_seqs=False):
   seq_headers = []
 
   # open genome FASTA
-  genome_open = pysam.Fastafile(genome_fasta)
+  genome_open = genome.open_fasta(genome_fasta)
 
   for snp in snps:
     # specify positions in GFF-style 1-based
@@ -298,16 +262,8 @@ def snps_seq1(snps, seq_len, genome_fasta, return_seqs=False):
     seq_end = snp.pos + right_len + max(0,
                                         len(snp.ref_allele) - snp.longest_alt())
 
-    # extract sequence as BED style
-    if seq_start < 0:
-      seq = 'N' * (-seq_start) + genome_open.fetch(snp.chr, 0,
-                                                   seq_end).upper()
-    else:
-      seq = genome_open.fetch(snp.chr, seq_start - 1, seq_end).upper()
-
-    # extend to full length
-    if len(seq) < seq_end - seq_start:
-      seq += 'N' * (seq_end - seq_start - len(seq))
+    # extract sequence as BED style, padded with N's
+    seq = genome.fetch_dna(genome_open, snp.chr, seq_start - 1, seq_end)
 
     # verify that ref allele matches ref sequence
     seq_ref = seq[left_len:left_len + len(snp.ref_allele)]
@@ -509,103 +465,120 @@ def dna_length_1hot(seq, length):
 
 def vcf_count(vcf_file):
   """ Count SNPs in a VCF file """
-  if vcf_file[-3:] == '.gz':
-    vcf_in = gzip.open(vcf_file, 'rt')
-  else:
-    vcf_in = open(vcf_file)
-
-  # read through header
-  line = vcf_in.readline()
-  while line[0] == '#':
-    line = vcf_in.readline()
+  vcf_in = vcf_open(vcf_file)
+  vcf_header_bytes(vcf_in)
 
-  # count SNPs
+  # count newlines in chunks
   num_snps = 0
-  while line:
+  last_byte = b'\n'
+  chunk = vcf_in.read(VCF_CHUNK_BYTES)
+  while chunk:
+    num_snps += chunk.count(b'\n')
+    last_byte = chunk[-1:]
+    chunk = vcf_in.read(VCF_CHUNK_BYTES)
+  if last_byte != b'\n':
     num_snps += 1
-    line = vcf_in.readline()
 
   vcf_in.close()
 
   return num_snps
 
 def vcf_snps(vcf_file, require_sorted=False, validate_ref_fasta=None,
-             flip_ref=False, pos2=False, start_i=None, end_i=None):
-  """ Load SNPs from a VCF file """
-  if vcf_file[-3:] == '.gz':
-    vcf_in = gzip.open(vcf_file, 'rt')
-  else:
-    vcf_in = open(vcf_file)
+             flip_ref=False, pos2=False, start_i=None, end_i=None,
+             part_i=None, num_parts=None):
+  """ Load SNPs from a VCF file
+
+    Args:
+      start_i, end_i: load SNPs with VCF indexes in [start_i, end_i).
+      part_i, num_parts: load part part_i of num_parts contiguous parts,
+                         split by byte offsets for uncompressed VCFs.
+    Returns:
+      snps: list of SNP's
+    """
+  snp_arrays = vcf_arrays(vcf_file, require_sorted, validate_ref_fasta,
+                          flip_ref, pos2, start_i, end_i, part_i, num_parts)
+  return snp_arrays.snps()
+
+
+def vcf_arrays(vcf_file, require_sorted=False, validate_ref_fasta=None,
+               flip_ref=False, pos2=False, start_i=None, end_i=None,
+               part_i=None, num_parts=None, chunk_bytes=None):
+  """ Load SNPs from a VCF file into SNPArrays, parsing chunks of lines
+      with the pandas C reader. Arguments match vcf_snps. """
+  if chunk_bytes is None:
+    chunk_bytes = VCF_CHUNK_BYTES
+  vcf_in = vcf_open(vcf_file)
+  header_end = vcf_header_bytes(vcf_in)
+
+  # determine byte range
+  start_byte, end_byte = header_end, None
+  if part_i is not None:
+    if vcf_file[-3:] == '.gz':
+      # compressed offsets can't be split; split SNP indexes
+      part_bounds = np.linspace(0, vcf_count(vcf_file), num_parts+1, dtype='int')
+      start_i, end_i = part_bounds[part_i], part_bounds[part_i+1]
+    else:
+      vcf_size = os.path.getsize(vcf_file)
+      part_bounds = np.linspace(header_end, vcf_size, num_parts+1, dtype='int64')
+      start_byte, end_byte = part_bounds[part_i], part_bounds[part_i+1]
+
+  # align to the first line starting in range
+  if start_byte > header_end:
+    vcf_in.seek(start_byte - 1)
+    if vcf_in.read(1) != b'\n':
+      vcf_in.readline()
+    start_byte = vcf_in.tell()
+
+  # parse chunks
+  snp_arrays = SNPArrays(pos2)
+  read_byte = start_byte
+  while end_byte is None or read_byte < end_byte:
+    if end_byte is None:
+      chunk = vcf_in.read(chunk_bytes)
+    else:
+      chunk = vcf_in.read(min(chunk_bytes, end_byte - read_byte))
+    if not chunk:
+      break
+    read_byte += len(chunk)
+    if not chunk.endswith(b'\n'):
+      chunk += vcf_in.readline()
+      read_byte = vcf_in.tell()
+    snp_arrays.add_chunk(chunk)
+  vcf_in.close()
 
-  # read through header
-  line = vcf_in.readline()
-  while line[0] == '#':
-    line = vcf_in.readline()
+  snp_arrays.finalize()
+
+  # filter SNP indexes
+  if start_i is not None:
+    snp_arrays = snp_arrays.subset(start_i, end_i)
 
-  # to check sorted
   if require_sorted:
-    seen_chrs = set()
-    prev_chr = None
-    prev_pos = -1
+    snp_arrays.check_sorted()
 
-  # to check reference
   if validate_ref_fasta is not None:
-    genome_open = pysam.Fastafile(validate_ref_fasta)
-
-  # read in SNPs
-  snps = []
-  si = 0
-  while line:
-    if start_i is None or start_i <= si < end_i:
-      snps.append(SNP(line, pos2))
-
-      if require_sorted:
-        if prev_chr is not None:
-          # same chromosome
-          if prev_chr == snps[-1].chr:
-            if snps[-1].pos < prev_pos:
-              print('Sorted VCF required. Mis-ordered position: %s' % line.rstrip(),
-                    file=sys.stderr)
-              exit(1)
-          elif snps[-1].chr in seen_chrs:
-            print('Sorted VCF required. Mis-ordered chromosome: %s' % line.rstrip(),
-                   file=sys.stderr)
-            exit(1)
-
-        seen_chrs.add(snps[-1].chr)
-        prev_chr = snps[-1].chr
-        prev_pos = snps[-1].pos
-
-      if validate_ref_fasta is not None:
-        ref_n = len(snps[-1].ref_allele)
-        snp_pos = snps[-1].pos-1
-        ref_snp = genome_open.fetch(snps[-1].chr, snp_pos, snp_pos+ref_n)
-        if snps[-1].ref_allele != ref_snp:
-          if not flip_ref:
-            # bail
-            print('ERROR: %s does not match reference %s' % (snps[-1], ref_snp), file=sys.stderr)
-            exit(1)
+    snp_arrays.validate_ref(validate_ref_fasta, flip_ref)
 
-          else:
-            alt_n = len(snps[-1].alt_alleles[0])
-            ref_snp = genome_open.fetch(snps[-1].chr, snp_pos, snp_pos+alt_n)
-
-            # if alt matches fasta reference
-            if snps[-1].alt_alleles[0] == ref_snp:
-              # flip alleles
-              snps[-1].flip_alleles()
+  return snp_arrays
 
-            else:
-              # bail
-              print('ERROR: %s does not match reference %s' % (snps[-1], ref_snp), file=sys.stderr)
-              exit(1)
 
-    si += 1
+def vcf_header_bytes(vcf_in):
+  """ Advance an open binary VCF past its header, returning the
+      byte offset of the first SNP line. """
+  header_end = vcf_in.tell()
+  line = vcf_in.readline()
+  while line[:1] == b'#':
+    header_end = vcf_in.tell()
     line = vcf_in.readline()
+  vcf_in.seek(header_end)
+  return header_end
 
-  vcf_in.close()
 
-  return snps
+def vcf_open(vcf_file):
+  """ Open a VCF file for binary reading. """
+  if vcf_file[-3:] == '.gz':
+    return gzip.open(vcf_file, 'rb')
+  else:
+    return open(vcf_file, 'rb')
 
 
 def vcf_sort(vcf_file):
@@ -625,40 +598,254 @@ def vcf_sort(vcf_file):
   os.remove('%s.tmp' % vcf_file)
 
 
+class SNPArrays:
+  """ SNPArrays
+
+    Represent SNPs read in from a VCF file as arrays, with strings
+    in one pool indexed by offsets.
+
+    Attributes:
+        chrs (str array) : chromosome names, indexed by chr_codes
+        chr_codes (int array) : SNP chromosome codes
+        pos (int array) : SNP positions
+        pos2 (int array) : SNP second positions, or None
+        strings (str) : pool of SNP ids and alleles
+        rsid_offsets (Nx2 int array) : SNP id [start, end) in strings
+        ref_offsets (Nx2 int array) : reference allele [start, end) in strings
+        alt_offsets (Nx2 int array) : comma-separated alt alleles [start, end)
+        flipped (bool array) : reference and first alt allele flipped
+    """
+
+  def __init__(self, pos2=False):
+    self.has_pos2 = pos2
+    self.chr_index = {}
+    self.chunks = []
+
+  def add_chunk(self, chunk):
+    """ Parse a chunk of complete VCF lines. """
+    if not chunk.strip():
+      return
+    num_cols = 6 if self.has_pos2 else 5
+    df = pd.read_csv(io.BytesIO(chunk), sep='\t', header=None,
+                     usecols=range(num_cols), dtype=str, na_filter=False,
+                     quoting=csv.QUOTE_NONE)
+
+    # code chromosomes
+    chunk_codes, chunk_chrs = pd.factorize(df[0].values)
+    chr_codes = []
+    for chrm in chunk_chrs:
+      if not chrm.startswith('chr'):
+        chrm = 'chr%s' % chrm
+      chr_codes.append(self.chr_index.setdefault(chrm, len(self.chr_index)))
+    chr_codes = np.array(chr_codes, dtype='int32')[chunk_codes]
+
+    pos = df[1].values.astype('int64')
+    pos2 = df[5].values.astype('int64') if self.has_pos2 else None
+
+    # pool strings
+    fields = np.stack([df[2].values, df[3].values, df[4].values], axis=1)
+    fields = fields.reshape(-1).tolist()
+    field_lens = np.fromiter(map(len, fields), dtype='int64', count=len(fields))
+    field_lens = field_lens.reshape(-1, 3)
+    strings = ''.join(fields)
+
+    self.chunks.append((chr_codes, pos, pos2, strings, field_lens))
+
+  def finalize(self):
+    """ Concatenate parsed chunks. """
+    self.chr_names = list(self.chr_index.keys())
+    self.chrs = np.array(self.chr_names, dtype='str')
+
+    if len(self.chunks) == 0:
+      self.chr_codes = np.zeros(0, dtype='int32')
+      self.pos = np.zeros(0, dtype='int64')
+      self.pos2 = np.zeros(0, dtype='int64') if self.has_pos2 else None
+      self.strings = ''
+      self.rsid_offsets = np.zeros((0,2), dtype='int64')
+      self.ref_offsets = np.zeros((0,2), dtype='int64')
+      self.alt_offsets = np.zeros((0,2), dtype='int64')
+    else:
+      self.chr_codes = np.concatenate([c[0] for c in self.chunks])
+      self.pos = np.concatenate([c[1] for c in self.chunks])
+      if self.has_pos2:
+        self.pos2 = np.concatenate([c[2] for c in self.chunks])
+      else:
+        self.pos2 = None
+      self.strings = ''.join([c[3] for c in self.chunks])
+
+      # string offsets
+      field_lens = np.concatenate([c[4] for c in self.chunks])
+      field_ends = np.cumsum(field_lens.reshape(-1)).reshape(field_lens.shape)
+      field_starts = field_ends - field_lens
+      self.rsid_offsets = np.stack([field_starts[:,0], field_ends[:,0]], axis=1)
+      self.ref_offsets = np.stack([field_starts[:,1], field_ends[:,1]], axis=1)
+      self.alt_offsets = np.stack([field_starts[:,2], field_ends[:,2]], axis=1)
+
+    self.flipped = np.zeros(len(self.pos), dtype='bool')
+    self.chunks = []
+
+  def __len__(self):
+    return len(self.pos)
+
+  def subset(self, start_i, end_i):
+    """ Return SNPArrays for SNP indexes [start_i, end_i), sharing strings. """
+    sub = SNPArrays(self.has_pos2)
+    sub.chr_index = self.chr_index
+    sub.chr_names = self.chr_names
+    sub.chrs = self.chrs
+    sub.strings = self.strings
+    for attr in ['chr_codes', 'pos', 'pos2', 'rsid_offsets',
+                 'ref_offsets', 'alt_offsets', 'flipped']:
+      values = getattr(self, attr)
+      if values is not None:
+        values = values[start_i:end_i]
+      setattr(sub, attr, values)
+    return sub
+
+  def string(self, offsets, si):
+    """ Return the pooled string at row si of offsets. """
+    return self.strings[offsets.item(si,0):offsets.item(si,1)]
+
+  def check_sorted(self):
+    """ Exit if SNPs are not sorted by chromosome and position. """
+    chr_changes = np.flatnonzero(np.diff(self.chr_codes) != 0) + 1
+    run_chrs = self.chr_codes[np.concatenate([[0], chr_changes])]
+    run_seen = np.zeros(len(self.chrs), dtype='bool')
+    for ri, run_chr in enumerate(run_chrs):
+      if run_seen[run_chr]:
+        snp_i = chr_changes[ri-1]
+        print('Sorted VCF required. Mis-ordered chromosome: %s' % self.snp(snp_i),
+              file=sys.stderr)
+        exit(1)
+      run_seen[run_chr] = True
+
+    pos_back = np.diff(self.pos) < 0
+    pos_back[chr_changes-1] = False
+    if pos_back.any():
+      snp_i = np.flatnonzero(pos_back)[0] + 1
+      print('Sorted VCF required. Mis-ordered position: %s' % self.snp(snp_i),
+            file=sys.stderr)
+      exit(1)
+
+  def validate_ref(self, fasta_file, flip_ref=False):
+    """ Exit if reference alleles don't match the FASTA, or flip
+        SNPs whose first alt allele matches, if flip_ref. Fetches
+        one sequence spanning each chromosome's SNPs. """
+    genome_open = pysam.Fastafile(fasta_file)
+    ref_starts = self.ref_offsets[:,0].tolist()
+    ref_ends = self.ref_offsets[:,1].tolist()
+    allele_lens = np.maximum(self.ref_offsets[:,1] - self.ref_offsets[:,0],
+                             self.alt_offsets[:,1] - self.alt_offsets[:,0])
+
+    for chr_code in np.unique(self.chr_codes):
+      chr_snps = np.flatnonzero(self.chr_codes == chr_code)
+      chrm = str(self.chrs[chr_code])
+
+      # fetch span, reaching the longest allele
+      chr_starts = self.pos[chr_snps] - 1
+      span_start = int(chr_starts.min())
+      span_end = int((chr_starts + allele_lens[chr_snps]).max())
+      span_seq = genome_open.fetch(chrm, span_start, span_end)
+
+      for si, snp_start in zip(chr_snps.tolist(), (chr_starts - span_start).tolist()):
+        ref_start, ref_end = ref_starts[si], ref_ends[si]
+        ref_snp = span_seq[snp_start:snp_start+ref_end-ref_start]
+        if self.strings[ref_start:ref_end] != ref_snp:
+          if not flip_ref:
+            # bail
+            print('ERROR: %s does not match reference %s' % (self.snp(si), ref_snp), file=sys.stderr)
+            exit(1)
+
+          else:
+            alt_alleles = self.string(self.alt_offsets, si).split(',')
+            ref_snp = span_seq[snp_start:snp_start+len(alt_alleles[0])]
+
+            # if alt matches fasta reference
+            if alt_alleles[0] == ref_snp:
+              # flip alleles
+              self.flip_alleles(si)
+
+            else:
+              # bail
+              print('ERROR: %s does not match reference %s' % (self.snp(si), ref_snp), file=sys.stderr)
+              exit(1)
+
+    genome_open.close()
+
+  def flip_alleles(self, si):
+    """ Flip reference and first alt allele of SNP si. """
+    assert(',' not in self.string(self.alt_offsets, si))
+    ref_offsets = self.ref_offsets[si].copy()
+    self.ref_offsets[si] = self.alt_offsets[si]
+    self.alt_offsets[si] = ref_offsets
+    self.flipped[si] = True
+
+  def snp(self, si):
+    """ Return a SNP view of index si. """
+    snp = SNP.__new__(SNP)
+    snp.snp_arrays = self
+    snp.si = si
+    return snp
+
+  def snps(self):
+    """ Return a list of SNP views. """
+    return [self.snp(si) for si in range(len(self))]
+
+
 class SNP:
   """ SNP
 
-    Represent SNPs read in from a VCF file
+    Represent SNPs read in from a VCF file, as a view of row si
+    of SNPArrays.
 
     Attributes:
         vcf_line (str)
     """
+  __slots__ = ('snp_arrays', 'si', 'seq_pos')
 
   def __init__(self, vcf_line, pos2=False):
-    a = vcf_line.split()
-    if a[0].startswith('chr'):
-      self.chr = a[0]
+    self.snp_arrays = SNPArrays(pos2)
+    self.snp_arrays.add_chunk(vcf_line.encode('UTF-8'))
+    self.snp_arrays.finalize()
+    self.si = 0
+
+  @property
+  def chr(self):
+    return self.snp_arrays.chr_names[self.snp_arrays.chr_codes.item(self.si)]
+
+  @property
+  def pos(self):
+    return self.snp_arrays.pos.item(self.si)
+
+  @property
+  def pos2(self):
+    if self.snp_arrays.pos2 is None:
+      return None
     else:
-      self.chr = 'chr%s' % a[0]
-    self.pos = int(a[1])
-    self.rsid = a[2]
-    self.ref_allele = a[3]
-    self.alt_alleles = a[4].split(',')
-    # self.alt_allele = self.alt_alleles[0]
-    self.flipped = False
+      return self.snp_arrays.pos2.item(self.si)
+
+  @property
+  def rsid(self):
+    rsid = self.snp_arrays.string(self.snp_arrays.rsid_offsets, self.si)
+    if rsid == '.':
+      rsid = '%s:%d' % (self.chr, self.pos)
+    return rsid
+
+  @property
+  def ref_allele(self):
+    return self.snp_arrays.string(self.snp_arrays.ref_offsets, self.si)
 
-    if self.rsid == '.':
-      self.rsid = '%s:%d' % (self.chr, self.pos)
+  @property
+  def alt_alleles(self):
+    return self.snp_arrays.string(self.snp_arrays.alt_offsets, self.si).split(',')
 
-    self.pos2 = None
-    if pos2:
-      self.pos2 = int(a[5])
+  @property
+  def flipped(self):
+    return self.snp_arrays.flipped.item(self.si)
 
   def flip_alleles(self):
     """ Flip reference and first alt allele."""
-    assert(len(self.alt_alleles) == 1)
-    self.ref_allele, self.alt_alleles[0] = self.alt_alleles[0], self.ref_allele
-    self.flipped = True
+    self.snp_arrays.flip_alleles(self.si)
 
   def get_alleles(self):
     """ Return a list of all alleles """
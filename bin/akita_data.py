@@ -256,11 +256,6 @@ def main():
   ################################################################
   # mappability
   ################################################################
-  if (options.umap_bed is not None) or (options.umap_midpoints is not None):
-    if shutil.which('bedtools') is None:
-      print('Install Bedtools to annotate unmappable sites', file=sys.stderr)
-      exit(1)
-
   if options.umap_bed is not None:
     # annotate unmappable positions
     mseqs_unmap = annotate_unmap(mseqs, options.umap_bed,
@@ -28,7 +28,6 @@ import h5py
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-import pysam
 from skimage.measure import block_reduce
 import seaborn as sns
 sns.set(style='ticks', font_scale=1.3)
@@ -37,6 +36,8 @@ import tensorflow as tf
 if tf.__version__[0] == '1':
   tf.compat.v1.enable_eager_execution()
 
+from basenji import genome
+from basenji import sad5
 from basenji import seqnn
 from basenji import stream
 from basenji import vcf as bvcf
@@ -56,6 +57,15 @@ def main():
   parser.add_option('-f', dest='genome_fasta',
       default=None,
       help='Genome FASTA for sequences [Default: %default]')
+  parser.add_option('--h5_chunks', dest='h5_chunks',
+      default=None,
+      help='Comma-separated SNP and target chunk shape of stat datasets, eg 26,5000 [Default: %default]')
+  parser.add_option('--h5_comp', dest='h5_compression',
+      default=None,
+      help='Stat dataset compression: gzip, lzf, or blosc, which requires hdf5plugin [Default: %default]')
+  parser.add_option('--h5_t', dest='h5_transpose',
+      default=False, action='store_true',
+      help='Write a target-major copy of each stat, as <stat>_T, for fast single-target reads [Default: %default]')
   parser.add_option('-l', dest='plot_lim_min',
       default=0.1, type='float',
       help='Heatmap plot limit [Default: %default]')
@@ -152,12 +162,8 @@ def main():
 
   # filter for worker SNPs
   if options.processes is not None:
-    # determine boundaries
-    num_snps = bvcf.vcf_count(vcf_file)
-    worker_bounds = np.linspace(0, num_snps, options.processes+1, dtype='int')
-
-    # read SNPs form VCF
-    snps = bvcf.vcf_snps(vcf_file, start_i=worker_bounds[worker_index], end_i=worker_bounds[worker_index+1])
+    # read worker's part of SNPs from VCF
+    snps = bvcf.vcf_snps(vcf_file, part_i=worker_index, num_parts=options.processes)
 
   else:
     # read SNPs form VCF
@@ -165,8 +171,8 @@ def main():
 
   num_snps = len(snps)
 
-  # open genome FASTA
-  genome_open = pysam.Fastafile(options.genome_fasta)
+  # open genome FASTA, or its cache
+  genome_open = genome.open_fasta(options.genome_fasta)
 
   def snp_gen():
     for snp in snps:
@@ -179,8 +185,12 @@ def main():
   #################################################################
   # setup output
 
+  h5_chunks = options.h5_chunks
+  if h5_chunks is not None:
+    h5_chunks = [int(hc) for hc in h5_chunks.split(',')]
   scd_out = initialize_output_h5(options.out_dir, options.scd_stats,
-                                 snps, target_ids, target_labels)
+                                 snps, target_ids, target_labels,
+                                 h5_chunks, options.h5_compression)
 
   #################################################################
   # predict SNP scores, write output
@@ -193,6 +203,10 @@ def main():
   # predictions index
   pi = 0
 
+  # hold the stat datasets open, so their chunk caches persist between
+  #  SNPs and each chunk is compressed once
+  scd_datasets = [scd_out[scd_stat] for scd_stat in options.scd_stats]
+
   for si in range(num_snps):
     # get predictions
     ref_preds = preds_stream[pi]
@@ -204,17 +218,27 @@ def main():
     write_snp(ref_preds, alt_preds, scd_out, si, options.scd_stats,
               plot_dir, seqnn_model.diagonal_offset, options.plot_lim_min)
 
-  genome_open.close()  
+  genome_open.close()
+
+  # write target-major copies, or leave them to multi collection
+  if options.h5_transpose and options.processes is None:
+    for scd_stat in options.scd_stats:
+      sad5.write_stat_transpose(scd_out, scd_stat)
+
   scd_out.close()
 
 
-def initialize_output_h5(out_dir, scd_stats, snps, target_ids, target_labels):
-  """Initialize an output HDF5 file for SCD stats."""
+def initialize_output_h5(out_dir, scd_stats, snps, target_ids, target_labels,
+                         chunks=None, compression=None):
+  """Initialize an output HDF5 file for SCD stats, stored contiguously
+     or with the given chunk shape and compression."""
 
   num_targets = len(target_ids)
   num_snps = len(snps)
 
-  scd_out = h5py.File('%s/scd.h5' % out_dir, 'w')
+  stat_opts = sad5.stat_h5_opts((num_snps, num_targets), chunks, compression)
+  scd_out = h5py.File('%s/scd.h5' % out_dir, 'w',
+                      **sad5.stat_h5_cache(stat_opts['shape'], stat_opts.get('chunks')))
 
   # write SNPs
   snp_ids = np.array([snp.rsid for snp in snps], 'S')
@@ -247,10 +271,7 @@ def initialize_output_h5(out_dir, scd_stats, snps, target_ids, target_labels):
 
   # initialize scd stats
   for scd_stat in scd_stats:
-    scd_out.create_dataset(scd_stat,
-        shape=(num_snps, num_targets),
-        dtype='float16',
-        compression=None)
+    scd_out.create_dataset(scd_stat, **stat_opts)
 
   return scd_out
 
@@ -22,11 +22,10 @@ import shutil
 import subprocess
 import sys
 
-import h5py
-import numpy as np
-
 import slurm
 
+from basenji_sad_multi import collect_h5
+
 """
 akita_scd_multi.py
 
@@ -45,6 +44,15 @@ def main():
   parser.add_option('-f', dest='genome_fasta',
       default='%s/data/hg19.fa' % os.environ['BASENJIDIR'],
       help='Genome FASTA for sequences [Default: %default]')
+  parser.add_option('--h5_chunks', dest='h5_chunks',
+      default=None,
+      help='Comma-separated SNP and target chunk shape of stat datasets, eg 26,5000 [Default: %default]')
+  parser.add_option('--h5_comp', dest='h5_compression',
+      default=None,
+      help='Stat dataset compression: gzip, lzf, or blosc, which requires hdf5plugin [Default: %default]')
+  parser.add_option('--h5_t', dest='h5_transpose',
+      default=False, action='store_true',
+      help='Write a target-major copy of each stat, as <stat>_T, for fast single-target reads [Default: %default]')
   parser.add_option('-m', dest='plot_map',
       default=False, action='store_true',
       help='Plot contact map for each allele [Default: %default]')
@@ -139,7 +147,8 @@ def main():
   #######################################################
   # collect output
 
-  collect_h5('scd.h5', options.out_dir, options.processes)
+  collect_h5('scd.h5', options.out_dir, options.processes,
+             transpose=options.h5_transpose)
 
   # for pi in range(options.processes):
   #     shutil.rmtree('%s/job%d' % (options.out_dir,pi))
@@ -154,73 +163,6 @@ def collect_table(file_name, out_dir, num_procs):
         shell=True)
 
 
-def collect_h5(file_name, out_dir, num_procs):
-  # count variants
-  num_variants = 0
-  for pi in range(num_procs):
-    # open job
-    job_h5_file = '%s/job%d/%s' % (out_dir, pi, file_name)
-    job_h5_open = h5py.File(job_h5_file, 'r')
-    num_variants += len(job_h5_open['snp'])
-    job_h5_open.close()
-
-  # initialize final h5
-  final_h5_file = '%s/%s' % (out_dir, file_name)
-  final_h5_open = h5py.File(final_h5_file, 'w')
-
-  # keep dict for string values
-  final_strings = {}
-
-  job0_h5_file = '%s/job0/%s' % (out_dir, file_name)
-  job0_h5_open = h5py.File(job0_h5_file, 'r')
-  for key in job0_h5_open.keys():
-    if key in ['target_ids', 'target_labels']:
-      # copy
-      final_h5_open.create_dataset(key, data=job0_h5_open[key])
-
-    elif job0_h5_open[key].dtype.char == 'S':
-        final_strings[key] = []
-
-    elif job0_h5_open[key].ndim == 1:
-      final_h5_open.create_dataset(key, shape=(num_variants,), dtype=job0_h5_open[key].dtype)
-
-    else:
-      num_targets = job0_h5_open[key].shape[1]
-      final_h5_open.create_dataset(key, shape=(num_variants, num_targets), dtype=job0_h5_open[key].dtype)
-
-  job0_h5_open.close()
-
-  # set values
-  vi = 0
-  for pi in range(num_procs):
-    # open job
-    job_h5_file = '%s/job%d/%s' % (out_dir, pi, file_name)
-    job_h5_open = h5py.File(job_h5_file, 'r')
-
-    # append to final
-    for key in job_h5_open.keys():
-      if key in ['target_ids', 'target_labels']:
-        # once is enough
-        pass
-
-      else:
-        if job_h5_open[key].dtype.char == 'S':
-          final_strings[key] += list(job_h5_open[key])
-        else:
-          job_variants = job_h5_open[key].shape[0]
-          final_h5_open[key][vi:vi+job_variants] = job_h5_open[key]
-
-    vi += job_variants
-    job_h5_open.close()
-
-  # create final string datasets
-  for key in final_strings:
-    final_h5_open.create_dataset(key,
-      data=np.array(final_strings[key], dtype='S'))
-
-  final_h5_open.close()
-
-
 def job_completed(options, pi):
   """Check whether a specific job has generated its
      output file."""
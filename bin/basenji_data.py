@@ -20,14 +20,13 @@ import collections
 import gzip
 import heapq
 import json
-import math
+import multiprocessing
 import pdb
 import os
 import random
 import shutil
 import subprocess
 import sys
-import tempfile
 import time
 
 import h5py
@@ -35,6 +34,7 @@ import numpy as np
 import pandas as pd
 
 from basenji import genome
+from basenji import intervals
 from basenji import util
 
 try:
@@ -68,6 +68,9 @@ def main():
       help='Generate cross fold split [Default: %default]')
   parser.add_option('-g', dest='gaps_file',
       help='Genome assembly gaps BED [Default: %default]')
+  parser.add_option('--genome_cache', dest='genome_cache',
+      default=False, action='store_true',
+      help='Build a memory-mapped cache of the genome FASTA, if not current, to fetch sequences from [Default: %default]')
   parser.add_option('-i', dest='interp_nan',
       default=False, action='store_true',
       help='Interpolate NaNs [Default: %default]') 
@@ -85,6 +88,9 @@ def main():
   parser.add_option('-p', dest='processes',
       default=None, type='int',
       help='Number parallel processes [Default: %default]')
+  parser.add_option('--pool', dest='pool',
+      default=False, action='store_true',
+      help='Read coverage and write TF Records in a local worker pool, skipping per-target HDF5 files [Default: %default]')
   parser.add_option('--peaks', dest='peaks_only',
       default=False, action='store_true',
       help='Create contigs only from peaks [Default: %default]') 
@@ -94,6 +100,9 @@ def main():
   parser.add_option('--restart', dest='restart',
       default=False, action='store_true',
       help='Skip already read HDF5 coverage values. [Default: %default]')
+  parser.add_option('--seq_index', dest='seq_index',
+      default=False, action='store_true',
+      help='Store sequences as uint8 nucleotide indexes rather than one hot coding [Default: %default]')
   parser.add_option('--seed', dest='seed',
       default=44, type='int',
       help='Random seed [Default: %default]')
@@ -292,10 +301,6 @@ def main():
   ################################################################
   if not options.restart:
     if options.umap_bed is not None:
-      if shutil.which('bedtools') is None:
-        print('Install Bedtools to annotate unmappable sites', file=sys.stderr)
-        exit(1)
-
       # annotate unmappable positions
       mseqs_unmap = annotate_unmap(mseqs, options.umap_bed, options.seq_length,
                                    options.pool_width, options.crop_bp)
@@ -339,65 +344,66 @@ def main():
   # read sequence coverage values
   ################################################################
   seqs_cov_dir = '%s/seqs_cov' % options.out_dir
-  if not os.path.isdir(seqs_cov_dir):
-    os.mkdir(seqs_cov_dir)
+  if not options.pool:
+    if not os.path.isdir(seqs_cov_dir):
+      os.mkdir(seqs_cov_dir)
 
-  read_jobs = []
+    read_jobs = []
 
-  for ti in range(targets_df.shape[0]):
-    genome_cov_file = targets_df['file'].iloc[ti]
-    seqs_cov_stem = '%s/%d' % (seqs_cov_dir, ti)
-    seqs_cov_file = '%s.h5' % seqs_cov_stem
-
-    clip_ti = None
-    if 'clip' in targets_df.columns:
-      clip_ti = targets_df['clip'].iloc[ti]
+    for ti in range(targets_df.shape[0]):
+      genome_cov_file = targets_df['file'].iloc[ti]
+      seqs_cov_stem = '%s/%d' % (seqs_cov_dir, ti)
+      seqs_cov_file = '%s.h5' % seqs_cov_stem
 
-    clipsoft_ti = None
-    if 'clip_soft' in targets_df.columns:
-      clipsoft_ti = targets_df['clip_soft'].iloc[ti]
+      clip_ti = None
+      if 'clip' in targets_df.columns:
+        clip_ti = targets_df['clip'].iloc[ti]
 
-    scale_ti = 1
-    if 'scale' in targets_df.columns:
-      scale_ti = targets_df['scale'].iloc[ti]
+      clipsoft_ti = None
+      if 'clip_soft' in targets_df.columns:
+        clipsoft_ti = targets_df['clip_soft'].iloc[ti]
 
-    if options.restart and os.path.isfile(seqs_cov_file):
-      print('Skipping existing %s' % seqs_cov_file, file=sys.stderr)
-    else:
-      cmd = 'basenji_data_read.py'
-      cmd += ' --crop %d' % options.crop_bp      
-      cmd += ' -w %d' % options.pool_width
-      cmd += ' -u %s' % targets_df['sum_stat'].iloc[ti]
-      if clip_ti is not None:
-        cmd += ' -c %f' % clip_ti
-      if clipsoft_ti is not None:
-        cmd += ' --clip_soft %f' % clipsoft_ti
-      cmd += ' -s %f' % scale_ti
-      if options.blacklist_bed:
-        cmd += ' -b %s' % options.blacklist_bed
-      if options.interp_nan:
-        cmd += ' -i'
-      cmd += ' %s' % genome_cov_file
-      cmd += ' %s' % seqs_bed_file
-      cmd += ' %s' % seqs_cov_file
+      scale_ti = 1
+      if 'scale' in targets_df.columns:
+        scale_ti = targets_df['scale'].iloc[ti]
 
-      if options.run_local:
-        # breaks on some OS
-        # cmd += ' &> %s.err' % seqs_cov_stem
-        read_jobs.append(cmd)
+      if options.restart and os.path.isfile(seqs_cov_file):
+        print('Skipping existing %s' % seqs_cov_file, file=sys.stderr)
       else:
-        j = slurm.Job(cmd,
-            name='read_t%d' % ti,
-            out_file='%s.out' % seqs_cov_stem,
-            err_file='%s.err' % seqs_cov_stem,
-            queue='standard', mem=15000, time='12:0:0')
-        read_jobs.append(j)
-
-  if options.run_local:
-    util.exec_par(read_jobs, options.processes, verbose=True)
-  else:
-    slurm.multi_run(read_jobs, options.processes, verbose=True,
-                    launch_sleep=1, update_sleep=5)
+        cmd = 'basenji_data_read.py'
+        cmd += ' --crop %d' % options.crop_bp      
+        cmd += ' -w %d' % options.pool_width
+        cmd += ' -u %s' % targets_df['sum_stat'].iloc[ti]
+        if clip_ti is not None:
+          cmd += ' -c %f' % clip_ti
+        if clipsoft_ti is not None:
+          cmd += ' --clip_soft %f' % clipsoft_ti
+        cmd += ' -s %f' % scale_ti
+        if options.blacklist_bed:
+          cmd += ' -b %s' % options.blacklist_bed
+        if options.interp_nan:
+          cmd += ' -i'
+        cmd += ' %s' % genome_cov_file
+        cmd += ' %s' % seqs_bed_file
+        cmd += ' %s' % seqs_cov_file
+
+        if options.run_local:
+          # breaks on some OS
+          # cmd += ' &> %s.err' % seqs_cov_stem
+          read_jobs.append(cmd)
+        else:
+          j = slurm.Job(cmd,
+              name='read_t%d' % ti,
+              out_file='%s.out' % seqs_cov_stem,
+              err_file='%s.err' % seqs_cov_stem,
+              queue='standard', mem=15000, time='12:0:0')
+          read_jobs.append(j)
+
+    if options.run_local:
+      util.exec_par(read_jobs, options.processes, verbose=True)
+    else:
+      slurm.multi_run(read_jobs, options.processes, verbose=True,
+                      launch_sleep=1, update_sleep=5)
 
   ################################################################
   # write TF Records
@@ -410,7 +416,8 @@ def main():
   if not os.path.isdir(tfr_dir):
     os.mkdir(tfr_dir)
 
-  write_jobs = []
+  # define TF Records shards
+  tfr_shards = []
 
   for fold_set in fold_labels:
     fold_set_indexes = [i for i in range(len(mseqs)) if mseqs[i].label == fold_set]
@@ -423,13 +430,35 @@ def main():
 
     while tfr_start <= fold_set_end:
       tfr_stem = '%s/%s-%d' % (tfr_dir, fold_set, tfr_i)
+      tfr_shards.append((tfr_stem, tfr_start, tfr_end))
+
+      # update
+      tfr_i += 1
+      tfr_start += options.seqs_per_tfr
+      tfr_end = min(tfr_start+options.seqs_per_tfr, fold_set_end)
+
+  # build the genome cache once, for writers to share
+  if options.genome_cache:
+    genome.GenomeCache.build(fasta_file)
 
+  if options.pool:
+    if options.umap_bed is None:
+      unmap_npy = None
+    pool_write_tfrs(tfr_shards, fasta_file, targets_df, mseqs,
+                    unmap_npy, options)
+
+  else:
+    write_jobs = []
+
+    for tfr_stem, tfr_start, tfr_end in tfr_shards:
       cmd = 'basenji_data_write.py'
       cmd += ' -s %d' % tfr_start
       cmd += ' -e %d' % tfr_end
       cmd += ' --umap_clip %f' % options.umap_clip
       if options.umap_tfr:
         cmd += ' --umap_tfr'
+      if options.seq_index:
+        cmd += ' --seq_index'
       if options.umap_bed is not None:
         cmd += ' -u %s' % unmap_npy
 
@@ -444,22 +473,17 @@ def main():
         write_jobs.append(cmd)
       else:
         j = slurm.Job(cmd,
-              name='write_%s-%d' % (fold_set, tfr_i),
+              name='write_%s' % os.path.split(tfr_stem)[1],
               out_file='%s.out' % tfr_stem,
               err_file='%s.err' % tfr_stem,
               queue='standard', mem=15000, time='12:0:0')
         write_jobs.append(j)
 
-      # update
-      tfr_i += 1
-      tfr_start += options.seqs_per_tfr
-      tfr_end = min(tfr_start+options.seqs_per_tfr, fold_set_end)
-
-  if options.run_local:
-    util.exec_par(write_jobs, options.processes, verbose=True)
-  else:
-    slurm.multi_run(write_jobs, options.processes, verbose=True,
-                    launch_sleep=1, update_sleep=5)
+    if options.run_local:
+      util.exec_par(write_jobs, options.processes, verbose=True)
+    else:
+      slurm.multi_run(write_jobs, options.processes, verbose=True,
+                      launch_sleep=1, update_sleep=5)
 
 
   ################################################################
@@ -470,6 +494,9 @@ def main():
   stats_dict['seq_length'] = options.seq_length
   stats_dict['pool_width'] = options.pool_width
   stats_dict['crop_bp'] = options.crop_bp
+  stats_dict['seqs_per_tfr'] = options.seqs_per_tfr
+  if options.seq_index:
+    stats_dict['seq_index'] = True
 
   target_length = options.seq_length - 2*options.crop_bp
   target_length = target_length // options.pool_width
@@ -483,7 +510,7 @@ def main():
 
 
 ################################################################################
-def annotate_unmap(mseqs, unmap_bed, seq_length, pool_width, crop_bp):
+def annotate_unmap(mseqs, unmap_bed, seq_length, pool_width, crop_bp=0):
   """ Intersect the sequence segments with unmappable regions
          and annoate the segments as NaN to possible be ignored.
 
@@ -498,57 +525,41 @@ def annotate_unmap(mseqs, unmap_bed, seq_length, pool_width, crop_bp):
       seqs_unmap: NxL binary NA indicators
     """
 
-  # print sequence segments to file
-  seqs_temp = tempfile.NamedTemporaryFile()
-  seqs_bed_file = seqs_temp.name
-  write_seqs_bed(seqs_bed_file, mseqs)
-
-  # hash segments to indexes
-  chr_start_indexes = {}
-  for i in range(len(mseqs)):
-    chr_start_indexes[(mseqs[i].chr, mseqs[i].start)] = i
-
   # initialize unmappable array
   pool_seq_length = seq_length // pool_width
   seqs_unmap = np.zeros((len(mseqs), pool_seq_length), dtype='bool')
 
   # intersect with unmappable regions
-  p = subprocess.Popen(
-      'bedtools intersect -wo -a %s -b %s' % (seqs_bed_file, unmap_bed),
-      shell=True, stdout=subprocess.PIPE)
-  for line in p.stdout:
-    line = line.decode('utf-8')
-    a = line.split()
-
-    seq_chrom = a[0]
-    seq_start = int(a[1])
-    seq_end = int(a[2])
-    seq_key = (seq_chrom, seq_start)
-
-    unmap_start = int(a[4])
-    unmap_end = int(a[5])
-
-    overlap_start = max(seq_start, unmap_start)
-    overlap_end = min(seq_end, unmap_end)
-
-    pool_seq_unmap_start = math.floor((overlap_start - seq_start) / pool_width)
-    pool_seq_unmap_end = math.ceil((overlap_end - seq_start) / pool_width)
-
-    # skip minor overlaps to the first
-    first_start = seq_start + pool_seq_unmap_start * pool_width
-    first_end = first_start + pool_width
-    first_overlap = first_end - overlap_start
-    if first_overlap < 0.1 * pool_width:
-      pool_seq_unmap_start += 1
-
-    # skip minor overlaps to the last
-    last_start = seq_start + (pool_seq_unmap_end - 1) * pool_width
-    last_overlap = overlap_end - last_start
-    if last_overlap < 0.1 * pool_width:
-      pool_seq_unmap_end -= 1
-
-    seqs_unmap[chr_start_indexes[seq_key], pool_seq_unmap_start:pool_seq_unmap_end] = True
-    assert(seqs_unmap[chr_start_indexes[seq_key], pool_seq_unmap_start:pool_seq_unmap_end].sum() == pool_seq_unmap_end-pool_seq_unmap_start)
+  seq_starts = np.array([ms.start for ms in mseqs], dtype='int64')
+  seq_ends = np.array([ms.end for ms in mseqs], dtype='int64')
+  unmap_index = intervals.IntervalIndex.from_bed(unmap_bed)
+  seq_pairs, unmap_pairs = unmap_index.overlap_pairs(
+    [ms.chr for ms in mseqs], seq_starts, seq_ends)
+
+  pair_seq_starts = seq_starts[seq_pairs]
+  overlap_starts = np.maximum(pair_seq_starts, unmap_index.starts[unmap_pairs])
+  overlap_ends = np.minimum(seq_ends[seq_pairs], unmap_index.ends[unmap_pairs])
+
+  pool_seq_unmap_starts = (overlap_starts - pair_seq_starts) // pool_width
+  pool_seq_unmap_ends = -((pair_seq_starts - overlap_ends) // pool_width)
+
+  # skip minor overlaps to the first
+  first_ends = pair_seq_starts + (pool_seq_unmap_starts + 1) * pool_width
+  first_overlaps = first_ends - overlap_starts
+  pool_seq_unmap_starts += (first_overlaps < 0.1 * pool_width)
+
+  # skip minor overlaps to the last
+  last_starts = pair_seq_starts + (pool_seq_unmap_ends - 1) * pool_width
+  last_overlaps = overlap_ends - last_starts
+  pool_seq_unmap_ends -= (last_overlaps < 0.1 * pool_width)
+
+  # mark unmappable bins
+  pool_unmap_lens = np.maximum(pool_seq_unmap_ends - pool_seq_unmap_starts, 0)
+  pool_unmap_offsets = np.arange(pool_unmap_lens.sum()) - \
+    np.repeat(np.cumsum(pool_unmap_lens) - pool_unmap_lens, pool_unmap_lens)
+  unmap_rows = np.repeat(seq_pairs, pool_unmap_lens)
+  unmap_cols = np.repeat(pool_seq_unmap_starts, pool_unmap_lens) + pool_unmap_offsets
+  seqs_unmap[unmap_rows, unmap_cols] = True
 
   # crop
   if crop_bp > 0:
@@ -869,34 +880,160 @@ def limit_contigs(contigs, filter_bed):
      fcontigs: list of Contigs
     """
 
-  # print ctgments to BED
-  ctg_fd, ctg_bed_file = tempfile.mkstemp()
-  ctg_bed_out = open(ctg_bed_file, 'w')
-  for ctg in contigs:
-    print('%s\t%d\t%d' % (ctg.chr, ctg.start, ctg.end), file=ctg_bed_out)
-  ctg_bed_out.close()
-
   # intersect w/ filter_bed
+  filter_index = intervals.IntervalIndex.from_bed(filter_bed)
+  ctg_starts = np.array([ctg.start for ctg in contigs], dtype='int64')
+  ctg_ends = np.array([ctg.end for ctg in contigs], dtype='int64')
+  ctg_pairs, filter_pairs = filter_index.overlap_pairs(
+    [ctg.chr for ctg in contigs], ctg_starts, ctg_ends)
+
+  # clip to overlaps
+  overlap_starts = np.maximum(ctg_starts[ctg_pairs], filter_index.starts[filter_pairs])
+  overlap_ends = np.minimum(ctg_ends[ctg_pairs], filter_index.ends[filter_pairs])
+
   fcontigs = []
-  p = subprocess.Popen(
-      'bedtools intersect -a %s -b %s' % (ctg_bed_file, filter_bed),
-      shell=True,
-      stdout=subprocess.PIPE)
-  for line in p.stdout:
-    a = line.decode('utf-8').split()
-    chrom = a[0]
-    ctg_start = int(a[1])
-    ctg_end = int(a[2])
-    fcontigs.append(Contig(chrom, ctg_start, ctg_end))
-
-  p.communicate()
-
-  os.close(ctg_fd)
-  os.remove(ctg_bed_file)
+  for ci, octg_start, octg_end in zip(ctg_pairs, overlap_starts, overlap_ends):
+    fcontigs.append(Contig(contigs[ci].chr, int(octg_start), int(octg_end)))
 
   return fcontigs
 
 
+################################################################################
+def pool_write_tfrs(tfr_shards, fasta_file, targets_df, mseqs, unmap_npy, options):
+  """ Read coverage and write TF Records shards in a local worker pool.
+
+    Each worker keeps the FASTA and coverage files open across shards and
+    writes a shard's targets straight into its TF Records file, skipping the
+    per-target seqs_cov HDF5 files. Completed shards are recorded in a
+    manifest, which --restart consults to skip finished work; otherwise,
+    it starts anew.
+
+    Args:
+      tfr_shards: list of (tfr_stem, seq start, seq end) tuples
+      fasta_file: genome FASTA file
+      targets_df: targets DataFrame
+      mseqs: list of ModelSeq's
+      unmap_npy: unmappable array numpy file, or None
+      options: basenji_data.py options
+    """
+
+  # read manifest of completed shards
+  manifest_file = '%s/tfr_manifest.txt' % options.out_dir
+  tfr_done = collections.OrderedDict()
+  if options.restart and os.path.isfile(manifest_file):
+    for line in open(manifest_file):
+      tfr_file, num_seqs = line.split()[:2]
+      if os.path.isfile(tfr_file):
+        tfr_done[tfr_file] = int(num_seqs)
+
+  # start the manifest anew, with shards still complete
+  with open('%s.tmp' % manifest_file, 'w') as manifest_out:
+    for tfr_file, num_seqs in tfr_done.items():
+      print('%s\t%d' % (tfr_file, num_seqs), file=manifest_out)
+  os.replace('%s.tmp' % manifest_file, manifest_file)
+
+  tfr_todo = [shard for shard in tfr_shards if '%s.tfr' % shard[0] not in tfr_done]
+  print('Writing %d of %d TF Records shards' % (len(tfr_todo), len(tfr_shards)), flush=True)
+
+  # define per-target read options
+  targets_opts = []
+  for ti in range(targets_df.shape[0]):
+    target_opts = {
+      'file': targets_df['file'].iloc[ti],
+      'sum_stat': targets_df['sum_stat'].iloc[ti],
+      'clip': None,
+      'clip_soft': None,
+      'scale': 1
+    }
+    if 'clip' in targets_df.columns:
+      target_opts['clip'] = targets_df['clip'].iloc[ti]
+    if 'clip_soft' in targets_df.columns:
+      target_opts['clip_soft'] = targets_df['clip_soft'].iloc[ti]
+    if 'scale' in targets_df.columns:
+      target_opts['scale'] = targets_df['scale'].iloc[ti]
+    targets_opts.append(target_opts)
+
+  pool_args = (fasta_file, targets_opts, mseqs, unmap_npy, options)
+  pool_ctx = multiprocessing.get_context('spawn')
+  with pool_ctx.Pool(options.processes, pool_init, pool_args) as pool:
+    with open(manifest_file, 'a') as manifest_out:
+      for tfr_file, num_seqs in pool.imap_unordered(pool_write_tfr, tfr_todo):
+        print('%s\t%d' % (tfr_file, num_seqs), file=manifest_out, flush=True)
+        os.fsync(manifest_out.fileno())
+        print('Wrote %s' % tfr_file, flush=True)
+
+
+pool_state = {}
+
+def pool_init(fasta_file, targets_opts, mseqs, unmap_npy, options):
+  """Initialize pool worker state."""
+  import basenji_data_read
+  import resource
+
+  # coverage files stay open, so allow as many as permitted
+  nofile_soft, nofile_hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  resource.setrlimit(resource.RLIMIT_NOFILE, (nofile_hard, nofile_hard))
+
+  pool_state['fasta_open'] = genome.open_fasta(fasta_file)
+  pool_state['targets_opts'] = targets_opts
+  pool_state['cov_opens'] = {}
+  pool_state['mseqs'] = mseqs
+  pool_state['options'] = options
+  pool_state['black_chr_trees'] = basenji_data_read.read_blacklist(options.blacklist_bed)
+  if unmap_npy is None:
+    pool_state['unmap'] = None
+  else:
+    pool_state['unmap'] = np.load(unmap_npy, mmap_mode='r')
+
+
+def pool_write_tfr(tfr_shard):
+  """Read coverage for one shard's sequences and write its TF Records."""
+  import basenji_data_read
+  import basenji_data_write
+
+  tfr_stem, tfr_start, tfr_end = tfr_shard
+  options = pool_state['options']
+  model_seqs = pool_state['mseqs'][tfr_start:tfr_end]
+  num_seqs = len(model_seqs)
+  num_targets = len(pool_state['targets_opts'])
+
+  target_length = options.seq_length - 2*options.crop_bp
+  target_length = target_length // options.pool_width
+
+  # read coverage
+  targets = np.zeros((num_seqs, target_length, num_targets), dtype='float16')
+  if num_seqs > 0:
+    for ti, target_opts in enumerate(pool_state['targets_opts']):
+      cov_file = target_opts['file']
+      if cov_file not in pool_state['cov_opens']:
+        pool_state['cov_opens'][cov_file] = basenji_data_read.CovFace(cov_file)
+
+      targets[:,:,ti] = basenji_data_read.read_seqs_cov(
+        pool_state['cov_opens'][cov_file], model_seqs,
+        pool_width=options.pool_width, crop_bp=options.crop_bp,
+        sum_stat=target_opts['sum_stat'], clip=target_opts['clip'],
+        clip_soft=target_opts['clip_soft'], scale=target_opts['scale'],
+        interp=options.interp_nan,
+        black_chr_trees=pool_state['black_chr_trees'])
+
+  # modify unmappable
+  unmap_mask = None
+  if pool_state['unmap'] is not None:
+    unmap_mask = np.array(pool_state['unmap'][tfr_start:tfr_end])
+    if options.umap_clip < 1:
+      basenji_data_write.clip_unmap(targets, unmap_mask, options.umap_clip)
+    if not options.umap_tfr:
+      unmap_mask = None
+
+  # write to a temporary file, then move into place
+  tfr_file = '%s.tfr' % tfr_stem
+  basenji_data_write.write_tfr('%s.tmp' % tfr_file, pool_state['fasta_open'],
+                               model_seqs, targets, unmap_mask, options.seq_index)
+  os.replace('%s.tmp' % tfr_file, tfr_file)
+
+  return tfr_file, num_seqs
+
+
 ################################################################################
 def rejoin_large_contigs(contigs):
   """ Rejoin large contigs that were broken up before alignment comparison."""
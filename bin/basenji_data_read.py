@@ -85,20 +85,55 @@ def main():
   # read blacklist regions
   black_chr_trees = read_blacklist(options.blacklist_bed)
 
+  # open genome coverage file
+  genome_cov_open = CovFace(genome_cov_file)
+
+  # read and summarize coverage
+  seqs_cov = read_seqs_cov(genome_cov_open, model_seqs,
+    pool_width=options.pool_width, crop_bp=options.crop_bp,
+    sum_stat=options.sum_stat, clip=options.clip,
+    clip_soft=options.clip_soft, scale=options.scale,
+    interp=options.interp_nan, black_chr_trees=black_chr_trees)
+
+  # close genome coverage file
+  genome_cov_open.close()
+
+  # write sequences coverage file
+  seqs_cov_open = h5py.File(seqs_cov_file, 'w')
+  seqs_cov_open.create_dataset('targets', dtype='float16', data=seqs_cov)
+  seqs_cov_open.close()
+
+
+def read_seqs_cov(genome_cov_open, model_seqs, pool_width=1, crop_bp=0,
+                  sum_stat='sum', clip=None, clip_soft=None, scale=1.,
+                  interp=False, black_chr_trees={}):
+  """Read coverage for each model sequence and summarize it in bins.
+
+    Args:
+      genome_cov_open: open CovFace
+      model_seqs: list of ModelSeq's
+      pool_width: summary bin width
+      crop_bp: nucleotides cropped off ends
+      sum_stat: bin summary statistic
+      clip: clip values post-summary to a maximum
+      clip_soft: soft clip values above this threshold
+      scale: scale values by
+      interp: interpolate NaNs, rather than set to baseline
+      black_chr_trees: blacklist interval trees by chromosome
+
+    Returns:
+      seqs_cov: num_seqs x target_length float16 array
+    """
+
   # compute dimensions
   num_seqs = len(model_seqs)
   seq_len_nt = model_seqs[0].end - model_seqs[0].start
-  seq_len_nt -= 2*options.crop_bp
-  target_length = seq_len_nt // options.pool_width
+  seq_len_nt -= 2*crop_bp
+  target_length = seq_len_nt // pool_width
   assert(target_length > 0)
 
-  # initialize sequences coverage file
-  seqs_cov_open = h5py.File(seqs_cov_file, 'w')
-  # seqs_cov_open.create_dataset('targets', shape=(num_seqs, target_length), dtype='float16')
-  targets_list = []
-
-  # open genome coverage file
-  genome_cov_open = CovFace(genome_cov_file)
+  # initialize sequences coverage
+  seqs_cov = np.zeros((num_seqs, target_length), dtype='float16')
 
   # for each model sequence
   for si in range(num_seqs):
@@ -108,7 +143,7 @@ def main():
     seq_cov_nt = genome_cov_open.read(mseq.chr, mseq.start, mseq.end)
 
     # interpolate NaN
-    if options.interp_nan:
+    if interp:
       seq_cov_nt = interp_nan(seq_cov_nt)
 
     # determine baseline coverage
@@ -127,57 +162,46 @@ def main():
         seq_cov_nt[black_seq_start:black_seq_end] = baseline_cov
 
     # set NaN's to baseline
-    if not options.interp_nan:
+    if not interp:
       nan_mask = np.isnan(seq_cov_nt)
       seq_cov_nt[nan_mask] = baseline_cov
 
     # crop
-    if options.crop_bp > 0:
-      seq_cov_nt = seq_cov_nt[options.crop_bp:-options.crop_bp]
+    if crop_bp > 0:
+      seq_cov_nt = seq_cov_nt[crop_bp:-crop_bp]
 
     # sum pool
-    seq_cov = seq_cov_nt.reshape(target_length, options.pool_width)
-    if options.sum_stat == 'sum':
+    seq_cov = seq_cov_nt.reshape(target_length, pool_width)
+    if sum_stat == 'sum':
       seq_cov = seq_cov.sum(axis=1, dtype='float32')
-    elif options.sum_stat in ['mean', 'avg']:
+    elif sum_stat in ['mean', 'avg']:
       seq_cov = seq_cov.mean(axis=1, dtype='float32')
-    elif options.sum_stat == 'median':
+    elif sum_stat == 'median':
       seq_cov = seq_cov.median(axis=1)
-    elif options.sum_stat == 'max':
+    elif sum_stat == 'max':
       seq_cov = seq_cov.max(axis=1)
-    elif options.sum_stat == 'peak':
+    elif sum_stat == 'peak':
       seq_cov = seq_cov.mean(axis=1, dtype='float32')
       seq_cov = np.clip(np.sqrt(seq_cov*4), 0, 1)
     else:
-      print('ERROR: Unrecognized summary statistic "%s".' % options.sum_stat,
+      print('ERROR: Unrecognized summary statistic "%s".' % sum_stat,
             file=sys.stderr)
       exit(1)
 
     # clip
-    if options.clip_soft is not None:
-      clip_mask = (seq_cov > options.clip_soft)
-      seq_cov[clip_mask] = options.clip_soft + np.sqrt(seq_cov[clip_mask] - options.clip_soft)
-    if options.clip is not None:
-        seq_cov = np.clip(seq_cov, 0, options.clip)
+    if clip_soft is not None:
+      clip_mask = (seq_cov > clip_soft)
+      seq_cov[clip_mask] = clip_soft + np.sqrt(seq_cov[clip_mask] - clip_soft)
+    if clip is not None:
+        seq_cov = np.clip(seq_cov, 0, clip)
 
     # scale
-    seq_cov = options.scale * seq_cov
+    seq_cov = scale * seq_cov
 
     # save
-    targets_list.append(seq_cov.astype('float16'))
+    seqs_cov[si] = seq_cov.astype('float16')
 
-    # write
-    # seqs_cov_open['targets'][si,:] = seq_cov.astype('float16')
-
-  # write all
-  seqs_cov_open.create_dataset('targets', dtype='float16',
-    data=np.array(targets_list, dtype='float16'))
-
-  # close genome coverage file
-  genome_cov_open.close()
-
-  # close sequences coverage file
-  seqs_cov_open.close()
+  return seqs_cov
 
 
 def interp_nan(x, kind='linear'):
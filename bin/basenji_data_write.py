@@ -20,10 +20,10 @@ import sys
 import h5py
 import numpy as np
 import pdb
-import pysam
 
 from basenji_data import ModelSeq
-from basenji.dna_io import dna_1hot, dna_1hot_index
+from basenji import genome
+from basenji.dna_io import index_1hot, index_sample_n
 
 import tensorflow as tf
 
@@ -61,6 +61,9 @@ def main():
   parser.add_option('--umap_tfr', dest='umap_tfr',
       default=False, action='store_true',
       help='Save umap array into TFRecords [Default: %default]')
+  parser.add_option('--seq_index', dest='seq_index',
+      default=False, action='store_true',
+      help='Store sequences as uint8 nucleotide indexes rather than one hot coding [Default: %default]')
   (options, args) = parser.parse_args()
 
   if len(args) != 4:
@@ -124,41 +127,62 @@ def main():
   ################################################################
   # modify unmappable
 
-  if options.umap_npy is not None and options.umap_clip < 1:
-    unmap_mask = np.load(options.umap_npy)
+  unmap_mask = None
+  if options.umap_npy is not None:
+    unmap_mask = np.load(options.umap_npy)[options.start_i:options.end_i]
+    if options.umap_clip < 1:
+      clip_unmap(targets, unmap_mask, options.umap_clip)
 
-    for si in range(num_seqs):
-      msi = options.start_i + si
+  ################################################################
+  # write TFRecords
 
-      # determine unmappable null value
-      seq_target_null = np.percentile(targets[si], q=[100*options.umap_clip], axis=0)[0]
+  # open FASTA, or its cache
+  fasta_open = genome.open_fasta(fasta_file)
 
-      # set unmappable positions to null
-      targets[si,unmap_mask[msi,:],:] = np.minimum(targets[si,unmap_mask[msi,:],:], seq_target_null)
+  # write sequences and targets
+  write_tfr(tfr_file, fasta_open,
+            model_seqs[options.start_i:options.end_i], targets,
+            unmap_mask if options.umap_tfr else None,
+            options.seq_index)
 
-  elif options.umap_npy is not None and options.umap_tfr:
-    unmap_mask = np.load(options.umap_npy)
+  fasta_open.close()
 
-  ################################################################
-  # write TFRecords
 
-  # open FASTA
-  fasta_open = pysam.Fastafile(fasta_file)
+def clip_unmap(targets, unmap_mask, umap_clip):
+  """Clip target values at unmappable positions to the given
+     quantile of each sequence's distribution, in place."""
+  for si in range(targets.shape[0]):
+    # determine unmappable null value
+    seq_target_null = np.percentile(targets[si], q=[100*umap_clip], axis=0)[0]
 
+    # set unmappable positions to null
+    targets[si,unmap_mask[si,:],:] = np.minimum(targets[si,unmap_mask[si,:],:], seq_target_null)
+
+
+def write_tfr(tfr_file, fasta_open, model_seqs, targets, unmap_mask=None, seq_index=False):
+  """Write model sequences and their targets to a TFRecord file.
+
+    Args:
+      tfr_file: output TFRecord file
+      fasta_open: open pysam Fastafile or GenomeCache
+      model_seqs: list of ModelSeq's
+      targets: num_seqs x target_length x num_targets array
+      unmap_mask: optional num_seqs x target_length unmappable array to save
+      seq_index: store nucleotide indexes rather than one hot coding
+    """
   # define options
   tf_opts = tf.io.TFRecordOptions(compression_type='ZLIB')
 
   with tf.io.TFRecordWriter(tfr_file, tf_opts) as writer:
-    for si in range(num_seqs):
-      msi = options.start_i + si
-      mseq = model_seqs[msi]
-
+    for si, mseq in enumerate(model_seqs):
       # read FASTA
-      seq_dna = fasta_open.fetch(mseq.chr, mseq.start, mseq.end)
+      seq_code = genome.fetch_index(fasta_open, mseq.chr, mseq.start, mseq.end)
 
       # one hot code
-      seq_1hot = dna_1hot(seq_dna)
-      # seq_1hot = dna_1hot_index(seq_dna) # more efficient, but fighting inertia
+      if seq_index:
+        seq_1hot = index_sample_n(seq_code)
+      else:
+        seq_1hot = index_1hot(seq_code)
 
       # hash to bytes
       features_dict = {
@@ -167,15 +191,13 @@ def main():
         }
 
       # add unmappability
-      if options.umap_tfr:
-        features_dict['umap'] = feature_bytes(unmap_mask[msi,:])
+      if unmap_mask is not None:
+        features_dict['umap'] = feature_bytes(unmap_mask[si,:])
 
       # write example
       example = tf.train.Example(features=tf.train.Features(feature=features_dict))
       writer.write(example.SerializeToString())
 
-    fasta_open.close()
-
 
 def feature_bytes(values):
   """Convert numpy arrays to bytes features."""
@@ -25,6 +25,9 @@ Fit Cauchy distribution parameters across chromosomes.
 def main():
     usage = 'usage: %prog [options] <sad_h5_path> <vcf_file>'
     parser = OptionParser(usage)
+    parser.add_option('-p', dest='processes',
+            default=None, type='int',
+            help='Processes to fit target distributions [Default: all CPUs]')
     parser.add_option('-s', dest='sample',
             default=131072, type='int',
             help='Sampled SNPs to fit distribution [Default: %default]')
@@ -39,7 +42,7 @@ def main():
     csad5 = ChrSAD5(sad_h5_path, index_chr=True, compute_norm=False)
 
     # fit Cauchy
-    csad5.fit_cauchy(options.sample)
+    csad5.fit_cauchy(options.sample, options.processes)
 
     # normalize
     csad5.norm_cauchy()
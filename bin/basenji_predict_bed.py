@@ -55,12 +55,18 @@ def main():
   parser.add_option('-e', dest='embed_layer',
       default=None, type='int',
       help='Embed sequences using the specified layer index.')
+  parser.add_option('--ens_batch', dest='ensemble_batch',
+      default=None, type='int',
+      help='Stack ensemble copies into batched model calls of at most this many sequences, or 0 for one call [Default: %default]')
   parser.add_option('-f', dest='genome_fasta',
       default=None,
       help='Genome FASTA for sequences [Default: %default]')
   parser.add_option('-g', dest='genome_file',
       default=None,
       help='Chromosome length information [Default: %default]')
+  parser.add_option('--heads', dest='head_indexes',
+      default=None, type='str',
+      help='Comma-separated list of heads to predict from one shared trunk, concatenating their targets, with a comma-separated -t targets file per head [Default: %default]')
   parser.add_option('-l', dest='site_length',
       default=None, type='int',
       help='Prediction site length. [Default: params.seq_length]')
@@ -132,11 +138,19 @@ def main():
     params = json.load(params_open)
   params_model = params['model']
 
+  if options.head_indexes is None:
+    head_indexes = [0]
+  else:
+    head_indexes = [int(hi) for hi in options.head_indexes.split(',')]
+
   if options.targets_file is None:
-    target_slice = None
+    target_slices = [None]*len(head_indexes)
   else:
-    targets_df = pd.read_table(options.targets_file, index_col=0)
-    target_slice = targets_df.index
+    targets_files = options.targets_file.split(',')
+    if len(targets_files) != len(head_indexes):
+      parser.error('Must provide a targets file per head')
+    target_slices = [pd.read_table(targets_file, index_col=0).index
+                     for targets_file in targets_files]
 
   #################################################################
   # setup model
@@ -144,12 +158,19 @@ def main():
   # initialize model
   seqnn_model = seqnn.SeqNN(params_model)
   seqnn_model.restore(model_file)
-  seqnn_model.build_slice(target_slice)
-  seqnn_model.build_ensemble(options.rc, options.shifts)
+  if options.head_indexes is None:
+    seqnn_model.build_slice(target_slices[0])
+  else:
+    seqnn_model.build_multi(head_indexes, target_slices)
+  seqnn_model.build_ensemble(options.rc, options.shifts,
+                             options.ensemble_batch)
 
   if options.embed_layer is not None:
     seqnn_model.build_embed(options.embed_layer)
     _, preds_length, preds_depth  = seqnn_model.embed.output.shape
+  elif options.head_indexes is not None:
+    _, preds_length, _ = seqnn_model.model_multi.outputs[0].shape
+    preds_depth = seqnn_model.num_targets()
   else:
     _, preds_length, preds_depth = seqnn_model.model.output.shape
     
@@ -230,7 +251,8 @@ def main():
       yield dna_io.dna_1hot(seq_dna)
 
   # predict
-  preds_stream = stream.PredStreamGen(seqnn_model, seqs_gen(), params['train']['batch_size'])
+  preds_stream = stream.PredStreamGen(seqnn_model, seqs_gen(), params['train']['batch_size'],
+                                      concat_outputs=True)
 
   for si in range(num_seqs):
     preds_seq = preds_stream[si]
@@ -47,12 +47,18 @@ def main():
       default=None, help='Comma-separated list of target indexes to write BigWigs')
   parser.add_option('-e', dest='embed_layer',
       default=None, type='int', help='Embed sequences using the specified layer index.')
+  parser.add_option('--ens_batch', dest='ensemble_batch',
+      default=None, type='int',
+      help='Stack ensemble copies into batched model calls of at most this many sequences, or 0 for one call [Default: %default]')
   parser.add_option('-f', dest='genome_fasta',
       default=None,
       help='Genome FASTA for sequences [Default: %default]')
   parser.add_option('-g', dest='genome_file',
       default=None,
       help='Chromosome length information [Default: %default]')
+  parser.add_option('--heads', dest='head_indexes',
+      default=None, type='str',
+      help='Comma-separated list of heads to predict from one shared trunk, concatenating their targets, with a comma-separated -t targets file per head [Default: %default]')
   parser.add_option('-l', dest='site_length',
       default=None, type='int',
       help='Prediction site length. [Default: params.seq_length]')
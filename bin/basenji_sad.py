@@ -27,12 +27,15 @@ import time
 import h5py
 import numpy as np
 import pandas as pd
-import pysam
 import tensorflow as tf
 if tf.__version__[0] == '1':
   tf.compat.v1.enable_eager_execution()
 
+from basenji import dna_io
+from basenji import genome
+from basenji import sad5
 from basenji import seqnn
+from basenji import sketch
 from basenji import stream
 from basenji import vcf as bvcf
 
@@ -48,12 +51,36 @@ Compute SNP Activity Difference (SAD) scores for SNPs in a VCF file.
 def main():
   usage = 'usage: %prog [options] <params_file> <model_file> <vcf_file>'
   parser = OptionParser(usage)
+  parser.add_option('-c', dest='center_pct',
+      default=0, type='float',
+      help='Cluster SNPs within this fraction of the sequence to share a reference prediction [Default: %default]')
   parser.add_option('--cpu', dest='cpu',
       default=False, action='store_true',
       help='Run without a GPU [Default: %default]')
+  parser.add_option('--ens_batch', dest='ensemble_batch',
+      default=None, type='int',
+      help='Stack ensemble copies into batched model calls of at most this many sequences, or 0 for one call [Default: %default]')
   parser.add_option('-f', dest='genome_fasta',
       default='%s/data/hg19.fa' % os.environ['BASENJIDIR'],
       help='Genome FASTA for sequences [Default: %default]')
+  parser.add_option('--flip', dest='flip_ref',
+      default=False, action='store_true',
+      help='Flip reference/alternate alleles when simple [Default: %default]')
+  parser.add_option('--genome_cache', dest='genome_cache',
+      default=False, action='store_true',
+      help='Build a memory-mapped cache of the genome FASTA, if not current, to fetch sequences from [Default: %default]')
+  parser.add_option('--h5_chunks', dest='h5_chunks',
+      default=None,
+      help='Comma-separated SNP and target chunk shape of stat datasets, eg 26,5000 [Default: %default]')
+  parser.add_option('--h5_comp', dest='h5_compression',
+      default=None,
+      help='Stat dataset compression: gzip, lzf, or blosc, which requires hdf5plugin [Default: %default]')
+  parser.add_option('--h5_t', dest='h5_transpose',
+      default=False, action='store_true',
+      help='Write a target-major copy of each stat, as <stat>_T, for fast single-target reads [Default: %default]')
+  parser.add_option('--heads', dest='head_indexes',
+      default=None, type='str',
+      help='Comma-separated list of heads to score from one shared trunk, concatenating their targets, with a comma-separated -t targets file per head [Default: %default]')
   parser.add_option('--local', dest='local',
       default=1024, type='int',
       help='Local SAD score [Default: %default]')
@@ -158,13 +185,23 @@ def main():
   params_model = params['model']
   params_train = params['train']
 
+  if options.head_indexes is None:
+    head_indexes = [0]
+  else:
+    head_indexes = [int(hi) for hi in options.head_indexes.split(',')]
+
   if options.targets_file is None:
-    target_slice = None
+    target_slices = [None]*len(head_indexes)
   else:
-    targets_df = pd.read_csv(options.targets_file, sep='\t', index_col=0)
+    targets_files = options.targets_file.split(',')
+    if len(targets_files) != len(head_indexes):
+      parser.error('Must provide a targets file per head')
+    targets_dfs = [pd.read_csv(targets_file, sep='\t', index_col=0)
+                   for targets_file in targets_files]
+    targets_df = pd.concat(targets_dfs)
     target_ids = targets_df.identifier
     target_labels = targets_df.description
-    target_slice = targets_df.index
+    target_slices = [tdf.index for tdf in targets_dfs]
 
   if options.penultimate:
     parser.error('Not implemented for TF2')
@@ -174,8 +211,12 @@ def main():
 
   seqnn_model = seqnn.SeqNN(params_model)
   seqnn_model.restore(model_file)
-  seqnn_model.build_slice(target_slice)
-  seqnn_model.build_ensemble(options.rc, options.shifts)
+  if options.head_indexes is None:
+    seqnn_model.build_slice(target_slices[0])
+  else:
+    seqnn_model.build_multi(head_indexes, target_slices)
+  seqnn_model.build_ensemble(options.rc, options.shifts,
+                             options.ensemble_batch)
 
   num_targets = seqnn_model.num_targets()
   if options.targets_file is None:
@@ -185,70 +226,155 @@ def main():
   #################################################################
   # load SNPs
 
-  # filter for worker SNPs
+  # filter for worker SNPs, splitting the VCF by byte offsets
   if options.processes is not None:
-    # determine boundaries
-    num_snps = bvcf.vcf_count(vcf_file)
-    worker_bounds = np.linspace(0, num_snps, options.processes+1, dtype='int')
-
-    # read SNPs form VCF
-    snps = bvcf.vcf_snps(vcf_file, start_i=worker_bounds[worker_index], end_i=worker_bounds[worker_index+1])
+    part_i, num_parts = worker_index, options.processes
+  else:
+    part_i, num_parts = None, None
 
+  # read SNPs form VCF, checking alleles only to flip them
+  if options.flip_ref:
+    snps = bvcf.vcf_snps(vcf_file, flip_ref=True,
+                         validate_ref_fasta=options.genome_fasta,
+                         part_i=part_i, num_parts=num_parts)
   else:
-    # read SNPs form VCF
-    snps = bvcf.vcf_snps(vcf_file)
+    snps = bvcf.vcf_snps(vcf_file, part_i=part_i, num_parts=num_parts)
 
-  num_snps = len(snps)
 
-  # open genome FASTA
-  genome_open = pysam.Fastafile(options.genome_fasta)
+  #################################################################
+  # setup output
 
-  def snp_gen():
-    for snp in snps:
-      # get SNP sequences
-      snp_1hot_list = bvcf.snp_seq1(snp, params_model['seq_length'], genome_open)
-      for snp_1hot in snp_1hot_list:
-        yield snp_1hot
+  h5_chunks = options.h5_chunks
+  if h5_chunks is not None:
+    h5_chunks = [int(hc) for hc in h5_chunks.split(',')]
+  sad_out = initialize_output_h5(options.out_dir, options.sad_stats,
+                                 snps, target_ids, target_labels,
+                                 h5_chunks, options.h5_compression)
 
 
   #################################################################
-  # setup output
+  # predict SNP scores, write output
 
-  sad_out = initialize_output_h5(options.out_dir, options.sad_stats,
-                                 snps, target_ids, target_labels)
+  sad_sketches = score_snps(seqnn_model, snps, sad_out,
+                            params_model['seq_length'],
+                            params_train['batch_size'], options)
+
+  ###################################################
+  # compute SAD distributions across variants
+
+  # save sketches for multi collection
+  write_pct(sad_out, options.sad_stats, sad_sketches,
+            save_sketches=options.processes is not None)
+
+  # write target-major copies, or leave them to multi collection
+  if options.h5_transpose and options.processes is None:
+    for sad_stat in options.sad_stats:
+      sad5.write_stat_transpose(sad_out, sad_stat)
+
+  sad_out.close()
+
+
+def score_snps(seqnn_model, snps, sad_out, seq_length, batch_size, options,
+               snp_block=32):
+  """Predict and write SAD stats for SNPs in VCF order.
+
+  Consecutive SNPs within options.center_pct of a shared sequence center
+  are clustered, so that each cluster fetches and one hot codes its
+  genomic window once, codes alleles by splicing its nucleotide indexes,
+  and predicts each distinct coding once.
+  Stats are computed and written in blocks of snp_block SNPs.
+
+  Returns:
+    dict mapping each stat to a QuantileSketch of its values by target.
+  """
+  # cluster SNPs by position
+  snp_clusters = cluster_snps(snps, seq_length, options.center_pct)
+
+  # initialize stat distributions
+  num_targets = sad_out['target_ids'].shape[0]
+  sad_sketches = {sad_stat:sketch.QuantileSketch(num_targets)
+                  for sad_stat in options.sad_stats}
+
+  # hold the stat datasets open, so their chunk caches persist between
+  #  SNP blocks and each chunk is compressed once
+  sad_datasets = [sad_out[sad_stat] for sad_stat in options.sad_stats]
+
+  # delimit sequence boundaries
+  [sc.delimit(seq_length) for sc in snp_clusters]
+
+  # open genome FASTA, or its cache
+  genome_open = genome.open_fasta(options.genome_fasta, options.genome_cache)
+
+  # make SNP sequence generator
+  def snp_gen():
+    for sc in snp_clusters:
+      snp_1hot_list = sc.get_1hots(genome_open)
+      for snp_1hot in snp_1hot_list:
+        yield snp_1hot
 
   if options.threads:
     snp_threads = []
     snp_queue = Queue()
     for i in range(1):
-      sw = SNPWorker(snp_queue, sad_out, options.sad_stats, options.log_pseudo)
+      sw = SNPWorker(snp_queue, sad_out, options.sad_stats, options.log_pseudo,
+                     sad_sketches)
       sw.start()
       snp_threads.append(sw)
 
-
-  #################################################################
-  # predict SNP scores, write output
-
   # initialize predictions stream
-  preds_stream = stream.PredStreamGen(seqnn_model, snp_gen(), params_train['batch_size'])
+  preds_stream = stream.PredStreamGen(seqnn_model, snp_gen(), batch_size,
+                                      concat_outputs=True)
 
   # predictions index
   pi = 0
 
-  for si in range(num_snps):
-    # get predictions
-    ref_preds = preds_stream[pi]
-    pi += 1
-    alt_preds = preds_stream[pi]
-    pi += 1
+  # SNP index of the current block's first row
+  si = 0
+
+  # accumulate SNP predictions to score and write as one row block
+  ref_block = []
+  alt_block = []
 
+  def write_block():
+    ref_preds = np.array(ref_block)
+    alt_preds = np.array(alt_block)
     if options.threads:
-      # queue SNP
+      # queue SNP block
       snp_queue.put((ref_preds, alt_preds, si))
     else:
-      # process SNP
-      write_snp(ref_preds, alt_preds, sad_out, si,
-                options.sad_stats, options.log_pseudo)
+      # process SNP block
+      write_snps(ref_preds, alt_preds, sad_out, si,
+                 options.sad_stats, options.log_pseudo, sad_sketches)
+    ref_block.clear()
+    alt_block.clear()
+
+  for snp_cluster in snp_clusters:
+    # the cluster's codings, and allele checks, precede its predictions
+    cluster_preds = [preds_stream[pi]]
+    num_codings = 1 + max([max(sc) for sc in snp_cluster.codings])
+    for ci in range(1, num_codings):
+      cluster_preds.append(preds_stream[pi+ci])
+    pi += num_codings
+
+    for snp, (ref_ci, alt_ci) in zip(snp_cluster.snps, snp_cluster.codings):
+      # unmatched alleles code (0, 0) and score zero
+      ref_preds = cluster_preds[ref_ci]
+      alt_preds = cluster_preds[alt_ci]
+
+      # flipped SNPs were coded with the genome allele as reference
+      if snp.flipped:
+        ref_block.append(alt_preds)
+        alt_block.append(ref_preds)
+      else:
+        ref_block.append(ref_preds)
+        alt_block.append(alt_preds)
+
+      if len(ref_block) == snp_block:
+        write_block()
+        si += snp_block
+
+  if ref_block:
+    write_block()
 
   if options.threads:
     # finish queue
@@ -258,20 +384,20 @@ def main():
   # close genome
   genome_open.close()
 
-  ###################################################
-  # compute SAD distributions across variants
+  return sad_sketches
 
-  write_pct(sad_out, options.sad_stats)
-  sad_out.close()
 
-
-def initialize_output_h5(out_dir, sad_stats, snps, target_ids, target_labels):
-  """Initialize an output HDF5 file for SAD stats."""
+def initialize_output_h5(out_dir, sad_stats, snps, target_ids, target_labels,
+                         chunks=None, compression=None):
+  """Initialize an output HDF5 file for SAD stats, stored contiguously
+     or with the given chunk shape and compression."""
 
   num_targets = len(target_ids)
   num_snps = len(snps)
 
-  sad_out = h5py.File('%s/sad.h5' % out_dir, 'w')
+  stat_opts = sad5.stat_h5_opts((num_snps, num_targets), chunks, compression)
+  sad_out = h5py.File('%s/sad.h5' % out_dir, 'w',
+                      **sad5.stat_h5_cache(stat_opts['shape'], stat_opts.get('chunks')))
 
   # write SNPs
   snp_ids = np.array([snp.rsid for snp in snps], 'S')
@@ -309,109 +435,279 @@ def initialize_output_h5(out_dir, sad_stats, snps, target_ids, target_labels):
 
   # initialize SAD stats
   for sad_stat in sad_stats:
-    sad_out.create_dataset(sad_stat,
-        shape=(num_snps, num_targets),
-        dtype='float16',
-        compression=None)
+    sad_out.create_dataset(sad_stat, **stat_opts)
 
   return sad_out
 
 
-def write_pct(sad_out, sad_stats):
-  """Compute percentile values for each target and write to HDF5."""
-
-  # define percentiles
+def sad_percentiles():
+  """Return the percentiles summarized for each target."""
   d_fine = 0.001
   d_coarse = 0.01
   percentiles_neg = np.arange(d_fine, 0.1, d_fine)
   percentiles_base = np.arange(0.1, 0.9, d_coarse)
   percentiles_pos = np.arange(0.9, 1, d_fine)
+  return np.concatenate([percentiles_neg, percentiles_base, percentiles_pos])
+
 
-  percentiles = np.concatenate([percentiles_neg, percentiles_base, percentiles_pos])
+def write_pct(sad_out, sad_stats, sad_sketches=None, save_sketches=False):
+  """Compute percentile values for each target and write to HDF5,
+     from quantile sketches when given or else the full stat matrix."""
+
+  # define percentiles
+  percentiles = sad_percentiles()
   sad_out.create_dataset('percentiles', data=percentiles)
-  pct_len = len(percentiles)
 
   for sad_stat in sad_stats:
     sad_stat_pct = '%s_pct' % sad_stat
 
     # compute
-    sad_pct = np.percentile(sad_out[sad_stat], 100*percentiles, axis=0).T
+    if sad_sketches is None:
+      sad_pct = np.percentile(sad_out[sad_stat], 100*percentiles, axis=0).T
+    else:
+      sad_pct = sad_sketches[sad_stat].quantiles(percentiles)
+      if save_sketches:
+        sad_sketches[sad_stat].write(sad_out, '%s_sketch' % sad_stat)
     sad_pct = sad_pct.astype('float16')
 
     # save
     sad_out.create_dataset(sad_stat_pct, data=sad_pct, dtype='float16')
 
-    
+
 def write_snp(ref_preds, alt_preds, sad_out, si, sad_stats, log_pseudo):
   """Write SNP predictions to HDF."""
-
-  ref_preds = ref_preds.astype('float64')
-  alt_preds = alt_preds.astype('float64')
-  num_targets = ref_preds.shape[-1]
-
-  # sum across length
-  ref_preds_sum = ref_preds.sum(axis=0)
-  alt_preds_sum = alt_preds.sum(axis=0)
+  write_snps(ref_preds[np.newaxis], alt_preds[np.newaxis], sad_out, si,
+             sad_stats, log_pseudo)
+
+
+def write_snps(ref_preds, alt_preds, sad_out, si, sad_stats, log_pseudo,
+               sad_sketches=None):
+  """Write a block of SNP predictions to consecutive HDF rows.
+
+  Args:
+    ref_preds: [snps, length, targets] reference predictions.
+    alt_preds: [snps, length, targets] alternative predictions.
+    sad_out: Open output HDF5 with a dataset per stat.
+    si: Row index of the block's first SNP.
+    sad_stats: Stats to compute.
+    log_pseudo: Log2 pseudocount.
+    sad_sketches: Optional dict of QuantileSketch by stat to update.
+  """
+  ref_preds = ref_preds.astype('float32', copy=False)
+  alt_preds = alt_preds.astype('float32', copy=False)
+  sj = si + ref_preds.shape[0]
+  sad_values = {}
+
+  # difference, shared by SAD and SAX
+  if 'SAD' in sad_stats or 'SAX' in sad_stats:
+    sad_vec = alt_preds - ref_preds
+
+  # log2 ratio, shared by SAXR and SAR
+  if 'SAXR' in sad_stats or 'SAR' in sad_stats:
+    sar_vec = np.log2(alt_preds + log_pseudo)
+    sar_vec -= np.log2(ref_preds + log_pseudo)
 
   # compare reference to alternative via mean subtraction
   if 'SAD' in sad_stats:
-    sad = alt_preds_sum - ref_preds_sum
-    sad_out['SAD'][si,:] = sad.astype('float16')
+    sad_values['SAD'] = sad_vec.sum(axis=1)
 
   # compare reference to alternative via max subtraction
   if 'SAX' in sad_stats:
-    sad_vec = (alt_preds - ref_preds)
-    max_i = np.argmax(np.abs(sad_vec), axis=0)
-    sax = sad_vec[max_i, np.arange(num_targets)]
-    sad_out['SAX'][si,:] = sax.astype('float16')
+    sad_values['SAX'] = max_abs(sad_vec)
 
   # compare reference to alternative via mean log division
   if 'SADR' in sad_stats:
-    sar = np.log2(alt_preds_sum + log_pseudo) \
-                   - np.log2(ref_preds_sum + log_pseudo)
-    sad_out['SADR'][si,:] = sar.astype('float16')
+    sad_values['SADR'] = np.log2(alt_preds.sum(axis=1) + log_pseudo) \
+                          - np.log2(ref_preds.sum(axis=1) + log_pseudo)
 
-  # compare reference to alternative via max subtraction
+  # compare reference to alternative via max log division
   if 'SAXR' in sad_stats:
-    sar_vec = np.log2(alt_preds + log_pseudo) \
-                - np.log2(ref_preds + log_pseudo)
-    max_i = np.argmax(np.abs(sar_vec), axis=0)
-    saxr = sar_vec[max_i, np.arange(num_targets)]
-    sad_out['SAXR'][si,:] = saxr.astype('float16')
+    sad_values['SAXR'] = max_abs(sar_vec)
 
   # compare geometric means
   if 'SAR' in sad_stats:
-    sar_vec = np.log2(alt_preds + log_pseudo) \
-                - np.log2(ref_preds + log_pseudo)
-    geo_sad = sar_vec.sum(axis=0)
-    sad_out['SAR'][si,:] = geo_sad.astype('float16')
+    sad_values['SAR'] = sar_vec.sum(axis=1)
+
+  # write row block
+  for sad_stat, values in sad_values.items():
+    values = values.astype('float16')
+    sad_out[sad_stat][si:sj] = values
+    if sad_sketches is not None:
+      sad_sketches[sad_stat].update(values)
+
+
+def max_abs(x):
+  """Return the entries of [snps, length, targets] x with maximum
+     absolute value along length."""
+  max_i = np.abs(x).argmax(axis=1)
+  return np.take_along_axis(x, max_i[:,np.newaxis,:], axis=1)[:,0,:]
 
 
 class SNPWorker(Thread):
-  """Compute summary statistics and write to HDF."""
-  def __init__(self, snp_queue, sad_out, stats, log_pseudo=1):
+  """Compute summary statistics and write to HDF for blocks of SNPs."""
+  def __init__(self, snp_queue, sad_out, stats, log_pseudo=1, sketches=None):
     Thread.__init__(self)
     self.queue = snp_queue
     self.daemon = True
     self.sad_out = sad_out
     self.stats = stats
     self.log_pseudo = log_pseudo
+    self.sketches = sketches
 
   def run(self):
     while True:
       # unload predictions
       ref_preds, alt_preds, szi = self.queue.get()
 
-      # write SNP
-      write_snp(ref_preds, alt_preds, self.sad_out, szi, self.stats, self.log_pseudo)
-
-      if szi % 32 == 0:
-        gc.collect()
+      # write SNP block
+      write_snps(ref_preds, alt_preds, self.sad_out, szi, self.stats,
+                 self.log_pseudo, self.sketches)
 
       # communicate finished task
       self.queue.task_done()
 
 
+def cluster_snps(snps, seq_len, center_pct):
+  """Cluster consecutive SNPs into regions that will satisfy
+     the required center_pct. SNPs at the same position always
+     share a cluster, and unsorted SNPs start new clusters."""
+  valid_snp_distance = max(1, int(seq_len*center_pct))
+
+  snp_clusters = []
+  cluster_chr = None
+
+  for snp in snps:
+    if snp.chr == cluster_chr and \
+        cluster_pos0 <= snp.pos < cluster_pos0 + valid_snp_distance:
+      # append to latest cluster
+      snp_clusters[-1].add_snp(snp)
+    else:
+      # initialize new cluster
+      snp_clusters.append(SNPCluster())
+      snp_clusters[-1].add_snp(snp)
+      cluster_chr = snp.chr
+      cluster_pos0 = snp.pos
+
+  return snp_clusters
+
+
+class SNPCluster:
+  def __init__(self):
+    self.snps = []
+    self.chr = None
+    self.start = None
+    self.end = None
+
+  def add_snp(self, snp):
+    self.snps.append(snp)
+
+  def delimit(self, seq_len):
+    positions = [snp.pos for snp in self.snps]
+    pos_min = np.min(positions)
+    pos_max = np.max(positions)
+    pos_mid = (pos_min + pos_max) // 2
+
+    self.chr = self.snps[0].chr
+    self.start = pos_mid - seq_len//2
+    self.end = self.start + seq_len
+
+    for snp in self.snps:
+      snp.seq_pos = snp.pos - 1 - self.start
+
+  def get_1hots(self, genome_open):
+    """Return the cluster's reference one hot coding, followed by the
+       further codings its SNPs need, as vcf.snp_seq1 would code them.
+
+       self.codings holds each SNP's (reference, alternative) indexes into
+       the returned list, sharing the cluster reference wherever a coding
+       equals it. SNPs whose alternative allele matches the genome have
+       their reference allele swapped in, marked in self.swapped. SNPs
+       matching neither are marked in self.skipped and coded (0, 0)."""
+    seq_len = self.end - self.start
+
+    # extend the window to fill deletions from the genome
+    extend_len = max([max(0, len(snp.ref_allele) - len(snp.alt_alleles[0]))
+                      for snp in self.snps])
+
+    # extract reference, padded with N's
+    ext_index = genome.fetch_index(genome_open, self.chr, self.start,
+                                   self.end + extend_len)
+    ref_index = ext_index[:seq_len]
+
+    # 1 hot code reference sequence
+    seqs1_list = [dna_io.index_1hot(ref_index)]
+
+    self.codings = []
+    self.swapped = []
+    self.skipped = []
+    for snp in self.snps:
+      ref_allele = snp.ref_allele
+      alt_allele = snp.alt_alleles[0]
+      ref_n = len(ref_allele)
+      alt_n = len(alt_allele)
+
+      # SNP sequence, extended by its own deletion
+      snp_index = ext_index[:seq_len + max(0, ref_n - alt_n)]
+
+      # verify reference alleles
+      ref_snp = index_dna(snp_index[snp.seq_pos:snp.seq_pos+ref_n])
+      alt_snp = index_dna(snp_index[snp.seq_pos:snp.seq_pos+alt_n])
+      if ref_snp == ref_allele:
+        self.swapped.append(False)
+        self.skipped.append(False)
+      elif alt_snp == alt_allele:
+        print('WARNING: %s - alt (as opposed to ref) allele matches reference genome; changing reference genome to match.' % snp.rsid, file=sys.stderr)
+        snp_index = splice_index(snp_index, snp.seq_pos, alt_n, ref_allele)
+        self.swapped.append(True)
+        self.skipped.append(False)
+      else:
+        print('WARNING: %s - reference genome does not match any allele' % snp.rsid, file=sys.stderr)
+        self.swapped.append(False)
+        self.skipped.append(True)
+        self.codings.append((0, 0))
+        continue
+
+      # make reference and alternative codings
+      #  (assuming SNP is 1-based indexed)
+      alt_index = splice_index(snp_index, snp.seq_pos, ref_n, alt_allele)
+      snp_codings = []
+      for seq_index in [snp_index, alt_index]:
+        seq_index = length_index(seq_index, seq_len)
+        if np.array_equal(seq_index, ref_index):
+          snp_codings.append(0)
+        else:
+          snp_codings.append(len(seqs1_list))
+          seqs1_list.append(dna_io.index_1hot(seq_index))
+      self.codings.append(tuple(snp_codings))
+
+    return seqs1_list
+
+
+def index_dna(seq_index):
+  """Return the nucleotide string of a uint8 index array."""
+  return dna_io.DNA_CHARS[seq_index].tobytes().decode('ascii')
+
+
+def length_index(seq_index, length):
+  """Trim or N pad a uint8 index array about its center to length,
+     as vcf.dna_length_1hot does."""
+  if length < len(seq_index):
+    seq_trim = (len(seq_index) - length) // 2
+    seq_index = seq_index[seq_trim:seq_trim+length]
+  elif length > len(seq_index):
+    nfront = (length - len(seq_index)) // 2
+    nback = length - len(seq_index) - nfront
+    seq_index = np.concatenate([np.full(nfront, 4, dtype='uint8'), seq_index,
+                                np.full(nback, 4, dtype='uint8')])
+  return seq_index
+
+
+def splice_index(seq_index, pos, remove_len, allele):
+  """Replace remove_len indexes at pos with the allele's."""
+  return np.concatenate([seq_index[:pos], dna_io.dna_index(allele),
+                         seq_index[pos+remove_len:]])
+
+
 ################################################################################
 # __main__
 ################################################################################
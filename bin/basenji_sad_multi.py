@@ -25,6 +25,9 @@ import sys
 import h5py
 import numpy as np
 
+from basenji import genome
+from basenji import sad5
+from basenji import sketch
 import slurm
 
 """
@@ -42,9 +45,33 @@ def main():
   parser = OptionParser(usage)
 
   # sad
+  parser.add_option('-c', dest='center_pct',
+      default=0, type='float',
+      help='Cluster SNPs within this fraction of the sequence to share a reference prediction [Default: %default]')
+  parser.add_option('--ens_batch', dest='ensemble_batch',
+      default=None, type='int',
+      help='Stack ensemble copies into batched model calls of at most this many sequences, or 0 for one call [Default: %default]')
   parser.add_option('-f', dest='genome_fasta',
       default='%s/data/hg19.fa' % os.environ['BASENJIDIR'],
       help='Genome FASTA for sequences [Default: %default]')
+  parser.add_option('--flip', dest='flip_ref',
+      default=False, action='store_true',
+      help='Flip reference/alternate alleles when simple [Default: %default]')
+  parser.add_option('--genome_cache', dest='genome_cache',
+      default=False, action='store_true',
+      help='Build a memory-mapped cache of the genome FASTA, if not current, to fetch sequences from [Default: %default]')
+  parser.add_option('--h5_chunks', dest='h5_chunks',
+      default=None,
+      help='Comma-separated SNP and target chunk shape of stat datasets, eg 26,5000 [Default: %default]')
+  parser.add_option('--h5_comp', dest='h5_compression',
+      default=None,
+      help='Stat dataset compression: gzip, lzf, or blosc, which requires hdf5plugin [Default: %default]')
+  parser.add_option('--h5_t', dest='h5_transpose',
+      default=False, action='store_true',
+      help='Write a target-major copy of each stat, as <stat>_T, for fast single-target reads [Default: %default]')
+  parser.add_option('--heads', dest='head_indexes',
+      default=None, type='str',
+      help='Comma-separated list of heads to score from one shared trunk, concatenating their targets, with a comma-separated -t targets file per head [Default: %default]')
   parser.add_option('--local',dest='local',
       default=1024, type='int',
       help='Local SAD score [Default: %default]')
@@ -83,6 +110,9 @@ def main():
   parser.add_option('--cpu', dest='cpu',
       default=False, action='store_true',
       help='Run without a GPU [Default: %default]')
+  parser.add_option('--exact_pct', dest='exact_pct',
+      default=False, action='store_true',
+      help='Compute percentiles exactly from the merged SAD, rather than from merged job sketches [Default: %default]')
   parser.add_option('--name', dest='name',
       default='sad', help='SLURM name prefix [Default: %default]')
   parser.add_option('--max_proc', dest='max_proc',
@@ -97,6 +127,9 @@ def main():
   parser.add_option('-r', dest='restart',
       default=False, action='store_true',
       help='Restart a partially completed job [Default: %default]')
+  parser.add_option('--vds', dest='virtual_h5',
+      default=False, action='store_true',
+      help='Collect job outputs into HDF5 virtual datasets, without copying [Default: %default]')
   (options, args) = parser.parse_args()
 
   if len(args) != 3:
@@ -116,6 +149,10 @@ def main():
       exit(1)
     os.mkdir(options.out_dir)
 
+  # build the genome cache once, for workers to share
+  if options.genome_cache:
+    genome.GenomeCache.build(options.genome_fasta)
+
   # pickle options
   options_pkl_file = '%s/options.pkl' % options.out_dir
   options_pkl = open(options_pkl_file, 'wb')
@@ -154,7 +191,8 @@ def main():
   #######################################################
   # collect output
 
-  collect_h5('sad.h5', options.out_dir, options.processes)
+  collect_h5('sad.h5', options.out_dir, options.processes,
+             options.virtual_h5, options.exact_pct, options.h5_transpose)
 
   # for pi in range(options.processes):
   #     shutil.rmtree('%s/job%d' % (options.out_dir,pi))
@@ -169,79 +207,135 @@ def collect_table(file_name, out_dir, num_procs):
         shell=True)
 
 
-def collect_h5(file_name, out_dir, num_procs):
+def collect_h5(file_name, out_dir, num_procs, virtual=False, exact_pct=False,
+               transpose=False, block_values=2**26):
+  """Merge job HDF5 outputs into one file.
+
+    Per-variant datasets are either copied from the jobs in blocks into
+    datasets chunked like the jobs', or, if virtual, stitched together as
+    HDF5 virtual datasets that read the job files in place, which must
+    then be kept. Percentiles come from the merged job quantile sketches,
+    or are computed exactly from the merged values if exact_pct or the
+    jobs saved no sketches. If transpose, each SNP x target stat also
+    gets a target-major copy, as <stat>_T.
+
+    Args:
+      file_name: HDF5 file name within out_dir and each job directory
+      out_dir: output directory, holding job0, job1, ...
+      num_procs: number of jobs
+      virtual: write virtual datasets, rather than copying
+      exact_pct: compute percentiles from the merged values
+      transpose: write target-major copies of the stats
+      block_values: values read into memory at a time
+  """
+  job_h5_files = ['job%d/%s' % (pi, file_name) for pi in range(num_procs)]
+  job_h5_opens = [h5py.File('%s/%s' % (out_dir, jf), 'r') for jf in job_h5_files]
+  job0_h5_open = job_h5_opens[0]
+
   # count variants
-  num_variants = 0
-  for pi in range(num_procs):
-    # open job
-    job_h5_file = '%s/job%d/%s' % (out_dir, pi, file_name)
-    job_h5_open = h5py.File(job_h5_file, 'r')
-    num_variants += len(job_h5_open['snp'])
-    job_h5_open.close()
+  job_variants = [len(job_h5_open['snp']) for job_h5_open in job_h5_opens]
+  job_starts = np.cumsum([0] + job_variants)
+  num_variants = job_starts[-1]
 
   # initialize final h5
   final_h5_file = '%s/%s' % (out_dir, file_name)
   final_h5_open = h5py.File(final_h5_file, 'w')
 
-  # keep dict for string values
-  final_strings = {}
+  # merged quantile sketches, stats with percentiles, and SNP x target stats
+  final_sketches = {}
+  pct_stats = []
+  matrix_stats = []
 
-  job0_h5_file = '%s/job0/%s' % (out_dir, file_name)
-  job0_h5_open = h5py.File(job0_h5_file, 'r')
   for key in job0_h5_open.keys():
-    if key in ['percentiles', 'target_ids', 'target_labels']:
-      # copy
-      final_h5_open.create_dataset(key, data=job0_h5_open[key])
+    job0_dataset = job0_h5_open[key]
 
-    elif key[-4:] == '_pct':
-      values = np.zeros(job0_h5_open[key].shape)
-      final_h5_open.create_dataset(key, data=values)
+    if key[-2:] == '_T':
+      # rewritten from the merged stat
+      pass
+
+    elif key in ['percentiles', 'target_ids', 'target_labels']:
+      # copy
+      final_h5_open.create_dataset(key, data=job0_dataset)
 
-    elif job0_h5_open[key].dtype.char == 'S':
-        final_strings[key] = []
+    elif key[-7:] == '_sketch':
+      if not exact_pct:
+        # merge
+        final_sketches[key[:-7]] = sketch.QuantileSketch.read(job0_h5_open, key)
+        for job_h5_open in job_h5_opens[1:]:
+          job_sketch = sketch.QuantileSketch.read(job_h5_open, key)
+          final_sketches[key[:-7]].merge(job_sketch)
 
-    elif job0_h5_open[key].ndim == 1:
-      final_h5_open.create_dataset(key, shape=(num_variants,), dtype=job0_h5_open[key].dtype)
+    elif key[-4:] == '_pct':
+      pct_stats.append(key[:-4])
 
     else:
-      num_targets = job0_h5_open[key].shape[1]
-      final_h5_open.create_dataset(key, shape=(num_variants, num_targets), dtype=job0_h5_open[key].dtype)
-
-  job0_h5_open.close()
-
-  # set values
-  vi = 0
-  for pi in range(num_procs):
-    # open job
-    job_h5_file = '%s/job%d/%s' % (out_dir, pi, file_name)
-    job_h5_open = h5py.File(job_h5_file, 'r')
-
-    # append to final
-    for key in job_h5_open.keys():
-      if key in ['percentiles', 'target_ids', 'target_labels']:
-        # once is enough
-        pass
-
-      elif key[-4:] == '_pct':
-        # average
-        u_k1 = np.array(final_h5_open[key])
-        x_k = np.array(job_h5_open[key])
-        final_h5_open[key][:] = u_k1 + (x_k - u_k1) / (pi+1)
+      shape = (num_variants,) + job0_dataset.shape[1:]
+      dtype = job0_dataset.dtype
+      if dtype.char == 'S':
+        # fit the longest job string
+        dtype = 'S%d' % max([jho[key].dtype.itemsize for jho in job_h5_opens])
+      elif len(shape) == 2:
+        matrix_stats.append(key)
+
+      if virtual and dtype == job0_dataset.dtype:
+        # stitch job datasets, by relative paths
+        final_layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+        for pi in range(num_procs):
+          if job_variants[pi] > 0:
+            job_source = h5py.VirtualSource(job_h5_files[pi], key,
+                                            shape=job_h5_opens[pi][key].shape)
+            final_layout[job_starts[pi]:job_starts[pi+1]] = job_source
+        final_h5_open.create_virtual_dataset(key, final_layout)
 
       else:
-        if job_h5_open[key].dtype.char == 'S':
-          final_strings[key] += list(job_h5_open[key])
-        else:
-          job_variants = job_h5_open[key].shape[0]
-          final_h5_open[key][vi:vi+job_variants] = job_h5_open[key]
-
-    vi += job_variants
+        # allocate, with the job datasets' filters, chunked
+        chunks = job0_dataset.chunks
+        if chunks is not None:
+          chunks = (min(chunks[0], num_variants),) + chunks[1:]
+        elif len(shape) > 1:
+          chunks = (min(num_variants, max(1, sad5.STAT_CHUNK_VALUES // max(shape[1],1))), shape[1])
+        final_dataset = sad5.create_dataset_like(final_h5_open, key, shape, dtype,
+          job0_dataset.id.get_create_plist(), chunks)
+
+        # copy job slices in blocks
+        block_rows = max(1, block_values // max(1, np.prod(shape[1:], dtype='int64')))
+        for pi in range(num_procs):
+          for bi in range(0, job_variants[pi], block_rows):
+            bj = min(bi + block_rows, job_variants[pi])
+            vi = job_starts[pi] + bi
+            final_dataset[vi:vi+bj-bi] = job_h5_opens[pi][key][bi:bj]
+
+  # close jobs, for virtual datasets to open them
+  job_dcpls = {key:job0_h5_open[key].id.get_create_plist() for key in matrix_stats}
+  for job_h5_open in job_h5_opens:
     job_h5_open.close()
 
-  # create final string datasets
-  for key in final_strings:
-    final_h5_open.create_dataset(key,
-      data=np.array(final_strings[key], dtype='S'))
+  # write target-major copies
+  if transpose:
+    for key in matrix_stats:
+      sad5.write_stat_transpose(final_h5_open, key, job_dcpls[key], block_values)
+
+  # compute percentiles
+  for stat in pct_stats:
+    percentiles = final_h5_open['percentiles'][:]
+    if stat in final_sketches:
+      stat_pct = final_sketches[stat].quantiles(percentiles)
+
+    else:
+      # exactly, from blocks of target columns
+      num_targets = final_h5_open[stat].shape[1]
+      block_targets = max(1, block_values // max(num_variants,1))
+      stat_pct = np.zeros((num_targets, len(percentiles)))
+      for ti in range(0, num_targets, block_targets):
+        tj = min(ti + block_targets, num_targets)
+        if '%s_T' % stat in final_h5_open:
+          stat_block = final_h5_open['%s_T' % stat][ti:tj].T
+        else:
+          stat_block = final_h5_open[stat][:,ti:tj]
+        stat_pct[ti:tj] = np.percentile(stat_block, 100*percentiles, axis=0).T
+
+    final_h5_open.create_dataset('%s_pct' % stat,
+      data=stat_pct.astype('float16'))
 
   final_h5_open.close()
 
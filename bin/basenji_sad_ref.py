@@ -16,14 +16,11 @@
 from __future__ import print_function
 
 from optparse import OptionParser
-import gc
 import json
 import pdb
 import pickle
 import os
-from queue import Queue
 import sys
-from threading import Thread
 import time
 
 import h5py
@@ -34,19 +31,19 @@ import tensorflow as tf
 if tf.__version__[0] == '1':
   tf.compat.v1.enable_eager_execution()
 
-from basenji import dna_io
 from basenji import seqnn
 from basenji import vcf as bvcf
-from basenji import stream
 
-from basenji_sad import SNPWorker, initialize_output_h5, write_pct, write_snp
+from basenji_sad import cluster_snps, initialize_output_h5, score_snps, write_pct
 
 '''
 basenji_sad_ref.py
 
 Compute SNP Activity Difference (SAD) scores for SNPs in a VCF file.
 This versions saves computation by clustering nearby SNPs in order to
-make a single reference prediction for several SNPs.
+make a single reference prediction for several SNPs, and requires a
+sorted VCF whose reference alleles match the genome. The clustering
+itself lives in basenji_sad.score_snps, shared with basenji_sad.py.
 '''
 
 ################################################################################
@@ -58,6 +55,9 @@ def main():
   parser.add_option('-c', dest='center_pct',
       default=0.25, type='float',
       help='Require clustered SNPs lie in center region [Default: %default]')
+  parser.add_option('--ens_batch', dest='ensemble_batch',
+      default=None, type='int',
+      help='Stack ensemble copies into batched model calls of at most this many sequences, or 0 for one call [Default: %default]')
   parser.add_option('-f', dest='genome_fasta',
       default='%s/data/hg19.fa' % os.environ['BASENJIDIR'],
       help='Genome FASTA for sequences [Default: %default]')
@@ -167,7 +167,8 @@ def main():
   seqnn_model = seqnn.SeqNN(params_model)
   seqnn_model.restore(model_file)
   seqnn_model.build_slice(target_slice)
-  seqnn_model.build_ensemble(options.rc, options.shifts)
+  seqnn_model.build_ensemble(options.rc, options.shifts,
+                             options.ensemble_batch)
 
   num_targets = seqnn_model.num_targets()
   if options.targets_file is None:
@@ -179,214 +180,38 @@ def main():
 
   # filter for worker SNPs
   if options.processes is not None:
-    # determine boundaries
-    num_snps = bvcf.vcf_count(vcf_file)
-    worker_bounds = np.linspace(0, num_snps, options.processes+1, dtype='int')
-
-    # read sorted SNPs from VCF
+    # read worker's part of sorted SNPs from VCF
     snps = bvcf.vcf_snps(vcf_file, require_sorted=True, flip_ref=options.flip_ref,
                          validate_ref_fasta=options.genome_fasta,
-                         start_i=worker_bounds[worker_index],
-                         end_i=worker_bounds[worker_index+1])
+                         part_i=worker_index, num_parts=options.processes)
   else:
     # read sorted SNPs from VCF
     snps = bvcf.vcf_snps(vcf_file, require_sorted=True, flip_ref=options.flip_ref,
                          validate_ref_fasta=options.genome_fasta)
 
-  # cluster SNPs by position
-  snp_clusters = cluster_snps(snps, params_model['seq_length'], options.center_pct)
-
-  # delimit sequence boundaries
-  [sc.delimit(params_model['seq_length']) for sc in snp_clusters]
-
-  # open genome FASTA
-  genome_open = pysam.Fastafile(options.genome_fasta)
-
-  # make SNP sequence generator
-  def snp_gen():
-    for sc in snp_clusters:
-      snp_1hot_list = sc.get_1hots(genome_open)
-      for snp_1hot in snp_1hot_list:
-        yield snp_1hot
-
-
   #################################################################
   # setup output
 
-  snp_flips = np.array([snp.flipped for snp in snps], dtype='bool')
-
   sad_out = initialize_output_h5(options.out_dir, options.sad_stats,
                                  snps, target_ids, target_labels)
 
-  if options.threads:
-    snp_threads = []
-    snp_queue = Queue()
-    for i in range(1):
-      sw = SNPWorker(snp_queue, sad_out, options.sad_stats, options.log_pseudo)
-      sw.start()
-      snp_threads.append(sw)
-
 
   #################################################################
   # predict SNP scores, write output
 
-  # initialize predictions stream
-  preds_stream = stream.PredStreamGen(seqnn_model, snp_gen(), params['train']['batch_size'])
-
-  # predictions index
-  pi = 0
-
-  # SNP index
-  si = 0
-
-  for snp_cluster in snp_clusters:
-    ref_preds = preds_stream[pi]
-    pi += 1
-
-    for snp in snp_cluster.snps:
-      # print(snp, flush=True)
-
-      alt_preds = preds_stream[pi]
-      pi += 1
-
-      if snp_flips[si]:
-        ref_preds, alt_preds = alt_preds, ref_preds
-
-      if options.threads:
-        # queue SNP
-          snp_queue.put((ref_preds, alt_preds, si))
-      else:
-        # process SNP
-        write_snp(ref_preds, alt_preds, sad_out, si,
-                  options.sad_stats, options.log_pseudo)
-
-      # update SNP index
-      si += 1
-
-  # finish queue
-  if options.threads:
-    print('Waiting for threads to finish.', flush=True)
-    snp_queue.join()
-
-  # close genome
-  genome_open.close()
+  sad_sketches = score_snps(seqnn_model, snps, sad_out,
+                            params_model['seq_length'],
+                            params_train['batch_size'], options)
 
   ###################################################
   # compute SAD distributions across variants
 
-  write_pct(sad_out, options.sad_stats)
+  # save sketches for multi collection
+  write_pct(sad_out, options.sad_stats, sad_sketches,
+            save_sketches=options.processes is not None)
   sad_out.close()
 
 
-def cluster_snps(snps, seq_len, center_pct):
-  """Cluster a sorted list of SNPs into regions that will satisfy
-     the required center_pct."""
-  valid_snp_distance = int(seq_len*center_pct)
-
-  snp_clusters = []
-  cluster_chr = None
-
-  for snp in snps:
-    if snp.chr == cluster_chr and snp.pos < cluster_pos0 + valid_snp_distance:
-      # append to latest cluster
-      snp_clusters[-1].add_snp(snp)
-    else:
-      # initialize new cluster
-      snp_clusters.append(SNPCluster())
-      snp_clusters[-1].add_snp(snp)
-      cluster_chr = snp.chr
-      cluster_pos0 = snp.pos
-
-  return snp_clusters
-
-
-class SNPCluster:
-  def __init__(self):
-    self.snps = []
-    self.chr = None
-    self.start = None
-    self.end = None
-
-  def add_snp(self, snp):
-    self.snps.append(snp)
-
-  def delimit(self, seq_len):
-    positions = [snp.pos for snp in self.snps]
-    pos_min = np.min(positions)
-    pos_max = np.max(positions)
-    pos_mid = (pos_min + pos_max) // 2
-
-    self.chr = self.snps[0].chr
-    self.start = pos_mid - seq_len//2
-    self.end = self.start + seq_len
-
-    for snp in self.snps:
-      snp.seq_pos = snp.pos - 1 - self.start
-
-  def get_1hots(self, genome_open):
-    seqs1_list = []
-
-    # extract reference
-    if self.start < 0:
-      ref_seq = 'N'*(-self.start) + genome_open.fetch(self.chr, 0, self.end).upper()
-    else:
-      ref_seq = genome_open.fetch(self.chr, self.start, self.end).upper()
-
-    # extend to full length
-    if len(ref_seq) < self.end - self.start:
-      ref_seq += 'N'*(self.end-self.start-len(ref_seq))
-
-    # verify reference alleles
-    for snp in self.snps:
-      ref_n = len(snp.ref_allele)
-      ref_snp = ref_seq[snp.seq_pos:snp.seq_pos+ref_n]
-      if snp.ref_allele != ref_snp:
-        print('ERROR: %s does not match reference %s' % (snp, ref_snp), file=sys.stderr)
-        exit(1)
-
-    # 1 hot code reference sequence
-    ref_1hot = dna_io.dna_1hot(ref_seq)
-    seqs1_list = [ref_1hot]
-
-    # make alternative 1 hot coded sequences
-    #  (assuming SNP is 1-based indexed)
-    for snp in self.snps:
-      alt_1hot = make_alt_1hot(ref_1hot, snp.seq_pos, snp.ref_allele, snp.alt_alleles[0])
-      seqs1_list.append(alt_1hot)
-
-    return seqs1_list
-
-
-def make_alt_1hot(ref_1hot, snp_seq_pos, ref_allele, alt_allele):
-  """Return alternative allele one hot coding."""
-  ref_n = len(ref_allele)
-  alt_n = len(alt_allele)
-
-  # copy reference
-  alt_1hot = np.copy(ref_1hot)
-
-  if alt_n == ref_n:
-    # SNP
-    dna_io.hot1_set(alt_1hot, snp_seq_pos, alt_allele)
-
-  elif ref_n > alt_n:
-    # deletion
-    delete_len = ref_n - alt_n
-    if (ref_allele[0] == alt_allele[0]):
-      dna_io.hot1_delete(alt_1hot, snp_seq_pos+1, delete_len)
-    else:
-      print('WARNING: Delection first nt does not match: %s %s' % (ref_allele, alt_allele), file=sys.stderr)    
-
-  else:
-    # insertion
-    if (ref_allele[0] == alt_allele[0]):
-      dna_io.hot1_insert(alt_1hot, snp_seq_pos+1, alt_allele[1:])
-    else:
-      print('WARNING: Insertion first nt does not match: %s %s' % (ref_allele, alt_allele), file=sys.stderr)    
-
-  return alt_1hot
-
-
 ################################################################################
 # __main__
 ################################################################################
@@ -51,6 +51,9 @@ def main():
   parser.add_option('-c', dest='center_pct',
       default=0.25, type='float',
       help='Require clustered SNPs lie in center region [Default: %default]')
+  parser.add_option('--ens_batch', dest='ensemble_batch',
+      default=None, type='int',
+      help='Stack ensemble copies into batched model calls of at most this many sequences, or 0 for one call [Default: %default]')
   parser.add_option('-f', dest='genome_fasta',
       default='%s/data/hg19.fa' % os.environ['BASENJIDIR'],
       help='Genome FASTA for sequences [Default: %default]')
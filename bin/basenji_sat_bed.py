@@ -17,7 +17,6 @@ from __future__ import print_function
 
 from optparse import OptionParser
 
-import gc
 import json
 import os
 import pdb
@@ -26,6 +25,7 @@ from queue import Queue
 import random
 import sys
 from threading import Thread
+import traceback
 
 import h5py
 import numpy as np
@@ -56,9 +56,18 @@ def main():
   parser.add_option('-d', dest='mut_down',
       default=0, type='int',
       help='Nucleotides downstream of center sequence to mutate [Default: %default]')
+  parser.add_option('--ens_batch', dest='ensemble_batch',
+      default=None, type='int',
+      help='Stack ensemble copies into batched model calls of at most this many sequences, or 0 for one call [Default: %default]')
   parser.add_option('-f', dest='genome_fasta',
       default=None,
       help='Genome FASTA for sequences [Default: %default]')
+  parser.add_option('--grad', dest='grad',
+      default=False, action='store_true',
+      help='Approximate mutation scores to first order from input gradients [Default: %default]')
+  parser.add_option('--grad_targets', dest='grad_targets',
+      default=16, type='int',
+      help='Targets per gradient backward pass, each on its own copy of the sequence batch [Default: %default]')
   parser.add_option('-l', dest='mut_len',
       default=0, type='int',
       help='Length of center sequence to mutate [Default: %default]')
@@ -129,6 +138,11 @@ def main():
 
   options.shifts = [int(shift) for shift in options.shifts.split(',')]
   options.sad_stats = [sad_stat.lower() for sad_stat in options.sad_stats.split(',')]
+  for sad_stat in options.sad_stats:
+    if sad_stat not in ['sum', 'center', 'scd']:
+      parser.error('Unrecognized summary statistic "%s"' % sad_stat)
+  if options.grad and 'scd' in options.sad_stats:
+    parser.error('SCD statistic has no gradient approximation')
 
   if options.mut_up > 0 or options.mut_down > 0:
     options.mut_len = options.mut_up + options.mut_down
@@ -159,7 +173,8 @@ def main():
   seqnn_model = seqnn.SeqNN(params_model)
   seqnn_model.restore(model_file)
   seqnn_model.build_slice(target_slice)
-  seqnn_model.build_ensemble(options.rc, options.shifts)
+  seqnn_model.build_ensemble(options.rc, options.shifts,
+                             options.ensemble_batch)
 
   num_targets = seqnn_model.num_targets()
 
@@ -183,8 +198,12 @@ def main():
   mut_start = seq_mid - options.mut_up
   mut_end = mut_start + options.mut_len
 
+  # 1 hot code mutagenized regions, shared by generator and scorer
+  seqs_mut_1hot = np.array([dna_io.dna_1hot(seq_dna[mut_start:mut_end]) for seq_dna in seqs_dna])
+  seqs_mut_1hot = seqs_mut_1hot.reshape((num_seqs, options.mut_len, 4))
+
   # make sequence generator
-  seqs_gen = satmut_gen(seqs_dna, mut_start, mut_end)
+  seqs_gen = satmut_gen(seqs_dna, seqs_mut_1hot, mut_start, params_train['batch_size'])
 
   #################################################################
   # setup output
@@ -193,8 +212,7 @@ def main():
   if os.path.isfile(scores_h5_file):
     os.remove(scores_h5_file)
   scores_h5 = h5py.File('%s/scores.h5' % options.out_dir, 'w')
-  scores_h5.create_dataset('seqs', dtype='bool',
-      shape=(num_seqs, options.mut_len, 4))
+  scores_h5.create_dataset('seqs', data=seqs_mut_1hot.astype('bool'))
   for sad_stat in options.sad_stats:
     scores_h5.create_dataset(sad_stat, dtype='float16',
         shape=(num_seqs, options.mut_len, 4, num_targets))
@@ -210,13 +228,10 @@ def main():
   scores_h5.create_dataset('end', data=seqs_end)
   scores_h5.create_dataset('strand', data=seqs_strand)
 
-  preds_per_seq = 1 + 3*options.mut_len
-
   score_threads = []
   score_queue = Queue()
   for i in range(1):
-    sw = ScoreWorker(score_queue, scores_h5, options.sad_stats,
-                     mut_start, mut_end)
+    sw = ScoreWorker(score_queue, scores_h5, options.sad_stats)
     sw.start()
     score_threads.append(sw)
 
@@ -231,6 +246,13 @@ def main():
   else:
     center_end = center_start + 1
 
+  if options.grad:
+    satmut_grad(seqnn_model, seqs_dna, seqs_mut_1hot, mut_start, scores_h5,
+                options.sad_stats, (center_start, center_end),
+                params_train['batch_size'], options.grad_targets)
+    scores_h5.close()
+    return
+
   # initialize predictions stream
   preds_stream = stream.PredStreamGen(seqnn_model, seqs_gen, params['train']['batch_size'])
 
@@ -240,67 +262,151 @@ def main():
   for si in range(num_seqs):
     print('Predicting %d' % si, flush=True)
 
-    # collect sequence predictions
-    seq_preds_sum = []
-    seq_preds_center = []
-    seq_preds_scd = []
-    preds_mut0 = preds_stream[pi]
-    for spi in range(preds_per_seq):
-      preds_mut = preds_stream[pi]
-      preds_sum = preds_mut.sum(axis=0)
-      seq_preds_sum.append(preds_sum)
-      if 'center' in options.sad_stats:
-        preds_center = preds_mut[center_start:center_end,:].sum(axis=0)
-        seq_preds_center.append(preds_center)
-      if 'scd' in options.sad_stats:
-        preds_scd = np.sqrt(((preds_mut-preds_mut0)**2).sum(axis=0))
-        seq_preds_scd.append(preds_scd)
-      pi += 1
-    seq_preds_sum = np.array(seq_preds_sum)
-    seq_preds_center = np.array(seq_preds_center)
-    seq_preds_scd = np.array(seq_preds_scd)
+    # summarize reference and mutant predictions across positions
+    seq_mut_1hot = seqs_mut_1hot[si]
+    preds_per_seq = 1 + int((seq_mut_1hot == 0).sum())
+    seq_preds = (preds_stream[pi+spi] for spi in range(preds_per_seq))
+    seq_pred_stats = satmut_stats(seq_preds, options.sad_stats,
+                                  (center_start, center_end),
+                                  params_train['batch_size'])
+    seq_preds_sum = seq_pred_stats['sum']
+    pi += preds_per_seq
 
     # wait for previous to finish
     score_queue.join()
+    check_workers(score_threads)
 
     # queue sequence for scoring
-    seq_pred_stats = (seq_preds_sum, seq_preds_center, seq_preds_scd)
-    score_queue.put((seqs_dna[si], seq_pred_stats, si))
+    score_queue.put((seq_mut_1hot, seq_pred_stats, si))
     
     # queue sequence for plotting
     if options.plots:
       plot_queue.put((seqs_dna[si], seq_preds_sum, si))
 
-    gc.collect()
-
   # finish queue
   print('Waiting for threads to finish.', flush=True)
   score_queue.join()
+  check_workers(score_threads)
 
   # close output HDF5
   scores_h5.close()
 
 
-def satmut_gen(seqs_dna, mut_start, mut_end):
+def check_workers(workers):
+  """Raise the first error recorded by a worker thread."""
+  for worker in workers:
+    if worker.error is not None:
+      raise worker.error
+
+
+def satmut_gen(seqs_dna, seqs_mut_1hot, mut_start, batch_size=32):
   """Construct generator for 1 hot encoded saturation
-     mutagenesis DNA sequences."""
+     mutagenesis DNA sequences, building mutants in batches."""
 
-  for seq_dna in seqs_dna:
-    # 1 hot code DNA
+  for si, seq_dna in enumerate(seqs_dna):
+    # 1 hot code DNA, matching the mutagenized region coding
     seq_1hot = dna_io.dna_1hot(seq_dna)
+    seq_mut_len = seqs_mut_1hot[si].shape[0]
+    seq_1hot[mut_start:mut_start+seq_mut_len] = seqs_mut_1hot[si]
     yield seq_1hot
 
-    # for mutation positions
-    for mi in range(mut_start, mut_end):
-      # for each nucleotide
-      for ni in range(4):
-        # if non-reference
-        if seq_1hot[mi,ni] == 0:
-          # copy and modify
-          seq_mut_1hot = np.copy(seq_1hot)
-          seq_mut_1hot[mi,:] = 0
-          seq_mut_1hot[mi,ni] = 1
-          yield seq_mut_1hot
+    # non-reference nucleotides, by position
+    mut_pos, mut_nt = np.nonzero(seqs_mut_1hot[si] == 0)
+    mut_pos += mut_start
+
+    for bi in range(0, len(mut_pos), batch_size):
+      bj = bi + batch_size
+      muts_1hot = satmut_1hot(seq_1hot, mut_pos[bi:bj], mut_nt[bi:bj])
+      for mut_1hot in muts_1hot:
+        yield mut_1hot
+
+
+def satmut_grad(seqnn_model, seqs_dna, seqs_mut_1hot, mut_start, scores_h5,
+                sad_stats, center_slice, batch_size, group_size=16):
+  """Write first order mutation scores from input gradients.
+
+  A mutation's effect on a stat summed across positions is approximated
+  by the gradient difference between the mutant and reference nucleotide,
+  which after normalizing positions to mean zero, as in the exact scores,
+  is the gradient minus its mean across nucleotides."""
+  num_seqs, mut_len, _ = seqs_mut_1hot.shape
+  stat_slices = {'sum': None, 'center': slice(*center_slice)}
+
+  for si in range(0, num_seqs, batch_size):
+    print('Predicting %d' % si, flush=True)
+    sj = min(si + batch_size, num_seqs)
+
+    # 1 hot code DNA, matching the mutagenized region coding
+    seqs_1hot = dna_io.dnas_1hot(seqs_dna[si:sj])
+    seqs_1hot[:,mut_start:mut_start+mut_len] = seqs_mut_1hot[si:sj]
+
+    for sad_stat in sad_stats:
+      # [seqs, mut_len, 4, targets]
+      seqs_grads = seqnn_model.gradients(seqs_1hot,
+                                         pos_slice=stat_slices[sad_stat],
+                                         seq_slice=slice(mut_start, mut_start+mut_len),
+                                         group_size=group_size,
+                                         batch_size=batch_size)
+
+      # normalize positions
+      seqs_grads -= seqs_grads.mean(axis=2, keepdims=True)
+
+      # write to HDF5
+      scores_h5[sad_stat][si:sj] = seqs_grads.astype('float16')
+
+
+def satmut_stats(seq_preds, sad_stats, center_slice, block_size=8):
+  """Summarize a sequence's reference and mutant predictions across
+     positions as they stream, holding at most block_size full
+     predictions at a time.
+
+  Args:
+    seq_preds: iterable of [length, targets] predictions, reference first.
+    sad_stats: stats to compute, beyond the sum.
+    center_slice: (start, end) positions summed for 'center'.
+    block_size: predictions summarized together.
+
+  Returns:
+    dict mapping 'sum' and each stat to [predictions, targets] arrays.
+  """
+  center_start, center_end = center_slice
+  stat_blocks = {'sum':[]}
+  for sad_stat in sad_stats:
+    stat_blocks[sad_stat] = []
+
+  ref_preds = None
+  preds_block = []
+
+  def summarize_block():
+    preds = np.array(preds_block)
+    stat_blocks['sum'].append(preds.sum(axis=1))
+    if 'center' in sad_stats:
+      stat_blocks['center'].append(preds[:,center_start:center_end].sum(axis=1))
+    if 'scd' in sad_stats:
+      stat_blocks['scd'].append(np.sqrt(((preds - ref_preds)**2).sum(axis=1)))
+    preds_block.clear()
+
+  for preds in seq_preds:
+    if ref_preds is None:
+      ref_preds = preds
+    preds_block.append(preds)
+    if len(preds_block) == block_size:
+      summarize_block()
+  if preds_block:
+    summarize_block()
+
+  return {stat:np.concatenate(blocks) for stat, blocks in stat_blocks.items()}
+
+
+def satmut_1hot(seq_1hot, mut_pos, mut_nt):
+  """Return copies of seq_1hot with each position mut_pos
+     changed to nucleotide mut_nt."""
+  num_muts = len(mut_pos)
+  muts_1hot = np.repeat(seq_1hot[np.newaxis], num_muts, axis=0)
+  mut_i = np.arange(num_muts)
+  muts_1hot[mut_i,mut_pos,:] = 0
+  muts_1hot[mut_i,mut_pos,mut_nt] = 1
+  return muts_1hot
 
 
 class PlotWorker(Thread):
@@ -323,74 +429,44 @@ class PlotWorker(Thread):
 
 class ScoreWorker(Thread):
   """Compute summary statistics and write to HDF."""
-  def __init__(self, score_queue, scores_h5, sad_stats, mut_start, mut_end):
+  def __init__(self, score_queue, scores_h5, sad_stats):
     Thread.__init__(self)
     self.queue = score_queue
     self.daemon = True
     self.scores_h5 = scores_h5
     self.sad_stats = sad_stats
-    self.mut_start = mut_start
-    self.mut_end = mut_end
+    self.error = None
 
   def run(self):
     while True:
-      try:
-        # unload predictions
-        seq_dna, seq_pred_stats, si = self.queue.get()
-        seq_preds_sum, seq_preds_center, seq_preds_scd = seq_pred_stats
-        print('Writing %d' % si, flush=True)
-
-        # seq_preds_sum is (1 + 3*mut_len) x (num_targets)
-        num_preds, num_targets = seq_preds_sum.shape
-        mut_len = self.mut_end - self.mut_start
-
-        # one hot code mutagenized DNA
-        seq_dna_mut = seq_dna[self.mut_start:self.mut_end]
-        seq_1hot_mut = dna_io.dna_1hot(seq_dna_mut)
+      # unload predictions
+      seq_mut_1hot, seq_pred_stats, si = self.queue.get()
+      print('Writing %d' % si, flush=True)
 
-        # write to HDF5
-        self.scores_h5['seqs'][si,:,:] = seq_1hot_mut
+      try:
+        # mutations were predicted in position, nucleotide order
+        mut_mask = (seq_mut_1hot == 0)
 
         for sad_stat in self.sad_stats:
-          # initialize scores
-          seq_scores = np.zeros((mut_len, 4, num_targets), dtype='float32')
-
-          # summary stat
-          if sad_stat == 'sum':
-            seq_preds_stat = seq_preds_sum
-          elif sad_stat == 'center':
-            seq_preds_stat = seq_preds_center
-          elif sad_stat == 'scd':
-            seq_preds_stat = seq_preds_scd
-          else:
-            print('Unrecognized summary statistic "%s"' % options.sad_stat)
-            exit(1)
-
-          # predictions index (starting at first mutagenesis)
-          pi = 1
-
-          # for each mutated position
-          for mi in range(mut_len):
-            # for each nucleotide
-            for ni in range(4):
-              if seq_1hot_mut[mi,ni]:
-                # reference score
-                seq_scores[mi,ni,:] = seq_preds_stat[0,:]
-              else:
-                # mutation score
-                seq_scores[mi,ni,:] = seq_preds_stat[pi,:]
-                pi += 1
+          # seq_preds_stat is (1 + num_muts) x (num_targets)
+          seq_preds_stat = seq_pred_stats[sad_stat]
+
+          # fill reference scores, then scatter mutation scores
+          mut_len = seq_mut_1hot.shape[0]
+          seq_scores = np.tile(seq_preds_stat[0], (mut_len, 4, 1))
+          seq_scores[mut_mask] = seq_preds_stat[1:]
 
           # normalize positions
-          if sad_stat != 'sqdiff':
-            seq_scores -= seq_scores.mean(axis=1, keepdims=True)
+          seq_scores -= seq_scores.mean(axis=1, keepdims=True)
 
           # write to HDF5
           self.scores_h5[sad_stat][si,:,:,:] = seq_scores.astype('float16')
 
-      except:
+      except Exception as e:
         # communicate error
         print('ERROR: Sequence %d failed' % si, file=sys.stderr, flush=True)
+        traceback.print_exc()
+        self.error = e
 
       # communicate finished task
       self.queue.task_done()
@@ -43,9 +43,18 @@ def main():
   parser = OptionParser(usage)
 
   # basenji_sat_bed.py options
+  parser.add_option('--ens_batch', dest='ensemble_batch',
+      default=None, type='int',
+      help='Stack ensemble copies into batched model calls of at most this many sequences, or 0 for one call [Default: %default]')
   parser.add_option('-f', dest='genome_fasta',
       default=None,
       help='Genome FASTA for sequences [Default: %default]')
+  parser.add_option('--grad', dest='grad',
+      default=False, action='store_true',
+      help='Approximate mutation scores to first order from input gradients [Default: %default]')
+  parser.add_option('--grad_targets', dest='grad_targets',
+      default=16, type='int',
+      help='Targets per gradient backward pass, each on its own copy of the sequence batch [Default: %default]')
   parser.add_option('-l', dest='mut_len',
       default=200, type='int',
       help='Length of center sequence to mutate [Default: %default]')
@@ -37,6 +37,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 from basenji import dataset
+from basenji import metrics
 from basenji import plots
 from basenji import seqnn
 
@@ -57,9 +58,15 @@ def main():
   parser = OptionParser(usage)
   parser.add_option('--ai', dest='accuracy_indexes',
       help='Comma-separated list of target indexes to make accuracy scatter plots.')
+  parser.add_option('--ens_batch', dest='ensemble_batch',
+      default=None, type='int',
+      help='Stack ensemble copies into batched model calls of at most this many sequences, or 0 for one call [Default: %default]')
   parser.add_option('--mc', dest='mc_n',
       default=0, type='int',
       help='Monte carlo test iterations [Default: %default]')
+  parser.add_option('--parallel', dest='parallel_read',
+      default=False, action='store_true',
+      help='Read and parse TFRecords in parallel, preserving order [Default: %default]')
   parser.add_option('--peak','--peaks', dest='peaks',
       default=False, action='store_true',
       help='Compute expensive peak accuracy [Default: %default]')
@@ -81,6 +88,9 @@ def main():
   parser.add_option('--split', dest='split_label',
       default='test',
       help='Dataset split label for eg TFR pattern [Default: %default]')
+  parser.add_option('--stream', dest='stream',
+      default=False, action='store_true',
+      help='Evaluate, save, and call peaks in a single pass with bounded memory [Default: %default]')
   parser.add_option('--tfr', dest='tfr_pattern',
       default=None,
       help='TFR pattern string appended to data_dir/tfrecords for subsetting [Default: %default]')
@@ -118,20 +128,33 @@ def main():
     split_label=options.split_label,
     batch_size=params_train['batch_size'],
     mode=tf.estimator.ModeKeys.EVAL,
-    tfr_pattern=options.tfr_pattern)
+    tfr_pattern=options.tfr_pattern,
+    parallel_read=options.parallel_read)
 
   # initialize model
   seqnn_model = seqnn.SeqNN(params_model)
   seqnn_model.restore(model_file)
-  seqnn_model.build_ensemble(options.rc, options.shifts)
+  seqnn_model.build_ensemble(options.rc, options.shifts,
+                             options.ensemble_batch)
 
   #######################################################
   # evaluate
 
   eval_loss = params_train.get('loss', 'poisson')
 
-  # evaluate
-  test_loss, test_metric1, test_metric2 = seqnn_model.evaluate(eval_data, loss=eval_loss)
+  if options.accuracy_indexes is not None:
+    accuracy_indexes = [int(ti) for ti in options.accuracy_indexes.split(',')]
+  else:
+    accuracy_indexes = []
+
+  if options.stream:
+    # evaluate, save, and accumulate peak/plot statistics in one pass
+    test_loss, test_metric1, test_metric2, stream_peaks, stream_samples = \
+      stream_test(seqnn_model, eval_data, eval_loss, accuracy_indexes,
+                  options.out_dir, options.save, options.peaks)
+  else:
+    # evaluate
+    test_loss, test_metric1, test_metric2 = seqnn_model.evaluate(eval_data, loss=eval_loss)
 
   # print summary statistics
   print('\nTest Loss:         %7.5f' % test_loss)
@@ -168,14 +191,23 @@ def main():
   #######################################################
   # predict?
 
-  if options.save or options.peaks or options.accuracy_indexes is not None:
+  predict = options.save or options.peaks or options.accuracy_indexes is not None
+  if predict and not options.stream:
     # compute predictions
     test_preds = seqnn_model.predict(eval_data).astype('float16')
 
     # read targets
-    test_targets = eval_data.numpy(return_inputs=False)
-
-  if options.save:
+    if options.save or options.peaks:
+      test_targets = eval_data.numpy(return_inputs=False)
+      target_cols = np.arange(test_targets.shape[-1])
+    else:
+      # accuracy plots need only their targets
+      test_targets = eval_data.numpy(return_inputs=False,
+                                     target_slice=accuracy_indexes)
+      target_cols = np.zeros(eval_data.num_targets, dtype='int')
+      target_cols[accuracy_indexes] = np.arange(len(accuracy_indexes))
+
+  if options.save and not options.stream:
     preds_h5 = h5py.File('%s/preds.h5' % options.out_dir, 'w')
     preds_h5.create_dataset('preds', data=test_preds)
     preds_h5.close()
@@ -189,15 +221,16 @@ def main():
 
   if options.peaks:
     peaks_out_file = '%s/peaks.txt' % options.out_dir
-    test_peaks(test_preds, test_targets, peaks_out_file)
+    if options.stream:
+      stream_peaks.write(peaks_out_file)
+    else:
+      test_peaks(test_preds, test_targets, peaks_out_file)
 
 
   #######################################################
   # accuracy plots
 
   if options.accuracy_indexes is not None:
-    accuracy_indexes = [int(ti) for ti in options.accuracy_indexes.split(',')]
-
     if not os.path.isdir('%s/scatter' % options.out_dir):
       os.mkdir('%s/scatter' % options.out_dir)
 
@@ -211,19 +244,24 @@ def main():
       os.mkdir('%s/pr' % options.out_dir)
 
     for ti in accuracy_indexes:
-      test_targets_ti = test_targets[:, :, ti]
-
       ############################################
       # scatter
 
-      # sample every few bins (adjust to plot the # points I want)
-      ds_indexes = np.arange(0, test_preds.shape[1], 8)
+      if options.stream:
+        # uniform sample of the strided bins
+        test_targets_ti_flat, test_preds_ti_flat = stream_samples[ti].values()
 
-      # subset and flatten
-      test_targets_ti_flat = test_targets_ti[:, ds_indexes].flatten(
-      ).astype('float32')
-      test_preds_ti_flat = test_preds[:, ds_indexes, ti].flatten().astype(
-          'float32')
+      else:
+        test_targets_ti = test_targets[:, :, target_cols[ti]]
+
+        # sample every few bins (adjust to plot the # points I want)
+        ds_indexes = np.arange(0, test_preds.shape[1], 8)
+
+        # subset and flatten
+        test_targets_ti_flat = test_targets_ti[:, ds_indexes].flatten(
+        ).astype('float32')
+        test_preds_ti_flat = test_preds[:, ds_indexes, ti].flatten().astype(
+            'float32')
 
       # take log2
       test_targets_ti_log = np.log2(test_targets_ti_flat + 1)
@@ -309,6 +347,267 @@ def main():
       plt.close()
 
 
+def stream_test(seqnn_model, eval_data, eval_loss, accuracy_indexes,
+                out_dir, save=False, peaks=False, sample_size=100000):
+  """Evaluate the model in a single pass over eval_data, holding one
+     batch of predictions in memory at a time.
+
+  Args:
+    seqnn_model: SeqNN with restored weights and optional ensemble.
+    eval_data: SeqDataset to evaluate.
+    eval_loss: Loss name, where 'bce' switches to AUROC/AUPRC metrics.
+    accuracy_indexes: Target indexes to sample for accuracy plots.
+    out_dir: Output directory for preds.h5/targets.h5.
+    save: Append predictions and targets to chunked HDF5 datasets.
+    peaks: Accumulate binned peak call statistics.
+    sample_size: Points sampled per accuracy plot target.
+
+  Returns:
+    loss, metric1, metric2, StreamPeaks or None, dict of StreamSample.
+  """
+  if seqnn_model.ensemble is None:
+    model = seqnn_model.models[0]
+  else:
+    model = seqnn_model.ensemble
+  target_length, num_targets = model.output_shape[-2:]
+
+  # same metrics as SeqNN.evaluate
+  if eval_loss == 'bce':
+    metric1 = metrics.SeqAUC(curve='ROC', summarize=False)
+    metric2 = metrics.SeqAUC(curve='PR', summarize=False)
+  else:
+    metric1 = metrics.PearsonR(num_targets, summarize=False)
+    metric2 = metrics.R2(num_targets, summarize=False)
+  loss_fn = tf.keras.losses.get(eval_loss)
+
+  @tf.function
+  def eval_step(x, y):
+    pred = model(x, training=False)
+    loss = tf.reduce_mean(loss_fn(y, pred))
+    if model.losses:
+      loss += tf.add_n(model.losses)
+    metric1.update_state(y, pred)
+    metric2.update_state(y, pred)
+    return pred, loss
+
+  if save:
+    preds_h5 = h5py.File('%s/preds.h5' % out_dir, 'w')
+    preds_dset = h5_stream_dataset(preds_h5, 'preds', target_length, num_targets)
+    targets_h5 = h5py.File('%s/targets.h5' % out_dir, 'w')
+    targets_dset = h5_stream_dataset(targets_h5, 'targets', target_length, num_targets)
+
+  stream_peaks = StreamPeaks(num_targets) if peaks else None
+  stream_samples = {ti:StreamSample(sample_size) for ti in accuracy_indexes}
+
+  # sample every few bins to decrease correlations
+  ds_indexes = np.arange(0, target_length, 8)
+
+  loss_sum = 0
+  num_seqs = 0
+  for x, y in eval_data.dataset:
+    pred, loss = eval_step(x, y)
+    batch_size = y.shape[0]
+    loss_sum += loss.numpy() * batch_size
+    num_seqs += batch_size
+
+    pred = pred.numpy().astype('float16')
+    y = y.numpy().astype('float16')
+
+    if save:
+      h5_append(preds_dset, pred)
+      h5_append(targets_dset, y)
+
+    if peaks or accuracy_indexes:
+      pred_ds = pred[:,ds_indexes].astype('float32')
+      y_ds = y[:,ds_indexes].astype('float32')
+      if peaks:
+        stream_peaks.update(y_ds, pred_ds)
+      for ti in accuracy_indexes:
+        stream_samples[ti].update(y_ds[:,:,ti].flatten(), pred_ds[:,:,ti].flatten())
+
+  if save:
+    preds_h5.close()
+    targets_h5.close()
+
+  test_loss = loss_sum / num_seqs
+  return test_loss, metric1.result().numpy(), metric2.result().numpy(), \
+    stream_peaks, stream_samples
+
+
+def h5_stream_dataset(h5_open, name, target_length, num_targets,
+                      chunk_values=2**19):
+  """Create an empty float16 dataset that grows one batch at a time,
+     chunked by sequence and blocks of targets."""
+  chunk_targets = max(1, min(num_targets, chunk_values // target_length))
+  return h5_open.create_dataset(name, dtype='float16',
+    shape=(0, target_length, num_targets),
+    maxshape=(None, target_length, num_targets),
+    chunks=(1, target_length, chunk_targets))
+
+
+def h5_append(dset, values):
+  """Append values along the first axis of a resizable dataset."""
+  n = dset.shape[0]
+  dset.resize(n + values.shape[0], axis=0)
+  dset[n:] = values
+
+
+class StreamPeaks:
+  """Peak call accuracy statistics accumulated batch by batch.
+
+  test_peaks calls peaks from Poisson p-values of rounded targets against
+  the target mean and ranks predictions at those calls. Here, each target
+  counts its rounded target values exactly, up to max_value, so that the
+  same Benjamini-Hochberg calls follow per distinct value at the end. A
+  joint histogram of target value bin (exact up to max_exact,
+  bins_per_octave log2-spaced beyond) and log2 prediction bin receives
+  each value's peak fraction for binned AUROC/AUPRC. Memory depends on
+  the number of targets only, and each batch is counted in blocks of
+  targets spanning about block_bins counts.
+  """
+  def __init__(self, num_targets, max_exact=32, bins_per_octave=4,
+               max_value=4096, pred_bins=128, pred_log2_max=16,
+               block_bins=2**20):
+    self.num_targets = num_targets
+    self.block_bins = block_bins
+    self.max_value = max_value
+    log_edges = 2**np.arange(np.log2(max_exact), np.log2(max_value), 1/bins_per_octave)
+    self.target_edges = np.unique(np.concatenate([np.arange(max_exact),
+                                                  np.floor(log_edges)])).astype('int64')
+    self.value_bins = np.searchsorted(self.target_edges, np.arange(max_value+1),
+                                      side='right') - 1
+    self.pred_bins = pred_bins
+    self.pred_log2_max = pred_log2_max
+    self.hist_size = len(self.target_edges) * pred_bins
+
+    self.hist = np.zeros((num_targets, self.hist_size), dtype='uint32')
+    self.value_counts = np.zeros((num_targets, 0), dtype='uint32')
+    self.target_sum = np.zeros(num_targets)
+    self.count = 0
+
+  def update(self, targets, preds):
+    """Add [batch, length, targets] arrays."""
+    targets = targets.reshape((-1, self.num_targets))
+    preds = preds.reshape((-1, self.num_targets))
+    self.target_sum += targets.sum(axis=0, dtype='float64')
+    self.count += targets.shape[0]
+
+    # exact value counts, widened to a power of two as values grow
+    values = np.clip(np.round(targets), 0, self.max_value).astype('int64')
+    values_width = int(values.max()) + 1
+    if values_width > self.value_counts.shape[1]:
+      values_width = min(self.max_value+1, max(64, 2**int(np.ceil(np.log2(values_width)))))
+      values_pad = values_width - self.value_counts.shape[1]
+      self.value_counts = np.pad(self.value_counts, ((0,0), (0,values_pad)))
+    self.add_counts(self.value_counts, values)
+
+    tbin = self.value_bins[values]
+    pbin = np.log2(np.maximum(preds, 0) + 1) * self.pred_bins / self.pred_log2_max
+    pbin = np.clip(pbin.astype('int64'), 0, self.pred_bins-1)
+    self.add_counts(self.hist, tbin*self.pred_bins + pbin)
+
+  def add_counts(self, counts, index):
+    """Count [rows, targets] index into [targets, width] counts, in
+       blocks of targets, so that no batch allocates counts for all."""
+    width = counts.shape[1]
+    block_targets = max(1, self.block_bins // width)
+    for ti in range(0, self.num_targets, block_targets):
+      tj = min(ti + block_targets, self.num_targets)
+      block_index = index[:,ti:tj] + np.arange(tj-ti)*width
+      block_counts = np.bincount(block_index.ravel(), minlength=(tj-ti)*width)
+      counts[ti:tj] += block_counts.reshape((tj-ti, width)).astype('uint32')
+
+  def result(self, ti):
+    """Return peak count, AUROC, and AUPRC for target ti."""
+    m = self.count
+    value_counts = self.value_counts[ti].astype('int64')
+    values = np.arange(len(value_counts))
+
+    # p-values by distinct value, ranked in descending value order
+    target_lambda = self.target_sum[ti] / m
+    pvals = 1 - poisson.cdf(values[::-1] - 1, mu=target_lambda)
+    group_n = value_counts[::-1]
+    rank_end = np.cumsum(group_n)
+    rank_start = rank_end - group_n
+
+    # ben_hoch q-values (p*m)//rank fall below 0.01 for rank > p*m
+    peak_n = rank_end - np.maximum(rank_start, np.floor(pvals*m))
+    peak_n = np.clip(peak_n, 0, group_n)[::-1]
+    num_peaks = int(peak_n.sum())
+
+    # spread value peak fractions over the joint histogram's target bins
+    num_tbins = len(self.target_edges)
+    value_bins = self.value_bins[values]
+    tbin_peaks = np.bincount(value_bins, weights=peak_n, minlength=num_tbins)
+    tbin_n = np.bincount(value_bins, weights=value_counts, minlength=num_tbins)
+    peak_frac = tbin_peaks / np.maximum(tbin_n, 1)
+
+    hist = self.hist[ti].reshape((num_tbins, self.pred_bins))
+    pos_hist = (hist * peak_frac[:,np.newaxis]).sum(axis=0)
+    neg_hist = hist.sum(axis=0) - pos_hist
+
+    if num_peaks == 0:
+      return num_peaks, 0.5, 0
+    else:
+      auroc, auprc = hist_auc(pos_hist, neg_hist)
+      return num_peaks, auroc, auprc
+
+  def write(self, peaks_out_file):
+    aurocs = []
+    auprcs = []
+
+    peaks_out = open(peaks_out_file, 'w')
+    for ti in range(self.num_targets):
+      num_peaks, auroc, auprc = self.result(ti)
+      aurocs.append(auroc)
+      auprcs.append(auprc)
+      print('%4d  %6d  %.5f  %.5f' % (ti, num_peaks, auroc, auprc),
+            file=peaks_out)
+    peaks_out.close()
+
+    print('Test AUROC:     %7.5f' % np.mean(aurocs))
+    print('Test AUPRC:     %7.5f' % np.mean(auprcs))
+
+
+def hist_auc(pos_hist, neg_hist):
+  """Compute AUROC and average precision from positive and negative
+     prediction histograms, treating each bin as one threshold."""
+  tp = np.cumsum(pos_hist[::-1])
+  fp = np.cumsum(neg_hist[::-1])
+  tpr = np.concatenate([[0], tp / tp[-1]])
+  fpr = np.concatenate([[0], fp / max(fp[-1], 1)])
+  auroc = np.trapz(tpr, fpr)
+
+  precision = tp / np.maximum(tp + fp, 1)
+  auprc = np.sum(np.diff(tpr) * precision)
+  return auroc, auprc
+
+
+class StreamSample:
+  """Uniform random sample of (target, prediction) pairs from a stream,
+     kept as the pairs with the smallest random keys."""
+  def __init__(self, sample_size):
+    self.sample_size = sample_size
+    self.keys = np.zeros(0)
+    self.targets = np.zeros(0, dtype='float32')
+    self.preds = np.zeros(0, dtype='float32')
+
+  def update(self, targets, preds):
+    keys = np.random.uniform(size=len(targets))
+    self.keys = np.concatenate([self.keys, keys])
+    self.targets = np.concatenate([self.targets, targets])
+    self.preds = np.concatenate([self.preds, preds])
+
+    if len(self.keys) > self.sample_size:
+      keep = np.argpartition(self.keys, self.sample_size)[:self.sample_size]
+      self.keys = self.keys[keep]
+      self.targets = self.targets[keep]
+      self.preds = self.preds[keep]
+
+  def values(self):
+    return self.targets, self.preds
+
+
 def ben_hoch(p_values):
   """ Convert the given p-values to q-values using Benjamini-Hochberg FDR. """
   m = len(p_values)
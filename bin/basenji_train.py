@@ -79,6 +79,9 @@ def main():
   params_model = params['model']
   params_train = params['train']
 
+  # set precision policy, before building the model
+  trainer.set_precision(params_train)
+
   # load train data
   train_data = dataset.SeqDataset(data_dir,
     split_label='train',
@@ -92,7 +95,9 @@ def main():
     split_label='valid',
     batch_size=params_train['batch_size'],
     mode=tf.estimator.ModeKeys.EVAL,
-    tfr_pattern=options.tfr_eval_pattern)
+    tfr_pattern=options.tfr_eval_pattern,
+    parallel_read=params_train.get('eval_parallel', False),
+    cache=params_train.get('eval_cache', None))
 
   if params_train.get('num_gpu', 1) == 1:
     ########################################
@@ -18,6 +18,7 @@ from optparse import OptionParser
 
 import json
 import os
+import shutil
 import sys
 import time
 
@@ -75,24 +76,27 @@ def main():
   params_model = params['model']
   params_train = params['train']
 
+  # set precision policy, before building the model
+  trainer.set_precision(params_train)
+
   # read datasets
   train_data = []
   eval_data = []
 
   for data_dir in data_dirs:
     # load train data
-    train_data = dataset.SeqDataset(data_dir,
+    train_data.append(dataset.SeqDataset(data_dir,
     split_label='train',
     batch_size=params_train['batch_size'],
     mode=tf.estimator.ModeKeys.TRAIN,
-    tfr_pattern=options.tfr_train_pattern)
+    tfr_pattern=options.tfr_train_pattern))
 
     # load eval data
-    eval_data = dataset.SeqDataset(data_dir,
+    eval_data.append(dataset.SeqDataset(data_dir,
     split_label='valid',
     batch_size=params_train['batch_size'],
     mode=tf.estimator.ModeKeys.EVAL,
-    tfr_pattern=options.tfr_eval_pattern)
+    tfr_pattern=options.tfr_eval_pattern))
 
   if params_train.get('num_gpu', 1) == 1:
     ########################################
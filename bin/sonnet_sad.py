@@ -26,12 +26,12 @@ import time
 import h5py
 import numpy as np
 import pandas as pd
-import pysam
 import tensorflow as tf
 if tf.__version__[0] == '1':
   tf.compat.v1.enable_eager_execution()
 
 from basenji import dna_io
+from basenji import genome
 from basenji import seqnn
 from basenji import vcf as bvcf
 from basenji_sad import write_snp
@@ -169,12 +169,8 @@ def main():
 
   # filter for worker SNPs
   if options.processes is not None:
-    # determine boundaries
-    num_snps = bvcf.vcf_count(vcf_file)
-    worker_bounds = np.linspace(0, num_snps, options.processes+1, dtype='int')
-
-    # read SNPs form VCF
-    snps = bvcf.vcf_snps(vcf_file, start_i=worker_bounds[worker_index], end_i=worker_bounds[worker_index+1])
+    # read worker's part of SNPs from VCF
+    snps = bvcf.vcf_snps(vcf_file, part_i=worker_index, num_parts=options.processes)
 
   else:
     # read SNPs form VCF
@@ -182,8 +178,8 @@ def main():
 
   num_snps = len(snps)
 
-  # open genome FASTA
-  genome_open = pysam.Fastafile(options.genome_fasta)
+  # open genome FASTA, or its cache
+  genome_open = genome.open_fasta(options.genome_fasta)
 
   # create SNP sequence generator
   def snp_gen():
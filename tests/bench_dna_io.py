@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import random
+import time
+
+import numpy as np
+
+import basenji.dna_io
+
+################################################################################
+# bench_dna_io.py
+#
+# Compare per-megabase throughput of the vectorized one hot coding in
+# basenji.dna_io against the original per-nucleotide loops.
+################################################################################
+
+
+################################################################################
+# main
+################################################################################
+def main():
+  usage = 'usage: %prog [options]'
+  parser = OptionParser(usage)
+  parser.add_option('-l', dest='seq_length',
+      default=131072, type='int',
+      help='Sequence length [Default: %default]')
+  parser.add_option('-n', dest='num_seqs',
+      default=8, type='int',
+      help='Number of sequences [Default: %default]')
+  parser.add_option('--nfrac', dest='n_frac',
+      default=0.01, type='float',
+      help='Fraction of N nucleotides [Default: %default]')
+  (options, args) = parser.parse_args()
+
+  random.seed(44)
+  nts = np.array(list('ACGTN'))
+  nt_probs = np.array([1,1,1,1,0]) * (1-options.n_frac) / 4
+  nt_probs[-1] = options.n_frac
+  seqs = [''.join(np.random.choice(nts, size=options.seq_length, p=nt_probs))
+          for si in range(options.num_seqs)]
+  mb = options.num_seqs * options.seq_length / 1e6
+
+  benchmarks = [
+    ('dna_1hot', lambda: [dna_1hot_loop(seq) for seq in seqs],
+                 lambda: [basenji.dna_io.dna_1hot(seq) for seq in seqs]),
+    ('dnas_1hot', lambda: np.array([dna_1hot_loop(seq) for seq in seqs]),
+                  lambda: basenji.dna_io.dnas_1hot(seqs)),
+    ('dna_1hot_index', lambda: [dna_1hot_index_loop(seq) for seq in seqs],
+                       lambda: [basenji.dna_io.dna_1hot_index(seq) for seq in seqs]),
+  ]
+
+  seqs_1hot = basenji.dna_io.dnas_1hot(seqs)
+  benchmarks.append(('hot1_dna', lambda: hot1_dna_loop(seqs_1hot),
+                     lambda: basenji.dna_io.hot1_dna(seqs_1hot)))
+
+  print('%-16s  %10s  %10s  %8s' % ('function', 'loop Mb/s', 'vec Mb/s', 'speedup'))
+  for name, loop_fn, vec_fn in benchmarks:
+    loop_time = time_fn(loop_fn)
+    vec_time = time_fn(vec_fn)
+    print('%-16s  %10.3f  %10.1f  %7.0fx' % \
+      (name, mb/loop_time, mb/vec_time, loop_time/vec_time))
+
+
+def time_fn(fn, reps=3):
+  """Return the minimum wall time of several calls."""
+  times = []
+  for ri in range(reps):
+    t0 = time.time()
+    fn()
+    times.append(time.time() - t0)
+  return min(times)
+
+
+################################################################################
+# original per-nucleotide implementations
+################################################################################
+def dna_1hot_loop(seq):
+  seq = seq.upper()
+  seq_code = np.zeros((len(seq), 4), dtype='bool')
+  for i in range(len(seq)):
+    nt = seq[i]
+    if nt == 'A':
+      seq_code[i, 0] = 1
+    elif nt == 'C':
+      seq_code[i, 1] = 1
+    elif nt == 'G':
+      seq_code[i, 2] = 1
+    elif nt == 'T':
+      seq_code[i, 3] = 1
+    else:
+      seq_code[i, random.randint(0,3)] = 1
+  return seq_code
+
+
+def dna_1hot_index_loop(seq):
+  seq = seq.upper()
+  seq_code = np.zeros(len(seq), dtype='uint8')
+  for i in range(len(seq)):
+    nt = seq[i]
+    if nt == 'A':
+      seq_code[i] = 0
+    elif nt == 'C':
+      seq_code[i] = 1
+    elif nt == 'G':
+      seq_code[i] = 2
+    elif nt == 'T':
+      seq_code[i] = 3
+    else:
+      seq_code[i] = random.randint(0,3)
+  return seq_code
+
+
+def hot1_dna_loop(seqs_1hot):
+  seqs = []
+  for si in range(seqs_1hot.shape[0]):
+    seq_list = ['A'] * seqs_1hot.shape[1]
+    for li in range(seqs_1hot.shape[1]):
+      if seqs_1hot[si, li, 0] == 1:
+        seq_list[li] = 'A'
+      elif seqs_1hot[si, li, 1] == 1:
+        seq_list[li] = 'C'
+      elif seqs_1hot[si, li, 2] == 1:
+        seq_list[li] = 'G'
+      elif seqs_1hot[si, li, 3] == 1:
+        seq_list[li] = 'T'
+      else:
+        seq_list[li] = 'N'
+    seqs.append(''.join(seq_list))
+  return seqs
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import os
+import shutil
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from basenji import sad5
+
+################################################################################
+# bench_sad_h5.py
+#
+# Compare file size and SNP row / target column read latency of SAD stat
+# layouts: contiguous, chunked (and compressed), and with a target-major
+# transposed copy.
+################################################################################
+
+
+################################################################################
+# main
+################################################################################
+def main():
+  usage = 'usage: %prog [options]'
+  parser = OptionParser(usage)
+  parser.add_option('-c', dest='chunks',
+      default=None,
+      help='Comma-separated chunk shape [Default: %default]')
+  parser.add_option('--comp', dest='compression',
+      default='lzf',
+      help='Chunk compression [Default: %default]')
+  parser.add_option('-n', dest='num_snps',
+      default=1000000, type='int',
+      help='Number of SNPs [Default: %default]')
+  parser.add_option('-o', dest='out_dir',
+      default=None,
+      help='Output directory, kept after [Default: temporary]')
+  parser.add_option('-r', dest='num_reads',
+      default=20, type='int',
+      help='Number of row and column reads [Default: %default]')
+  parser.add_option('-t', dest='num_targets',
+      default=5000, type='int',
+      help='Number of targets [Default: %default]')
+  (options, args) = parser.parse_args()
+
+  if options.chunks is not None:
+    options.chunks = [int(c) for c in options.chunks.split(',')]
+
+  if options.out_dir is None:
+    out_dir = tempfile.mkdtemp()
+  else:
+    out_dir = options.out_dir
+    os.makedirs(out_dir, exist_ok=True)
+
+  shape = (options.num_snps, options.num_targets)
+  layouts = [
+    ('contiguous', sad5.stat_h5_opts(shape), False),
+    ('chunked', sad5.stat_h5_opts(shape, options.chunks, options.compression), False),
+    ('transposed', sad5.stat_h5_opts(shape, options.chunks, options.compression), True)
+  ]
+
+  np.random.seed(25)
+  row_indexes = np.random.randint(options.num_snps, size=options.num_reads)
+  col_indexes = np.random.randint(options.num_targets, size=options.num_reads)
+
+  print('%-12s  %8s  %8s  %10s  %10s' % ('layout', 'write s', 'size MB', 'row ms', 'column ms'))
+  for name, stat_opts, transpose in layouts:
+    h5_file = '%s/%s.h5' % (out_dir, name)
+
+    t0 = time.time()
+    write_stat(h5_file, shape, stat_opts, transpose)
+    write_time = time.time() - t0
+    size_mb = os.path.getsize(h5_file) / 2**20
+
+    with h5py.File(h5_file, 'r', **sad5.stat_h5_cache(shape, stat_opts.get('chunks'))) as h5_open:
+      sad_matrix = h5_open['SAD']
+      row_time = time_reads(lambda si: sad_matrix[si,:], row_indexes)
+      if transpose:
+        sad_matrix_t = h5_open['SAD_T']
+        col_time = time_reads(lambda ti: sad_matrix_t[ti,:], col_indexes)
+      else:
+        col_time = time_reads(lambda ti: sad_matrix[:,ti], col_indexes)
+
+    print('%-12s  %8.1f  %8.0f  %10.2f  %10.1f' % \
+      (name, write_time, size_mb, 1e3*row_time, 1e3*col_time))
+
+  if options.out_dir is None:
+    shutil.rmtree(out_dir)
+
+
+def time_reads(read_fn, indexes):
+  """Mean seconds per read."""
+  t0 = time.time()
+  for i in indexes:
+    read_fn(i)
+  return (time.time() - t0) / len(indexes)
+
+
+def write_stat(h5_file, shape, stat_opts, transpose, block_snps=16384):
+  """Write heavy-tailed float16 scores, as SAD stats are, in SNP blocks."""
+  num_snps, num_targets = shape
+  with h5py.File(h5_file, 'w', **sad5.stat_h5_cache(shape, stat_opts.get('chunks'))) as h5_open:
+    sad_matrix = h5_open.create_dataset('SAD', **stat_opts)
+    for si in range(0, num_snps, block_snps):
+      block_len = min(block_snps, num_snps - si)
+      sad_block = np.random.standard_cauchy(size=(block_len, num_targets)) * 0.01
+      sad_matrix[si:si+block_len] = np.clip(sad_block, -100, 100).astype('float16')
+    if transpose:
+      sad5.write_stat_transpose(h5_open, 'SAD')
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  main()
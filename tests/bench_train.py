@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import json
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+
+################################################################################
+# bench_train.py
+#
+# Compare training steps/sec and peak memory across precision policies and
+# XLA compilation for a model parameters file, e.g. train_full/params.json.
+################################################################################
+
+
+################################################################################
+# main
+################################################################################
+def main():
+  usage = 'usage: %prog [options] <params_file>'
+  parser = OptionParser(usage)
+  parser.add_option('-a', dest='accumulate_steps',
+      default=None, type='int',
+      help='Gradient accumulation micro-batches, overriding parameters [Default: %default]')
+  parser.add_option('-b', dest='batch_size',
+      default=None, type='int',
+      help='Batch size, overriding parameters [Default: %default]')
+  parser.add_option('--precision', dest='precisions',
+      default='float32,mixed_float16,mixed_bfloat16',
+      help='Comma-separated precision policies [Default: %default]')
+  parser.add_option('-s', dest='steps',
+      default=20, type='int',
+      help='Timed train steps [Default: %default]')
+  parser.add_option('-w', dest='warmup_steps',
+      default=3, type='int',
+      help='Untimed warmup steps, including compilation [Default: %default]')
+  (options, args) = parser.parse_args()
+
+  if len(args) != 1:
+    parser.error('Must provide parameters file')
+  else:
+    params_file = args[0]
+
+  with open(params_file) as params_open:
+    params = json.load(params_open)
+  if options.batch_size is not None:
+    params['train']['batch_size'] = options.batch_size
+  if options.accumulate_steps is not None:
+    params['train']['accumulate_steps'] = options.accumulate_steps
+
+  # run each configuration in a fresh process, to isolate policy and memory
+  mp_context = multiprocessing.get_context('spawn')
+
+  print('%-16s  %5s  %10s  %12s' % ('precision', 'xla', 'steps/s', 'peak MB'))
+  for precision in options.precisions.split(','):
+    for xla in [False, True]:
+      params['train']['precision'] = precision
+      params['train']['xla'] = xla
+      with mp_context.Pool(1) as pool:
+        steps_sec, peak_mb = pool.apply(bench_config,
+          (params, options.steps, options.warmup_steps))
+      print('%-16s  %5s  %10.2f  %12.1f' % (precision, xla, steps_sec, peak_mb), flush=True)
+
+
+def bench_config(params, steps, warmup_steps):
+  """Time train steps on random data, returning steps/sec and peak MB."""
+  import tensorflow as tf
+  from basenji import metrics
+  from basenji import seqnn
+  from basenji import trainer
+
+  params_model = params['model']
+  params_train = params['train']
+  trainer.set_precision(params_train)
+  seqnn_model = seqnn.SeqNN(params_model)
+  model = seqnn_model.model
+
+  # random batch
+  batch_size = params_train['batch_size']
+  seq_length = params_model['seq_length']
+  target_length, num_targets = model.output_shape[1:]
+  x = np.eye(4, dtype='float32')[np.random.randint(0, 4, size=(batch_size, seq_length))]
+  y = np.random.poisson(2, size=(batch_size, target_length, num_targets)).astype('float32')
+  x, y = tf.constant(x), tf.constant(y)
+
+  # train step from a trainer without datasets
+  seqnn_trainer = trainer.Trainer(params_train, [], [], None)
+  train_step = seqnn_trainer.make_train_step(model, tf.keras.metrics.Mean(),
+                                             metrics.PearsonR(num_targets))
+
+  gpus = tf.config.list_logical_devices('GPU')
+  for si in range(warmup_steps):
+    train_step(x, y)
+  if gpus:
+    tf.config.experimental.reset_memory_stats(gpus[0].name)
+
+  t0 = time.time()
+  for si in range(steps):
+    train_step(x, y)
+  float(seqnn_trainer.optimizer.iterations.numpy())
+  steps_sec = steps / (time.time() - t0)
+
+  if gpus:
+    peak_mb = tf.config.experimental.get_memory_info(gpus[0].name)['peak'] / 2**20
+  else:
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+  return steps_sec, peak_mb
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  main()
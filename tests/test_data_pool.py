@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+from optparse import Values
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+import pandas as pd
+import pysam
+import tensorflow as tf
+
+from basenji import dataset
+from basenji import dna_io
+import basenji_data
+from basenji_data import ModelSeq
+
+try:
+  import pyBigWig
+except ModuleNotFoundError:
+  pyBigWig = None
+
+
+class TestPoolWrite(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(3)
+    cls.out_dir = tempfile.mkdtemp()
+    chr_lengths = {'chr1': 2000, 'chr2': 1200}
+
+    # genome
+    cls.genome = {chrm: ''.join(np.random.choice(list('ACGT'), chr_len))
+                  for chrm, chr_len in chr_lengths.items()}
+    cls.fasta_file = '%s/genome.fa' % cls.out_dir
+    with open(cls.fasta_file, 'w') as fasta_out:
+      for chrm, seq in cls.genome.items():
+        print('>%s\n%s' % (chrm, seq), file=fasta_out)
+    pysam.faidx(cls.fasta_file)
+
+    # coverage, as HDF5 and BigWig
+    cls.cov = {chrm: np.random.gamma(0.5, 4, chr_len).astype('float16')
+               for chrm, chr_len in chr_lengths.items()}
+    cls.cov_h5_file = '%s/cov.h5' % cls.out_dir
+    with h5py.File(cls.cov_h5_file, 'w') as cov_h5:
+      for chrm in chr_lengths:
+        cov_h5.create_dataset(chrm, data=cls.cov[chrm])
+
+    if pyBigWig is not None:
+      cls.cov_bw_file = '%s/cov.bw' % cls.out_dir
+      cov_bw = pyBigWig.open(cls.cov_bw_file, 'w')
+      cov_bw.addHeader(list(chr_lengths.items()))
+      for chrm in chr_lengths:
+        cov_bw.addEntries(chrm, 0, values=cls.cov[chrm].astype('float64').tolist(),
+                          span=1, step=1)
+      cov_bw.close()
+
+    cls.mseqs = [ModelSeq('chr1', 0, 256, 'train'), ModelSeq('chr1', 700, 956, 'train'),
+                 ModelSeq('chr2', 128, 384, 'train'), ModelSeq('chr1', 1744, 2000, 'train'),
+                 ModelSeq('chr2', 900, 1156, 'train')]
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.out_dir)
+
+  def make_options(self, out_dir, restart=False):
+    os.makedirs('%s/tfrecords' % out_dir, exist_ok=True)
+    return Values({'out_dir': out_dir, 'restart': restart, 'processes': 2,
+                   'seq_length': 256, 'crop_bp': 32, 'pool_width': 16,
+                   'interp_nan': False, 'blacklist_bed': None, 'umap_clip': 1,
+                   'umap_tfr': False, 'seq_index': False})
+
+  def write_read(self, cov_file, out_dir, restart=False):
+    targets_df = pd.DataFrame({'file': [cov_file]*2, 'sum_stat': ['sum', 'mean'],
+                               'clip': [1000, 2], 'scale': [1, 2]})
+    tfr_shards = [('%s/tfrecords/train-%d' % (out_dir, ti), ti*3, min(ti*3+3, 5))
+                  for ti in range(2)]
+    options = self.make_options(out_dir, restart)
+    basenji_data.pool_write_tfrs(tfr_shards, self.fasta_file, targets_df,
+                                 self.mseqs, None, options)
+
+    # manifest lists each shard once
+    manifest_df = pd.read_csv('%s/tfr_manifest.txt' % out_dir, sep='\t', header=None)
+    self.assertEqual(sorted(manifest_df[0]), ['%s.tfr' % ts[0] for ts in tfr_shards])
+    self.assertEqual(manifest_df[1].sum(), len(self.mseqs))
+
+    # read examples in order
+    seqs_1hot, targets = [], []
+    for tfr_stem, _, _ in tfr_shards:
+      for example_bytes in dataset.file_to_records('%s.tfr' % tfr_stem):
+        example = tf.train.Example.FromString(example_bytes.numpy())
+        features = example.features.feature
+        seq_bytes = features[dataset.TFR_INPUT].bytes_list.value[0]
+        seqs_1hot.append(np.frombuffer(seq_bytes, dtype='bool').reshape((-1, 4)))
+        target_bytes = features[dataset.TFR_OUTPUT].bytes_list.value[0]
+        targets.append(np.frombuffer(target_bytes, dtype='float16').reshape((12, 2)))
+    return seqs_1hot, targets
+
+  def check_round_trip(self, cov_file):
+    out_dir = tempfile.mkdtemp(dir=self.out_dir)
+    seqs_1hot, targets = self.write_read(cov_file, out_dir)
+    self.assertEqual(len(seqs_1hot), len(self.mseqs))
+
+    for si, mseq in enumerate(self.mseqs):
+      seq_dna = self.genome[mseq.chr][mseq.start:mseq.end]
+      np.testing.assert_array_equal(seqs_1hot[si], dna_io.dna_1hot(seq_dna))
+
+      seq_cov = self.cov[mseq.chr][mseq.start+32:mseq.end-32].astype('float32')
+      seq_cov = seq_cov.reshape((12, 16))
+      np.testing.assert_allclose(targets[si][:,0], seq_cov.sum(axis=1), rtol=2e-3)
+      np.testing.assert_allclose(targets[si][:,1], 2*np.clip(seq_cov.mean(axis=1), 0, 2),
+                                 rtol=2e-3)
+
+  def test_h5(self):
+    self.check_round_trip(self.cov_h5_file)
+
+  @unittest.skipIf(pyBigWig is None, 'pyBigWig not installed')
+  def test_bigwig(self):
+    self.check_round_trip(self.cov_bw_file)
+
+  def test_manifest(self):
+    out_dir = tempfile.mkdtemp(dir=self.out_dir)
+
+    # stale manifest entry from an earlier run
+    stale_tfr = '%s/tfrecords/valid-0.tfr' % out_dir
+    os.makedirs('%s/tfrecords' % out_dir)
+    open(stale_tfr, 'w').close()
+    with open('%s/tfr_manifest.txt' % out_dir, 'w') as manifest_out:
+      print('%s\t7' % stale_tfr, file=manifest_out)
+
+    # written anew, without --restart
+    self.write_read(self.cov_h5_file, out_dir)
+
+    # missing shard rewritten, and appended, with --restart
+    tfr_file = '%s/tfrecords/train-1.tfr' % out_dir
+    os.remove(tfr_file)
+    seqs_1hot, targets = self.write_read(self.cov_h5_file, out_dir, restart=True)
+    self.assertTrue(os.path.isfile(tfr_file))
+    self.assertEqual(len(seqs_1hot), len(self.mseqs))
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
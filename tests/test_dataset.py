@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# Copyright 2017 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from basenji import dataset
+from basenji import dna_io
+
+
+def write_data(data_dir, seqs_dna, targets, seq_index=False, seqs_per_tfr=2):
+  """Write a small TFRecord data directory mimicking basenji_data.py."""
+  num_seqs, target_length, num_targets = targets.shape
+  os.makedirs('%s/tfrecords' % data_dir)
+
+  stats_dict = {
+    'num_targets': num_targets,
+    'seq_length': len(seqs_dna[0]),
+    'target_length': target_length,
+    'test_seqs': num_seqs
+  }
+  if seq_index:
+    stats_dict['seq_index'] = True
+  with open('%s/statistics.json' % data_dir, 'w') as stats_out:
+    json.dump(stats_dict, stats_out)
+
+  tf_opts = tf.io.TFRecordOptions(compression_type='ZLIB')
+  for tfr_i, si_start in enumerate(range(0, num_seqs, seqs_per_tfr)):
+    tfr_file = '%s/tfrecords/test-%d.tfr' % (data_dir, tfr_i)
+    with tf.io.TFRecordWriter(tfr_file, tf_opts) as writer:
+      for si in range(si_start, min(si_start+seqs_per_tfr, num_seqs)):
+        if seq_index:
+          seq_code = dna_io.dna_1hot_index(seqs_dna[si])
+        else:
+          seq_code = dna_io.dna_1hot(seqs_dna[si])
+        features_dict = {
+          'sequence': feature_bytes(seq_code),
+          'target': feature_bytes(targets[si])
+        }
+        example = tf.train.Example(features=tf.train.Features(feature=features_dict))
+        writer.write(example.SerializeToString())
+
+
+def feature_bytes(values):
+  values = values.flatten().tobytes()
+  return tf.train.Feature(bytes_list=tf.train.BytesList(value=[values]))
+
+
+class TestSeqDataset(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.temp_dir = tempfile.mkdtemp()
+    np.random.seed(7)
+    cls.seqs_dna = [''.join(np.random.choice(list('ACGT'), 64)) for si in range(5)]
+    cls.targets = np.random.uniform(size=(5, 8, 3)).astype('float16')
+
+    cls.data_1hot = '%s/data_1hot' % cls.temp_dir
+    write_data(cls.data_1hot, cls.seqs_dna, cls.targets)
+    cls.data_index = '%s/data_index' % cls.temp_dir
+    write_data(cls.data_index, cls.seqs_dna, cls.targets, seq_index=True)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.temp_dir)
+
+  def test_seq_index(self):
+    # index records are a quarter the size
+    size_1hot = os.path.getsize('%s/tfrecords/test-0.tfr' % self.data_1hot)
+    size_index = os.path.getsize('%s/tfrecords/test-0.tfr' % self.data_index)
+    self.assertLess(size_index, size_1hot)
+
+    data_1hot = dataset.SeqDataset(self.data_1hot, 'test', batch_size=2)
+    data_index = dataset.SeqDataset(self.data_index, 'test', batch_size=2)
+
+    for (seq1, tgt1), (seq2, tgt2) in zip(data_1hot.dataset, data_index.dataset):
+      self.assertEqual(seq2.dtype, tf.float32)
+      np.testing.assert_array_equal(seq1.numpy(), seq2.numpy())
+      np.testing.assert_array_equal(tgt1.numpy(), tgt2.numpy())
+
+    seqs_1hot, targets = data_index.numpy()
+    self.assertEqual(dna_io.hot1_dna(seqs_1hot), self.seqs_dna)
+    np.testing.assert_array_equal(targets, self.targets)
+
+  def test_crop(self):
+    data_index = dataset.SeqDataset(self.data_index, 'test', batch_size=5,
+                                    seq_length_crop=32)
+    seqs_1hot, _ = next(iter(data_index.dataset))
+    self.assertEqual(seqs_1hot.shape, (5, 32, 4))
+    seqs_dna = dna_io.hot1_dna(seqs_1hot.numpy())
+    self.assertEqual(seqs_dna, [seq[16:-16] for seq in self.seqs_dna])
+
+  def test_numpy(self):
+    data_1hot = dataset.SeqDataset(self.data_1hot, 'test', batch_size=2,
+                                   seq_length_crop=32)
+    seqs_1hot, targets = data_1hot.numpy(read_batch=2, mem_budget=512)
+    self.assertIsInstance(seqs_1hot, np.memmap)
+    self.assertEqual(dna_io.hot1_dna(seqs_1hot), [seq[16:-16] for seq in self.seqs_dna])
+    np.testing.assert_array_equal(targets, self.targets)
+
+    targets = data_1hot.numpy(return_inputs=False, step=2, target_slice=[2,0])
+    self.assertNotIsInstance(targets, np.memmap)
+    np.testing.assert_array_equal(targets, self.targets[:,::2][:,:,[2,0]])
+
+  def test_compute_stats(self):
+    data_index = dataset.SeqDataset(self.data_index, 'test', batch_size=2,
+                                    tfr_pattern='test-*.tfr')
+    self.assertEqual(data_index.num_seqs, 5)
+    self.assertEqual(data_index.num_targets_nonzero, 3)
+
+  def test_parallel_read(self):
+    for cache in [None, True, '%s/valid_cache' % self.temp_dir]:
+      data_par = dataset.SeqDataset(self.data_1hot, 'test', batch_size=2,
+                                    parallel_read=True, cache=cache)
+      self.assertEqual(data_par.seqs_per_tfr, 2)
+
+      # two passes match the serial record order
+      for pass_i in range(2):
+        seqs_1hot = np.concatenate([x.numpy() for x, y in data_par.dataset])
+        self.assertEqual(dna_io.hot1_dna(seqs_1hot), self.seqs_dna)
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
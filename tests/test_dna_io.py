@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from optparse import OptionParser
 
+import random
 import unittest
 
 import numpy as np
@@ -19,6 +20,45 @@ class TestDelete(unittest.TestCase):
     self.assertEqual('GATCANN', basenji.dna_io.hot1_dna(seq_1hot))
 
 
+class TestEncode(unittest.TestCase):
+
+  def test_1hot(self):
+    seq = 'GATtacaN'
+    seq_1hot = basenji.dna_io.dna_1hot(seq, n_uniform=True)
+    self.assertEqual(seq_1hot.dtype, np.float16)
+    np.testing.assert_array_equal(seq_1hot[-1], [0.25]*4)
+    self.assertEqual('GATTACAN', basenji.dna_io.hot1_dna(seq_1hot))
+
+    # padding stays zero
+    seq_1hot = basenji.dna_io.dna_1hot('GATTACA', seq_len=11)
+    self.assertEqual('NNGATTACANN', basenji.dna_io.hot1_dna(seq_1hot))
+    self.assertEqual(seq_1hot[:2].sum(), 0)
+
+    # trimming keeps the center
+    seq_1hot = basenji.dna_io.dna_1hot('GATTACA', seq_len=3)
+    self.assertEqual('TTA', basenji.dna_io.hot1_dna(seq_1hot))
+
+  def test_n_sample(self):
+    seq = 'ANNNNNNNNNNNNNNNNNNT'
+    random.seed(1)
+    seq_1hot = basenji.dna_io.dna_1hot(seq)
+    np.testing.assert_array_equal(seq_1hot.sum(axis=1), 1)
+    random.seed(1)
+    seq_index = basenji.dna_io.dna_1hot_index(seq)
+    np.testing.assert_array_equal(seq_1hot.argmax(axis=1), seq_index)
+
+  def test_batch(self):
+    seqs = ['GATTACA', 'TAGATAC', 'ACGTNNA']
+    random.seed(2)
+    seqs_1hot = basenji.dna_io.dnas_1hot(seqs)
+    random.seed(2)
+    seqs_1hot_loop = np.array([basenji.dna_io.dna_1hot(seq) for seq in seqs])
+    np.testing.assert_array_equal(seqs_1hot, seqs_1hot_loop)
+
+    seqs_1hot = basenji.dna_io.dnas_1hot(['GATTACA', 'TAG'], seq_len=5, n_uniform=True)
+    self.assertEqual(['ATTAC', 'NTAGN'], basenji.dna_io.hot1_dna(seqs_1hot))
+
+
 class TestInsert(unittest.TestCase):
 
   def test_insert(self):
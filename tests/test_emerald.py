@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pysam
+
+from basenji import emerald
+
+
+class TestEmerald(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(12)
+    cls.out_dir = tempfile.mkdtemp()
+    cls.pop_vcf_stem = '%s/pop' % cls.out_dir
+    num_samples = 13
+
+    # variant positions, with a deletion spanning the 100 bp window boundary
+    positions = sorted(np.random.choice(np.arange(2, 300), 40, replace=False).tolist() + [97])
+    positions = [pos for pos in positions if pos not in range(98, 103)]
+
+    # haplotype alleles, with some missing
+    cls.hap_alleles = np.random.randint(2, size=(len(positions), 2, num_samples))
+    hap_missing = np.random.uniform(size=cls.hap_alleles.shape) < 0.05
+
+    vcf_file = '%s.chr1.vcf' % cls.pop_vcf_stem
+    with open(vcf_file, 'w') as vcf_out:
+      print('##fileformat=VCFv4.2', file=vcf_out)
+      print('##contig=<ID=chr1,length=1000>', file=vcf_out)
+      print('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">', file=vcf_out)
+      print('##FORMAT=<ID=DS,Number=1,Type=Float,Description="Dosage">', file=vcf_out)
+      cols = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT']
+      cols += ['s%d' % si for si in range(num_samples)]
+      print('\t'.join(cols), file=vcf_out)
+
+      for vi, pos in enumerate(positions):
+        alleles = cls.hap_alleles[vi].astype('str').astype('object')
+        alleles[hap_missing[vi]] = '.'
+        ref = 'ACGTAC' if pos == 97 else 'A'
+
+        # one record in the general format
+        if vi % 10 == 5:
+          sample_gts = ['%s|%s:%d' % (alleles[0,si], alleles[1,si], cls.hap_alleles[vi,:,si].sum())
+                        for si in range(num_samples)]
+          fmt = 'GT:DS'
+        else:
+          sample_gts = ['%s|%s' % (alleles[0,si], alleles[1,si]) for si in range(num_samples)]
+          fmt = 'GT'
+        cols = ['chr1', str(pos), 'rs%d' % pos, ref, 'T', '.', 'PASS', '.', fmt] + sample_gts
+        print('\t'.join(cols), file=vcf_out)
+
+    pysam.tabix_index(vcf_file, preset='vcf', force=True)
+
+    cls.positions = np.array(positions)
+    cls.hap_alleles[hap_missing] = 0
+    cls.dosages = cls.hap_alleles.sum(axis=1)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.out_dir)
+
+  def test_region(self):
+    emerald_vcf = emerald.EmeraldVCF(self.pop_vcf_stem, cache_regions=2, cache_window=100)
+    region_pos, region_ids, region_gts, num_samples = \
+      emerald_vcf.region_genotypes('chr1', 50, 250)
+
+    # variants in the region once each, the deletion included
+    pos_mask = (self.positions >= 50) & (self.positions <= 250)
+    np.testing.assert_array_equal(region_pos, self.positions[pos_mask])
+    self.assertIn('rs97', region_ids.tolist())
+    self.assertEqual(len(set(region_ids)), len(region_ids))
+
+    # unpack the haplotypes
+    hap_alleles = np.unpackbits(region_gts, axis=-1)[...,:num_samples]
+    np.testing.assert_array_equal(hap_alleles, self.hap_alleles[pos_mask])
+
+  def test_r(self):
+    gts = emerald.read_genotypes('%s.chr1.vcf.gz' % self.pop_vcf_stem, 'chr1', 1, 1000)[2]
+    num_samples = self.dosages.shape[1]
+    dosages_r = np.corrcoef(self.dosages)
+    for snp_i in [0, 5, 17]:
+      region_r = emerald.genotypes_r(gts, snp_i, num_samples)
+      np.testing.assert_allclose(region_r, dosages_r[snp_i], rtol=1e-6, atol=1e-9)
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pysam
+
+from basenji import dna_io
+from basenji import genome
+
+
+def random_chrom(chrom_len):
+  """Random sequence with soft-masking, N runs, and IUPAC codes."""
+  seq = np.random.choice(list('ACGTacgt'), size=chrom_len)
+  for _ in range(3):
+    nstart = np.random.randint(chrom_len)
+    seq[nstart:nstart+np.random.randint(1, 40)] = 'N'
+  seq[np.random.randint(chrom_len)] = 'R'
+  seq[:2] = 'N'
+  return ''.join(seq)
+
+
+class TestGenomeCache(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(23)
+    cls.out_dir = tempfile.mkdtemp()
+
+    cls.chroms = {'chr1':random_chrom(1001), 'chr2':random_chrom(64),
+                  'chr3':random_chrom(7), 'chrM':random_chrom(333)}
+    cls.fasta_file = '%s/genome.fa' % cls.out_dir
+    with open(cls.fasta_file, 'w') as fasta_out:
+      for chrm, seq in cls.chroms.items():
+        print('>%s' % chrm, file=fasta_out)
+        for i in range(0, len(seq), 60):
+          print(seq[i:i+60], file=fasta_out)
+    pysam.faidx(cls.fasta_file)
+
+    # small blocks, to split N runs across them
+    block_nt = genome.CACHE_BLOCK_NT
+    genome.CACHE_BLOCK_NT = 32
+    cls.genome_cache = genome.GenomeCache.build(cls.fasta_file)
+    genome.CACHE_BLOCK_NT = block_nt
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.out_dir)
+
+  def expected_dna(self, chrm, start, end):
+    seq = self.chroms[chrm].upper()
+    seq = ''.join([nt if nt in 'ACGT' else 'N' for nt in seq])
+    return ''.join([seq[i] if 0 <= i < len(seq) else 'N' for i in range(start, end)])
+
+  def test_fetch(self):
+    fasta_open = pysam.Fastafile(self.fasta_file)
+    self.assertEqual(list(self.genome_cache.references), list(fasta_open.references))
+    self.assertEqual(tuple(self.genome_cache.lengths), tuple(fasta_open.lengths))
+
+    for chrm, seq in self.chroms.items():
+      for _ in range(50):
+        start = np.random.randint(-20, len(seq)+20)
+        end = start + np.random.randint(0, 80)
+
+        # padded sequences and indexes match pysam's
+        seq_dna = self.expected_dna(chrm, start, end)
+        self.assertEqual(self.genome_cache.fetch_dna(chrm, start, end), seq_dna)
+        self.assertEqual(genome.fetch_dna(fasta_open, chrm, start, end).replace('R','N'), seq_dna)
+        np.testing.assert_array_equal(self.genome_cache.fetch_index(chrm, start, end),
+                                      genome.fetch_index(fasta_open, chrm, start, end))
+
+        # clipped like pysam
+        start, end = max(start, 0), max(end, 0)
+        pysam_dna = fasta_open.fetch(chrm, start, end).upper().replace('R','N')
+        self.assertEqual(self.genome_cache.fetch(chrm, start, end), pysam_dna)
+
+    self.assertEqual(self.genome_cache.fetch('chr3'), self.expected_dna('chr3', 0, 7))
+    fasta_open.close()
+
+  def test_1hot(self):
+    seq_dna = genome.fetch_dna(pysam.Fastafile(self.fasta_file), 'chrM', -5, 300)
+    random.seed(1)
+    seq_1hot = dna_io.dna_1hot(seq_dna)
+    random.seed(1)
+    np.testing.assert_array_equal(self.genome_cache.fetch_1hot('chrM', -5, 300), seq_1hot)
+
+    seq_1hot = self.genome_cache.fetch_1hot('chrM', -5, 300, n_uniform=True)
+    np.testing.assert_array_equal(seq_1hot, dna_io.dna_1hot(seq_dna, n_uniform=True))
+
+  def test_open(self):
+    self.assertTrue(genome.cache_current(self.fasta_file))
+    self.assertIsInstance(genome.open_fasta(self.fasta_file), genome.GenomeCache)
+
+    # stale caches are ignored
+    fasta_mtime = os.path.getmtime(self.fasta_file)
+    chroms_file = '%s/chroms.txt' % genome.cache_path(self.fasta_file)
+    os.utime(chroms_file, (fasta_mtime-10, fasta_mtime-10))
+    self.assertFalse(genome.cache_current(self.fasta_file))
+    self.assertIsInstance(genome.open_fasta(self.fasta_file), pysam.Fastafile)
+
+    # and rebuilt on request
+    self.assertIsInstance(genome.open_fasta(self.fasta_file, cache=True), genome.GenomeCache)
+    self.assertTrue(genome.cache_current(self.fasta_file))
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
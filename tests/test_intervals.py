@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from basenji import intervals
+from basenji import vcf
+
+
+def random_intervals(num, max_len, chroms=['chr1', 'chr2', 'chr3']):
+  chrs = np.random.choice(chroms, size=num)
+  starts = np.random.randint(0, 20000, size=num)
+  ends = starts + np.random.randint(1, max_len, size=num)
+  return chrs, starts, ends
+
+
+def brute_pairs(query_intervals, index_intervals):
+  pairs = []
+  for qi, (qc, qs, qe) in enumerate(zip(*query_intervals)):
+    for ii, (ic, ist, ie) in enumerate(zip(*index_intervals)):
+      if qc == ic and ist < qe and qs < ie:
+        pairs.append((qi, ii))
+  return sorted(pairs)
+
+
+class TestIntervals(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(21)
+
+  def test_overlap_pairs(self):
+    for max_len in [2, 500, 5000]:
+      index_intervals = random_intervals(200, max_len)
+      query_intervals = random_intervals(300, 800, ['chr1', 'chr2', 'chr4'])
+
+      interval_index = intervals.IntervalIndex(*index_intervals)
+      query_pairs, interval_pairs = interval_index.overlap_pairs(*query_intervals)
+      self.assertTrue((np.diff(query_pairs) >= 0).all())
+
+      pairs = sorted(zip(query_pairs.tolist(), interval_pairs.tolist()))
+      self.assertEqual(pairs, brute_pairs(query_intervals, index_intervals))
+
+      overlaps = interval_index.overlaps(*query_intervals)
+      self.assertEqual(set(np.flatnonzero(overlaps)), set(qi for qi, _ in pairs))
+
+  def test_from_bed(self):
+    bed_fd, bed_file = tempfile.mkstemp(suffix='.bed')
+    with os.fdopen(bed_fd, 'w') as bed_out:
+      print('track name=test', file=bed_out)
+      print('chr1\t100\t200\tpeak1', file=bed_out)
+      print('chr1\t150\t300', file=bed_out)
+      print('chr2\t0\t50', file=bed_out)
+    interval_index = intervals.IntervalIndex.from_bed(bed_file)
+    os.remove(bed_file)
+
+    self.assertEqual(len(interval_index), 3)
+    query_pairs, interval_pairs = interval_index.overlap_pairs(
+      ['chr1', 'chr2', 'chr2'], [199, 50, 49], [250, 60, 50])
+    self.assertEqual(query_pairs.tolist(), [0, 0, 2])
+    self.assertEqual(interval_pairs.tolist(), [0, 1, 2])
+
+  def test_vcf_intersect(self):
+    seq_coords = [('chr1', 1000, 2000), ('chr1', 1500, 2500), ('chr2', 0, 1000)]
+    snps = [('chr1', 1001), ('chr1', 1600), ('chr1', 2000),
+            ('chr2', 500), ('chr1', 1000), ('chr3', 10)]
+
+    vcf_fd, vcf_file = tempfile.mkstemp(suffix='.vcf')
+    with os.fdopen(vcf_fd, 'w') as vcf_out:
+      print('##fileformat=VCFv4.2', file=vcf_out)
+      for si, (chrom, pos) in enumerate(snps):
+        print('%s\t%d\trs%d\tA\tG' % (chrom, pos, si), file=vcf_out)
+
+    snp_seqs = vcf.intersect_snps_seqs(vcf_file, seq_coords)
+    self.assertEqual(snp_seqs, [[0], [0, 1], [1], [2], [], []])
+
+    snp_seqs = vcf.intersect_snps_seqs(vcf_file, seq_coords, vision_p=0.5)
+    self.assertEqual(snp_seqs, [[], [0], [1], [2], [], []])
+
+    class GeneSeq:
+      def __init__(self, chrom, start, end):
+        self.chrom, self.start, self.end = chrom, start, end
+    gene_seqs = [GeneSeq(*sc) for sc in seq_coords]
+    seqs_snps = vcf.intersect_seqs_snps(vcf_file, gene_seqs)
+    self.assertEqual(seqs_snps, [[0, 1], [1, 2], [3]])
+    os.remove(vcf_file)
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
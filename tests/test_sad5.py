@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+import pysam
+from scipy.stats import cauchy
+
+from basenji import sad5
+import basenji_sad_multi
+
+
+def write_sad_h5(sad_h5_file, sad, snp_ids, snp_pos, target_labels, transpose=False,
+                 chunks=None, compression=None):
+  """Write a sad.h5 as basenji_sad.py does, with SAD percentiles, and SAD
+     stored with stat_h5_opts chunks and compression."""
+  num_snps, num_targets = sad.shape
+  stat_opts = sad5.stat_h5_opts(sad.shape, chunks, compression)
+  stat_cache = sad5.stat_h5_cache(stat_opts['shape'], stat_opts.get('chunks'))
+  with h5py.File(sad_h5_file, 'w', **stat_cache) as sad_out:
+    sad_out.create_dataset('snp', data=np.array(snp_ids, 'S'))
+    sad_out.create_dataset('pos', data=np.array(snp_pos))
+    sad_out.create_dataset('target_ids',
+      data=np.array(['t%d' % ti for ti in range(num_targets)], 'S'))
+    sad_out.create_dataset('target_labels', data=np.array(target_labels, 'S'))
+
+    # in blocks of SNPs, across chunk rows
+    sad_dataset = sad_out.create_dataset('SAD', **stat_opts)
+    for si in range(0, num_snps, 32):
+      sad_dataset[si:si+32] = sad[si:si+32]
+    if transpose:
+      sad5.write_stat_transpose(sad_out, 'SAD', block_values=2**16)
+
+    percentiles = np.linspace(0, 1, 11)
+    sad_out.create_dataset('percentiles', data=percentiles)
+    sad_out.create_dataset('SAD_pct', data=np.percentile(sad, 100*percentiles, axis=0).T)
+
+
+def write_pop_vcf(vcf_file, chrm, snp_ids, snp_pos, hap_alleles):
+  """Write a bgzipped, indexed population VCF of phased genotypes."""
+  num_samples = hap_alleles.shape[-1]
+  with open(vcf_file, 'w') as vcf_out:
+    print('##fileformat=VCFv4.2', file=vcf_out)
+    print('##contig=<ID=%s,length=100000>' % chrm, file=vcf_out)
+    print('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">', file=vcf_out)
+    cols = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT']
+    cols += ['s%d' % si for si in range(num_samples)]
+    print('\t'.join(cols), file=vcf_out)
+    for snp_id, pos, snp_alleles in zip(snp_ids, snp_pos, hap_alleles):
+      sample_gts = ['%d|%d' % tuple(snp_alleles[:,si]) for si in range(num_samples)]
+      cols = [chrm, str(pos), snp_id, 'A', 'G', '.', 'PASS', '.', 'GT'] + sample_gts
+      print('\t'.join(cols), file=vcf_out)
+  pysam.tabix_index(vcf_file, preset='vcf', force=True)
+
+
+class TestSAD5(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(10)
+    cls.out_dir = tempfile.mkdtemp()
+    cls.num_snps, cls.num_targets = 400, 6
+
+    # heavy-tailed scores, differing by target
+    cls.fit_loc = np.random.uniform(-0.1, 0.1, cls.num_targets)
+    cls.fit_scale = np.random.uniform(0.01, 0.2, cls.num_targets)
+    cls.sad = cauchy.rvs(cls.fit_loc, cls.fit_scale,
+                         size=(cls.num_snps, cls.num_targets)).astype('float16')
+    cls.target_labels = ['CAGE:a', 'DNASE:b', 'CAGE:c', 'CHIP:d', 'CAGE:e', 'DNASE:f']
+
+    snp_ids = ['rs%d' % si for si in range(cls.num_snps)]
+    cls.sad_h5_files = []
+    for transpose in [False, True]:
+      sad_h5_file = '%s/sad%d.h5' % (cls.out_dir, transpose)
+      write_sad_h5(sad_h5_file, cls.sad, snp_ids, np.arange(cls.num_snps),
+                   cls.target_labels, transpose)
+      cls.sad_h5_files.append(sad_h5_file)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.out_dir)
+
+  def test_read(self):
+    si = [17, 3, 17, 250, 0, 3]
+    ti = [5, 0, 5, 2]
+    for sad_h5_file in self.sad_h5_files:
+      sad_h5 = sad5.SAD5(sad_h5_file, compute_norm=False)
+
+      # repeated and unsorted indexes
+      np.testing.assert_array_equal(sad_h5.read_sad(si), self.sad[si])
+      np.testing.assert_array_equal(sad_h5.read_sad(np.array(si)), self.sad[si])
+      np.testing.assert_array_equal(sad_h5.read_targets(ti), self.sad[:,ti])
+      np.testing.assert_array_equal(sad_h5.read_targets(np.array(ti)), self.sad[:,ti])
+
+      # integers, slices, and empty lists
+      np.testing.assert_array_equal(sad_h5.read_sad(9), self.sad[9])
+      np.testing.assert_array_equal(sad_h5.read_sad(slice(5, 20)), self.sad[5:20])
+      np.testing.assert_array_equal(sad_h5.read_targets(4), self.sad[:,4])
+      self.assertEqual(sad_h5.read_sad([]).shape, (0, self.num_targets))
+      self.assertEqual(sad_h5.read_targets([]).shape, (self.num_snps, 0))
+      sad_h5.sad_h5_open.close()
+
+  def test_norm(self):
+    norm_h5_file = '%s/norm.h5' % self.out_dir
+    shutil.copy(self.sad_h5_files[0], norm_h5_file)
+    sad_h5 = sad5.SAD5(norm_h5_file)
+
+    # fits of every SNP, by target
+    for ti in range(self.num_targets):
+      fit_loc, fit_scale = cauchy.fit(self.sad[:,ti].astype('float32'))
+      np.testing.assert_allclose(sad_h5.target_cauchy_fit_loc[ti], fit_loc, rtol=1e-6)
+      np.testing.assert_allclose(sad_h5.target_cauchy_fit_scale[ti], fit_scale, rtol=1e-6)
+
+    # normalizing parameters shared within target sets
+    cage_ti = [0, 2, 4]
+    np.testing.assert_allclose(sad_h5.target_cauchy_norm_loc[cage_ti],
+                               np.median(sad_h5.target_cauchy_fit_loc[cage_ti]))
+
+    # closed form against scipy, for repeated and unsorted indexes
+    si = [17, 3, 17, 250, 0, 3]
+    ti = [5, 0, 5, 2]
+    sad_q = cauchy.cdf(self.sad[si][:,ti].astype('float64'),
+                       sad_h5.target_cauchy_fit_loc[ti], sad_h5.target_cauchy_fit_scale[ti])
+    sad_q = np.where(sad_q > 0.5, sad_q-1e-5, sad_q+1e-5)
+    sad_norm = cauchy.ppf(sad_q, sad_h5.target_cauchy_norm_loc[ti],
+                          sad_h5.target_cauchy_norm_scale[ti])
+    np.testing.assert_allclose(sad_h5[si, ti], sad_norm, rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(sad_h5[si][:,ti], sad_norm, rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(sad_h5[3:5, 1], sad_h5[[3,4]][:,1], rtol=1e-12)
+    sad_h5.sad_h5_open.close()
+
+  def test_fit_targets(self):
+    sad = cauchy.rvs(self.fit_loc, self.fit_scale, size=(20000, self.num_targets))
+    fit_loc, fit_scale = sad5.fit_cauchy_targets(sad, processes=2)
+    np.testing.assert_allclose(fit_loc, self.fit_loc, atol=0.01)
+    np.testing.assert_allclose(fit_scale, self.fit_scale, rtol=0.05)
+
+
+class TestStatH5(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(14)
+    cls.out_dir = tempfile.mkdtemp()
+    cls.num_snps, cls.num_targets = 20000, 5
+    cls.sad = np.random.normal(size=(cls.num_snps, cls.num_targets)).astype('float16')
+    cls.snp_ids = ['rs%d' % si for si in range(cls.num_snps)]
+    cls.target_labels = ['CAGE:t%d' % ti for ti in range(cls.num_targets)]
+
+    # contiguous, chunked, and compressed stats
+    cls.stat_opts = [(None, None, None), ((1000, 2), None, (1000, 2)),
+                     (None, 'gzip', (20000, 5)), ((777, 5), 'lzf', (777, 5))]
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.out_dir)
+
+  def test_round_trip(self):
+    for chunks, compression, stat_chunks in self.stat_opts:
+      sad_h5_file = '%s/sad_%s.h5' % (self.out_dir, compression)
+      write_sad_h5(sad_h5_file, self.sad, self.snp_ids, np.arange(self.num_snps),
+                   self.target_labels, True, chunks, compression)
+
+      with h5py.File(sad_h5_file, 'r') as sad_h5_open:
+        sad_dataset = sad_h5_open['SAD']
+        self.assertEqual(sad_dataset.chunks, stat_chunks)
+        self.assertEqual(sad_dataset.compression, compression)
+        np.testing.assert_array_equal(sad_dataset[:], self.sad)
+
+        # one target per chunk, filtered like the stat
+        t_dataset = sad_h5_open['SAD_T']
+        self.assertEqual(t_dataset.chunks, (1, sad5.STAT_T_CHUNK_SNPS))
+        self.assertEqual(t_dataset.compression, compression)
+        np.testing.assert_array_equal(t_dataset[:], self.sad.T)
+
+  def test_create_like(self):
+    with h5py.File('%s/like.h5' % self.out_dir, 'w') as h5_open:
+      gzip_dataset = h5_open.create_dataset('gzip', shape=(100, 4), dtype='float16',
+        chunks=(10, 4), compression='gzip', compression_opts=6, shuffle=True,
+        fillvalue=np.nan)
+      dcpl = gzip_dataset.id.get_create_plist()
+
+      like_dataset = sad5.create_dataset_like(h5_open, 'like', (30, 7), 'float32',
+                                              dcpl, (8, 7))
+      self.assertEqual(like_dataset.shape, (30, 7))
+      self.assertEqual(like_dataset.dtype, np.dtype('float32'))
+      self.assertEqual(like_dataset.chunks, (8, 7))
+      self.assertEqual(like_dataset.compression, 'gzip')
+      self.assertEqual(like_dataset.compression_opts, 6)
+      self.assertTrue(like_dataset.shuffle)
+      self.assertTrue(np.isnan(like_dataset[3, 2]))
+      like_dataset[:] = 1
+      np.testing.assert_array_equal(like_dataset[:], 1)
+
+      # the source's chunks, unchanged
+      self.assertEqual(gzip_dataset.id.get_create_plist().get_chunk(), (10, 4))
+
+      # empty datasets can't be chunked
+      empty_dataset = sad5.create_dataset_like(h5_open, 'empty', (0, 7), 'float16',
+                                               dcpl, (8, 7))
+      self.assertEqual(empty_dataset.shape, (0, 7))
+
+  def test_read_targets(self):
+    ti = [4, 0, 4, 2, 2]
+    for transpose in [False, True]:
+      sad_h5_file = '%s/sad_read%d.h5' % (self.out_dir, transpose)
+      write_sad_h5(sad_h5_file, self.sad, self.snp_ids, np.arange(self.num_snps),
+                   self.target_labels, transpose, (1000, 2), 'gzip')
+      sad_h5 = sad5.SAD5(sad_h5_file, compute_norm=False)
+      self.assertEqual(sad_h5.sad_matrix_t is not None, transpose)
+
+      # repeated and unsorted indexes, integers, and slices
+      np.testing.assert_array_equal(sad_h5.read_targets(ti), self.sad[:,ti])
+      np.testing.assert_array_equal(sad_h5.read_targets(np.array(ti)), self.sad[:,ti])
+      np.testing.assert_array_equal(sad_h5.read_targets(3), self.sad[:,3])
+      np.testing.assert_array_equal(sad_h5.read_targets(slice(1, 4)), self.sad[:,1:4])
+      sad_h5.sad_h5_open.close()
+
+  def test_collect_transpose(self):
+    num_jobs = 3
+    job_snps = [0, 7000, 13000, self.num_snps]
+    for virtual in [False, True]:
+      for chunks, compression, _ in self.stat_opts:
+        out_dir = tempfile.mkdtemp(dir=self.out_dir)
+        for pi in range(num_jobs):
+          si, sj = job_snps[pi], job_snps[pi+1]
+          os.makedirs('%s/job%d' % (out_dir, pi))
+          write_sad_h5('%s/job%d/sad.h5' % (out_dir, pi), self.sad[si:sj],
+                       self.snp_ids[si:sj], np.arange(si, sj), self.target_labels,
+                       True, chunks, compression)
+
+        basenji_sad_multi.collect_h5('sad.h5', out_dir, num_jobs, virtual=virtual,
+                                     transpose=True, block_values=2**16)
+
+        with h5py.File('%s/sad.h5' % out_dir, 'r') as sad_h5_open:
+          np.testing.assert_array_equal(sad_h5_open['SAD'][:], self.sad)
+          t_dataset = sad_h5_open['SAD_T']
+          self.assertEqual(t_dataset.compression, compression)
+          np.testing.assert_array_equal(t_dataset[:], self.sad.T)
+
+        # and read through it
+        sad_h5 = sad5.SAD5('%s/sad.h5' % out_dir, compute_norm=False)
+        np.testing.assert_array_equal(sad_h5.read_targets([3, 1, 3]), self.sad[:,[3,1,3]])
+        sad_h5.sad_h5_open.close()
+
+
+class TestChrSAD5(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(11)
+    cls.out_dir = tempfile.mkdtemp()
+    cls.sad_h5_path = '%s/sad' % cls.out_dir
+    num_targets, num_samples = 3, 40
+    target_labels = ['CAGE:a', 'DNASE:b', 'CAGE:c']
+
+    # SNPs on two chromosomes, in unsorted id and position order
+    cls.chr_snps = {'1': ['rs%d' % si for si in np.random.permutation(30)],
+                    '2': ['rs%d' % si for si in np.random.permutation(np.arange(30, 50))]}
+    cls.chr_pos = {chrm: np.random.permutation(np.arange(1000, 1000+100*len(snps), 100))
+                   for chrm, snps in cls.chr_snps.items()}
+    cls.chr_pos['2'][3] = cls.chr_pos['2'][7]
+    for chrm, snp_ids in cls.chr_snps.items():
+      os.makedirs('%s/chr%s' % (cls.sad_h5_path, chrm))
+      sad = cauchy.rvs(0, 0.1, size=(len(snp_ids), num_targets))
+      write_sad_h5('%s/chr%s/sad.h5' % (cls.sad_h5_path, chrm), sad,
+                   snp_ids, cls.chr_pos[chrm], target_labels)
+
+    # population VCF, of haplotypes in LD, with a SNP without scores
+    cls.hg19 = os.environ.get('HG19')
+    os.environ['HG19'] = cls.out_dir
+    pop_dir = '%s/popgen/1000G/phase3/eur' % cls.out_dir
+    os.makedirs(pop_dir)
+    pop_order = np.argsort(cls.chr_pos['1'])
+    pop_ids = [cls.chr_snps['1'][pi] for pi in pop_order] + ['rs_pop']
+    pop_pos = cls.chr_pos['1'][pop_order].tolist() + [cls.chr_pos['1'].max()+50]
+    block_alleles = np.random.randint(2, size=(1, 2, num_samples))
+    pop_alleles = np.repeat(block_alleles, len(pop_ids), axis=0)
+    pop_alleles ^= (np.random.uniform(size=pop_alleles.shape) < 0.2)
+    write_pop_vcf('%s/1000G.EUR.QC.1.vcf' % pop_dir, '1', pop_ids, pop_pos, pop_alleles)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.out_dir)
+    if cls.hg19 is None:
+      del os.environ['HG19']
+    else:
+      os.environ['HG19'] = cls.hg19
+
+  def test_index(self):
+    chr_sad = sad5.ChrSAD5(self.sad_h5_path)
+    index_dir = '%s/snp_index' % self.sad_h5_path
+    self.assertEqual(sorted(os.listdir(self.sad_h5_path)), ['chr1', 'chr2', 'snp_index'])
+
+    # lookups by id, with missing and overlong ids
+    snp_ids = ['rs35', 'rs3', 'rs999', 'rs0', 'rs%s' % ('9'*40), 'rs35']
+    snp_chrs, snp_rows = chr_sad.snps_chr_index(snp_ids)
+    for snp_id, snp_chr, snp_row in zip(snp_ids, snp_chrs, snp_rows):
+      if snp_id in self.chr_snps['1'] + self.chr_snps['2']:
+        self.assertEqual(chr_sad.chr_sad5[snp_chr].snps()[snp_row].decode(), snp_id)
+      else:
+        self.assertIsNone(snp_chr)
+        self.assertEqual(snp_row, -1)
+    self.assertEqual(chr_sad.snp_chr_index('rs999'), (None, None))
+    self.assertEqual(chr_sad.snp_chr_index('rs3')[0], '1')
+
+    # lookups by position, with shared and missing positions
+    for chrm in ['1', 'chr2']:
+      chr_pos = self.chr_pos[chrm[-1]]
+      for pos in [chr_pos[3], chr_pos[5], 7]:
+        np.testing.assert_array_equal(chr_sad.snps_pos_index(chrm, pos),
+                                      np.nonzero(chr_pos == pos)[0])
+    self.assertEqual(len(chr_sad.snps_pos_index('3', 1000)), 0)
+
+    # replaced whole for a newer sad.h5, leaving no temporary directory
+    open('%s/partial.npy' % index_dir, 'w').close()
+    index_time = os.path.getmtime('%s/pos_offsets.npy' % index_dir)
+    os.utime('%s/chr2/sad.h5' % self.sad_h5_path, (index_time+10, index_time+10))
+    chr_sad = sad5.ChrSAD5(self.sad_h5_path)
+    self.assertGreater(os.path.getmtime('%s/pos_offsets.npy' % index_dir), index_time)
+    self.assertFalse(os.path.isfile('%s/partial.npy' % index_dir))
+    self.assertEqual(sorted(os.listdir(self.sad_h5_path)), ['chr1', 'chr2', 'snp_index'])
+    self.assertEqual(chr_sad.snp_chr_index('rs35')[0], '2')
+
+  def test_retrieve(self):
+    chr_sad = sad5.ChrSAD5(self.sad_h5_path)
+    snp_id = self.chr_snps['1'][4]
+    snp_pos = self.chr_pos['1'][4]
+    snp_ldscores, ld_df, snps_scores = chr_sad.retrieve_snp(snp_id, 'chr1', snp_pos, ld_t=0)
+
+    # LD SNPs with scores, weighted by r
+    ld_rows = [self.chr_snps['1'].index(ld_snp) for ld_snp in ld_df.snp]
+    self.assertIn(snp_id, ld_df.snp.tolist())
+    self.assertNotIn('rs_pop', ld_df.snp.tolist())
+    self.assertGreater(len(ld_rows), 1)
+    np.testing.assert_allclose(snps_scores, chr_sad.chr_sad5['1'][ld_rows])
+    np.testing.assert_allclose(snp_ldscores, ld_df.r.values @ snps_scores)
+
+    # missing SNP
+    snp_ldscores, ld_df, snps_scores = chr_sad.retrieve_snp('rs999', '1', 500)
+    self.assertEqual(len(snp_ldscores), 0)
+    self.assertIsNone(snps_scores)
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
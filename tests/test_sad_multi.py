@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from basenji import sketch
+from basenji import vcf as bvcf
+import basenji_sad
+import basenji_sad_multi
+
+
+class TestCollectH5(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(24)
+    cls.out_dir = tempfile.mkdtemp()
+    cls.num_targets = 4
+    cls.sad_stats = ['SAD', 'SAX']
+
+    # jobs of SNPs, one empty, with ids of different widths
+    cls.job_snps = []
+    for pi, (num_snps, id_fmt) in enumerate([(37, 'rs%d'), (0, 'rs%d'), (55, 'rs1000000%d')]):
+      snp_lines = ['chr1\t%d\t%s\tA\tG' % (100*pi+si+1, id_fmt % si) for si in range(num_snps)]
+      cls.job_snps.append([bvcf.SNP(line) for line in snp_lines])
+
+    cls.job_stats = [{sad_stat: np.random.standard_cauchy((len(snps), cls.num_targets)).astype('float16')
+                      for sad_stat in cls.sad_stats} for snps in cls.job_snps]
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.out_dir)
+
+  def write_jobs(self, save_sketches):
+    """Write job sad.h5 files as basenji_sad.py does for sad_multi."""
+    out_dir = tempfile.mkdtemp(dir=self.out_dir)
+    target_ids = ['t%d' % ti for ti in range(self.num_targets)]
+    for pi, (snps, stats) in enumerate(zip(self.job_snps, self.job_stats)):
+      job_dir = '%s/job%d' % (out_dir, pi)
+      os.makedirs(job_dir)
+      sad_out = basenji_sad.initialize_output_h5(job_dir, self.sad_stats, snps,
+                                                 target_ids, target_ids, (16, 2), 'gzip')
+      sad_sketches = {}
+      for sad_stat, values in stats.items():
+        sad_out[sad_stat][:] = values
+        sad_sketches[sad_stat] = sketch.QuantileSketch(self.num_targets)
+        sad_sketches[sad_stat].update(values)
+      basenji_sad.write_pct(sad_out, self.sad_stats, sad_sketches, save_sketches)
+      sad_out.close()
+    return out_dir
+
+  def check_merge(self, virtual, exact_pct, save_sketches):
+    out_dir = self.write_jobs(save_sketches)
+    basenji_sad_multi.collect_h5('sad.h5', out_dir, len(self.job_snps),
+                                 virtual=virtual, exact_pct=exact_pct, block_values=64)
+
+    # moved with its jobs, for relative virtual sources
+    moved_dir = '%s_moved' % out_dir
+    os.rename(out_dir, moved_dir)
+
+    with h5py.File('%s/sad.h5' % moved_dir, 'r') as sad_h5_open:
+      # strings, concatenated and fit to the widest
+      snp_ids = np.concatenate([[snp.rsid for snp in snps] for snps in self.job_snps])
+      np.testing.assert_array_equal(sad_h5_open['snp'][:].astype('U'), snp_ids)
+      self.assertEqual(sad_h5_open['snp'].dtype.itemsize, max([len(si) for si in snp_ids]))
+      snp_pos = np.concatenate([[snp.pos for snp in snps] for snps in self.job_snps])
+      np.testing.assert_array_equal(sad_h5_open['pos'][:], snp_pos)
+
+      for sad_stat in self.sad_stats:
+        stat_dataset = sad_h5_open[sad_stat]
+        self.assertEqual(stat_dataset.is_virtual, virtual)
+        stat_values = np.concatenate([stats[sad_stat] for stats in self.job_stats])
+        np.testing.assert_array_equal(stat_dataset[:], stat_values)
+
+        # percentiles, exactly or from the merged sketches
+        percentiles = sad_h5_open['percentiles'][:]
+        if exact_pct or not save_sketches:
+          stat_pct = np.percentile(stat_values, 100*percentiles, axis=0).T
+        else:
+          stat_sketch = sketch.QuantileSketch(self.num_targets)
+          stat_sketch.update(stat_values)
+          stat_pct = stat_sketch.quantiles(percentiles)
+        np.testing.assert_array_equal(sad_h5_open['%s_pct' % sad_stat][:],
+                                      stat_pct.astype('float16'))
+        self.assertNotIn('%s_sketch' % sad_stat, sad_h5_open)
+
+  def test_copy(self):
+    self.check_merge(virtual=False, exact_pct=False, save_sketches=True)
+    self.check_merge(virtual=False, exact_pct=True, save_sketches=True)
+    self.check_merge(virtual=False, exact_pct=False, save_sketches=False)
+
+  def test_virtual(self):
+    self.check_merge(virtual=True, exact_pct=False, save_sketches=True)
+    self.check_merge(virtual=True, exact_pct=True, save_sketches=True)
+    self.check_merge(virtual=True, exact_pct=False, save_sketches=False)
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+from optparse import Values
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pysam
+import tensorflow as tf
+
+from basenji import vcf as bvcf
+import basenji_sad
+
+
+class TestSADSNPs(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(7)
+    tf.random.set_seed(7)
+    cls.out_dir = tempfile.mkdtemp()
+    cls.seq_length = 64
+
+    # genome
+    cls.genome = ''.join(np.random.choice(list('ACGT'), size=1000))
+    cls.fasta_file = '%s/genome.fa' % cls.out_dir
+    with open(cls.fasta_file, 'w') as fasta_out:
+      print('>chr1\n%s' % cls.genome, file=fasta_out)
+    pysam.faidx(cls.fasta_file)
+
+    sequence = tf.keras.Input(shape=(cls.seq_length, 4))
+    current = tf.keras.layers.Conv1D(3, 5, padding='same')(sequence)
+    current = tf.keras.layers.AveragePooling1D(4)(current)
+    cls.model = tf.keras.Model(inputs=sequence, outputs=current)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.out_dir)
+
+  def other_nt(self, nt):
+    return 'A' if nt != 'A' else 'C'
+
+  def snp_line(self, pos, ref, alt):
+    return 'chr1\t%d\trs%d\t%s\t%s' % (pos, pos, ref, alt)
+
+  def snp_codings(self, snp):
+    snp_clusters = basenji_sad.cluster_snps([snp], self.seq_length, 0)
+    snp_clusters[0].delimit(self.seq_length)
+    genome_open = pysam.Fastafile(self.fasta_file)
+    # N padding samples nucleotides from the python RNG
+    random.seed(11)
+    snp_1hots = snp_clusters[0].get_1hots(genome_open)
+    genome_open.close()
+    ref_ci, alt_ci = snp_clusters[0].codings[0]
+    return snp_clusters[0], [snp_1hots[ref_ci], snp_1hots[alt_ci]]
+
+  def baseline_codings(self, snp):
+    genome_open = pysam.Fastafile(self.fasta_file)
+    random.seed(11)
+    snp_1hots = bvcf.snp_seq1(snp, self.seq_length, genome_open)
+    genome_open.close()
+    return snp_1hots
+
+  def test_codings(self):
+    pos = 300
+    genome_nt = self.genome[pos-1]
+    genome_mnp = self.genome[pos-1:pos+2]
+    mnp = ''.join([self.other_nt(nt) for nt in genome_mnp])
+    genome_del = self.genome[pos-1:pos+3]
+    other_del = genome_nt + ''.join([self.other_nt(nt) for nt in genome_del[1:]])
+
+    # matching alleles, multi-nucleotide substitutions, deletions, and insertions
+    for ref, alt in [(genome_nt, self.other_nt(genome_nt)), (genome_mnp, mnp),
+                     (genome_del, genome_nt), (genome_del[:2], genome_nt),
+                     (genome_nt, genome_nt + 'GGG'), (genome_nt, genome_nt + 'TG')]:
+      snp = bvcf.SNP(self.snp_line(pos, ref, alt))
+      snp_cluster, snp_1hots = self.snp_codings(snp)
+      self.assertEqual(snp_cluster.swapped, [False])
+      self.assertEqual(snp_cluster.skipped, [False])
+      np.testing.assert_array_equal(snp_1hots, self.baseline_codings(snp))
+
+    # alternative allele matches the genome
+    for ref, alt in [(self.other_nt(genome_nt), genome_nt), (mnp, genome_mnp),
+                     (other_del, genome_nt), (self.other_nt(genome_nt), genome_del)]:
+      snp = bvcf.SNP(self.snp_line(pos, ref, alt))
+      snp_cluster, snp_1hots = self.snp_codings(snp)
+      self.assertEqual(snp_cluster.swapped, [True])
+      np.testing.assert_array_equal(snp_1hots, self.baseline_codings(snp))
+
+    # neither allele matches the genome
+    other_nts = [nt for nt in 'ACGT' if nt != genome_nt]
+    snp = bvcf.SNP(self.snp_line(pos, other_nts[0], other_nts[1]))
+    snp_cluster, snp_1hots = self.snp_codings(snp)
+    self.assertEqual(snp_cluster.skipped, [True])
+    self.assertEqual(snp_cluster.codings, [(0, 0)])
+    self.assertEqual(self.baseline_codings(snp), [])
+
+  def test_score(self):
+    positions = [200, 230, 500, 700, 900]
+    genome_nts = [self.genome[pos-1] for pos in positions]
+    other_nts = [self.other_nt(nt) for nt in genome_nts]
+    genome_del = self.genome[positions[4]-1:positions[4]+4]
+
+    # genome ref, swapped, unmatched, genome ref, and deletion records
+    snp_lines = [self.snp_line(positions[0], genome_nts[0], other_nts[0]),
+                 self.snp_line(positions[1], other_nts[1], genome_nts[1]),
+                 self.snp_line(positions[2], other_nts[2], other_nts[2]),
+                 self.snp_line(positions[3], genome_nts[3], other_nts[3]),
+                 self.snp_line(positions[4], genome_del, genome_nts[4])]
+    swap_lines = [self.snp_line(positions[1], genome_nts[1], other_nts[1])]
+
+    options = Values({'center_pct':0.5, 'genome_cache':False,
+                      'genome_fasta':self.fasta_file, 'log_pseudo':1,
+                      'sad_stats':['SAD'], 'threads':False})
+    sad = self.score_snps(snp_lines, options)
+    swap_sad = self.score_snps(swap_lines, options)
+
+    self.assertTrue(np.abs(sad[1]).max() > 0)
+    np.testing.assert_allclose(sad[1], -swap_sad[0], atol=2e-3)
+    np.testing.assert_array_equal(sad[2], 0)
+    self.assertTrue(np.abs(sad[[0,3]]).max() > 0)
+
+    # the deletion scores its own reference and alternative codings
+    del_preds = self.model.predict(np.array(self.baseline_codings(bvcf.SNP(snp_lines[4]))))
+    np.testing.assert_allclose(sad[4], (del_preds[1] - del_preds[0]).sum(axis=0),
+                               rtol=2e-3, atol=2e-3)
+
+  def score_snps(self, snp_lines, options):
+    snps = [bvcf.SNP(line) for line in snp_lines]
+    num_targets = self.model.output_shape[-1]
+    target_ids = ['t%d' % ti for ti in range(num_targets)]
+    sad_out = basenji_sad.initialize_output_h5(self.out_dir, options.sad_stats,
+                                               snps, target_ids, ['']*num_targets)
+    basenji_sad.score_snps(self.model, snps, sad_out, self.seq_length, 2, options)
+    sad = sad_out['SAD'][:].astype('float32')
+    sad_out.close()
+    return sad
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+from queue import Queue
+import unittest
+
+import numpy as np
+
+from basenji import dna_io
+from basenji import seqnn
+import basenji_sat_bed
+
+
+def per_mutant_scores(seq_preds, seq_1hot_mut, sad_stat, center_slice):
+  """Score mutations one prediction and one position at a time."""
+  # summarize each prediction
+  preds_mut0 = seq_preds[0]
+  seq_preds_stat = []
+  for preds_mut in seq_preds:
+    if sad_stat == 'sum':
+      seq_preds_stat.append(preds_mut.sum(axis=0))
+    elif sad_stat == 'center':
+      seq_preds_stat.append(preds_mut[center_slice[0]:center_slice[1]].sum(axis=0))
+    else:
+      seq_preds_stat.append(np.sqrt(((preds_mut-preds_mut0)**2).sum(axis=0)))
+  seq_preds_stat = np.array(seq_preds_stat)
+
+  # scatter by position and nucleotide
+  mut_len = seq_1hot_mut.shape[0]
+  seq_scores = np.zeros((mut_len, 4, seq_preds_stat.shape[1]), dtype='float32')
+  pi = 1
+  for mi in range(mut_len):
+    for ni in range(4):
+      if seq_1hot_mut[mi,ni]:
+        seq_scores[mi,ni,:] = seq_preds_stat[0,:]
+      else:
+        seq_scores[mi,ni,:] = seq_preds_stat[pi,:]
+        pi += 1
+
+  # normalize positions
+  seq_scores -= seq_scores.mean(axis=1, keepdims=True)
+  return seq_scores
+
+
+class TestSatMutStats(unittest.TestCase):
+  def test_scores(self):
+    np.random.seed(14)
+    mut_len, preds_length, num_targets = 9, 16, 3
+    center_slice = (7, 9)
+    sad_stats = ['sum', 'center', 'scd']
+
+    seq_1hot_mut = dna_io.dna_1hot(''.join(np.random.choice(list('ACGT'), mut_len)))
+    num_preds = 1 + int((seq_1hot_mut == 0).sum())
+    seq_preds = np.random.uniform(size=(num_preds, preds_length, num_targets))
+    seq_preds = seq_preds.astype('float32')
+
+    # predictions, summarized in uneven blocks as they stream
+    seq_pred_stats = basenji_sat_bed.satmut_stats(iter(seq_preds), sad_stats,
+                                                  center_slice, block_size=4)
+    for sad_stat in sad_stats:
+      self.assertEqual(seq_pred_stats[sad_stat].shape, (num_preds, num_targets))
+
+    # write through the score worker
+    scores_h5 = {sad_stat:np.zeros((1, mut_len, 4, num_targets), dtype='float16')
+                 for sad_stat in sad_stats}
+    score_queue = Queue()
+    score_worker = basenji_sat_bed.ScoreWorker(score_queue, scores_h5, sad_stats)
+    score_worker.start()
+    score_queue.put((seq_1hot_mut, seq_pred_stats, 0))
+    score_queue.join()
+    self.assertIsNone(score_worker.error)
+
+    for sad_stat in sad_stats:
+      seq_scores = per_mutant_scores(seq_preds, seq_1hot_mut, sad_stat, center_slice)
+      np.testing.assert_allclose(scores_h5[sad_stat][0], seq_scores.astype('float16'),
+                                 rtol=1e-3, atol=1e-3)
+
+
+class TestSatMutGrad(unittest.TestCase):
+  def test_linear(self):
+    np.random.seed(15)
+    # positive convolutions of one hot coding pass through relu, so that
+    # predictions are linear, and first order scores exact, near sequences
+    params_model = {
+      'seq_length': 64,
+      'activation': 'relu',
+      'trunk': [{'name': 'Conv1D', 'filters': 8, 'kernel_size': 5,
+                 'strides': 4, 'padding': 'same',
+                 'kernel_initializer': {'class_name': 'RandomUniform',
+                                        'config': {'minval': 0.1, 'maxval': 1}}}],
+      'head_human': {'name': 'dense', 'units': 5, 'activation': 'linear'}
+    }
+    seqnn_model = seqnn.SeqNN(params_model)
+    model = seqnn_model.models[0]
+    mut_start, mut_len = 24, 12
+    center_slice = (7, 9)
+    sad_stats = ['sum', 'center']
+
+    seqs_dna = [''.join(np.random.choice(list('ACGT'), 64)) for si in range(3)]
+    seqs_mut_1hot = np.array([dna_io.dna_1hot(seq_dna[mut_start:mut_start+mut_len])
+                              for seq_dna in seqs_dna])
+
+    # first order scores, in vectorized groups of two targets
+    scores_h5 = {sad_stat:np.zeros((3, mut_len, 4, 5), dtype='float16')
+                 for sad_stat in sad_stats}
+    basenji_sat_bed.satmut_grad(seqnn_model, seqs_dna, seqs_mut_1hot, mut_start,
+                                scores_h5, sad_stats, center_slice,
+                                batch_size=2, group_size=2)
+
+    # exact mutagenesis
+    seqs_gen = basenji_sat_bed.satmut_gen(seqs_dna, seqs_mut_1hot, mut_start)
+    preds = model.predict(np.array(list(seqs_gen), dtype='float32'), verbose=0)
+    pi = 0
+    for si in range(3):
+      num_preds = 1 + 3*mut_len
+      for sad_stat in sad_stats:
+        seq_scores = per_mutant_scores(preds[pi:pi+num_preds], seqs_mut_1hot[si],
+                                       sad_stat, center_slice)
+        np.testing.assert_allclose(scores_h5[sad_stat][si], seq_scores,
+                                   rtol=1e-2, atol=2e-2)
+      pi += num_preds
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from basenji import dna_io
+from basenji import layers
+from basenji import seqnn
+
+
+def make_params(augment_rc=False):
+  return {
+    'seq_length': 64,
+    'activation': 'gelu',
+    'augment_rc': augment_rc,
+    'trunk': [{'name': 'conv_block', 'filters': 8, 'kernel_size': 5, 'pool_size': 4}],
+    'head_human': {'name': 'dense', 'units': 5, 'activation': 'softplus'},
+    'head_mouse': {'name': 'dense', 'units': 3, 'activation': 'softplus'}
+  }
+
+
+class TestSeqNN(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(17)
+    tf.random.set_seed(17)
+    seqs_dna = [''.join(np.random.choice(list('ACGT'), 64)) for si in range(4)]
+    cls.seqs_1hot = dna_io.dnas_1hot(seqs_dna).astype('float32')
+
+  def test_slice(self):
+    for augment_rc in [False, True]:
+      seqnn_model = seqnn.SeqNN(make_params(augment_rc))
+      preds = seqnn_model.model.predict(self.seqs_1hot, verbose=0)
+
+      seqnn_model.build_slice([3, 0])
+      self.assertTrue(any(isinstance(layer, layers.DenseSlice)
+                          for layer in seqnn_model.model.layers))
+      preds_slice = seqnn_model.model.predict(self.seqs_1hot, verbose=0)
+      np.testing.assert_allclose(preds_slice, preds[...,[3,0]], rtol=1e-5, atol=1e-6)
+      self.assertIs(seqnn_model.predict_model(), seqnn_model.model)
+
+  def test_multi(self):
+    seqnn_model = seqnn.SeqNN(make_params())
+    preds0 = seqnn_model.models[0].predict(self.seqs_1hot, verbose=0)
+    preds1 = seqnn_model.models[1].predict(self.seqs_1hot, verbose=0)
+
+    model_multi = seqnn_model.build_multi([0, 1, 0], [None, [2], [4, 1]])
+    preds_multi = model_multi.predict(self.seqs_1hot, verbose=0)
+    self.assertEqual(len(preds_multi), 3)
+    np.testing.assert_allclose(preds_multi[0], preds0, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(preds_multi[1], preds1[...,[2]], rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(preds_multi[2], preds0[...,[4,1]], rtol=1e-5, atol=1e-6)
+
+    # one trunk convolution
+    conv_layers = [layer for layer in model_multi.layers
+                   if isinstance(layer, tf.keras.layers.Conv1D)]
+    self.assertEqual(len(conv_layers), 1)
+
+  def test_multi_ensemble(self):
+    seqnn_model = seqnn.SeqNN(make_params())
+    model_multi = seqnn_model.build_multi([0, 1], [[4, 1], None])
+    self.assertIs(seqnn_model.predict_model(), model_multi)
+    self.assertEqual(seqnn_model.num_targets(), 5)
+
+    # average forward and reverse complement predictions of each head
+    seqs_1hot_rc = self.seqs_1hot[:,::-1,::-1]
+    preds_fwd = model_multi.predict(self.seqs_1hot, verbose=0)
+    preds_rev = model_multi.predict(seqs_1hot_rc, verbose=0)
+    preds = [(pf + pr[:,::-1])/2 for pf, pr in zip(preds_fwd, preds_rev)]
+
+    for ensemble_batch in [None, 0, 1]:
+      seqnn_model.build_ensemble(True, [0], ensemble_batch=ensemble_batch)
+      self.assertIs(seqnn_model.predict_model(), seqnn_model.ensemble)
+      preds_ens = seqnn_model.predict_model().predict(self.seqs_1hot, verbose=0)
+      self.assertEqual(len(preds_ens), 2)
+      for pe, p in zip(preds_ens, preds):
+        np.testing.assert_allclose(pe, p, rtol=1e-5, atol=1e-6)
+
+  def test_ensemble_batch(self):
+    seqnn_model = seqnn.SeqNN(make_params())
+    seqnn_model.build_ensemble(True, [-1, 0, 1])
+    preds = seqnn_model.ensemble.predict(self.seqs_1hot, verbose=0)
+
+    # one call, and calls capped at 5 of 24 stacked sequences
+    for ensemble_batch in [0, 5]:
+      seqnn_model.build_ensemble(True, [-1, 0, 1], ensemble_batch=ensemble_batch)
+      self.assertTrue(any(isinstance(layer, layers.EnsembleBatch)
+                          for layer in seqnn_model.ensemble.layers))
+      preds_batch = seqnn_model.ensemble.predict(self.seqs_1hot, verbose=0)
+      np.testing.assert_allclose(preds_batch, preds, rtol=1e-5, atol=1e-6)
+
+
+  def test_gradients(self):
+    seqnn_model = seqnn.SeqNN(make_params())
+    model = seqnn_model.models[0]
+    pos_slice = slice(4, 12)
+
+    # one target per pass, and vectorized groups of targets
+    grads = seqnn_model.gradients(self.seqs_1hot, pos_slice=pos_slice,
+                                  group_size=1, batch_size=3)
+    self.assertEqual(grads.shape, (4, 64, 4, 5))
+    grads_group = seqnn_model.gradients(self.seqs_1hot, pos_slice=pos_slice,
+                                        group_size=3, batch_size=3)
+    np.testing.assert_allclose(grads_group, grads, rtol=1e-5, atol=1e-6)
+
+    # central finite differences
+    def preds_sum(x):
+      preds = model.predict(x.astype('float32'), verbose=0)
+      return preds[:,pos_slice].astype('float64').sum(axis=1)
+    eps = 1e-3
+    for pos, nt in [(0, 0), (20, 2), (41, 3), (63, 1)]:
+      x_plus = self.seqs_1hot.copy()
+      x_plus[:,pos,nt] += eps
+      x_minus = self.seqs_1hot.copy()
+      x_minus[:,pos,nt] -= eps
+      grads_fd = (preds_sum(x_plus) - preds_sum(x_minus)) / (2*eps)
+      np.testing.assert_allclose(grads[:,pos,nt], grads_fd, rtol=1e-2, atol=1e-3)
+
+    # summed target groups
+    grads_sum = seqnn_model.gradients(self.seqs_1hot, pos_slice=pos_slice,
+                                      target_groups=[[0, 3], [4]],
+                                      seq_slice=slice(10, 20))
+    np.testing.assert_allclose(grads_sum[...,0], grads[:,10:20,:,[0,3]].sum(axis=-1),
+                               rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(grads_sum[...,1], grads[:,10:20,:,4], rtol=1e-4, atol=1e-5)
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from basenji import sketch
+
+
+class TestQuantileSketch(unittest.TestCase):
+  def setUp(self):
+    np.random.seed(11)
+    self.values = 0.1*np.random.standard_cauchy(size=(3000, 4))
+    self.values[:50] = 0
+    self.qs = np.array([0, 0.001, 0.01, 0.25, 0.5, 0.75, 0.99, 0.999, 1])
+
+  def test_quantiles(self):
+    qsketch = sketch.QuantileSketch(4, rel_acc=0.01)
+    for si in range(0, 3000, 32):
+      qsketch.update(self.values[si:si+32])
+
+    sketch_q = qsketch.quantiles(self.qs)
+    exact_q = np.percentile(self.values, 100*self.qs, axis=0, method='nearest').T
+    self.assertEqual(sketch_q.shape, (4, len(self.qs)))
+    np.testing.assert_allclose(sketch_q, exact_q, rtol=0.01, atol=qsketch.min_value)
+
+  def test_merge(self):
+    qsketch = sketch.QuantileSketch(4)
+    qsketch.update(self.values)
+
+    qsketch1 = sketch.QuantileSketch(4)
+    qsketch1.update(self.values[:1000])
+    qsketch2 = sketch.QuantileSketch(4)
+    qsketch2.update(self.values[1000:])
+
+    # round trip through HDF5
+    temp_dir = tempfile.mkdtemp()
+    with h5py.File('%s/sketch.h5' % temp_dir, 'w') as sketch_h5:
+      qsketch2.write(sketch_h5, 'SAD_sketch')
+    with h5py.File('%s/sketch.h5' % temp_dir, 'r') as sketch_h5:
+      qsketch2 = sketch.QuantileSketch.read(sketch_h5, 'SAD_sketch')
+    shutil.rmtree(temp_dir)
+
+    qsketch1.merge(qsketch2)
+    np.testing.assert_array_equal(qsketch1.counts, qsketch.counts)
+    np.testing.assert_array_equal(qsketch1.quantiles(self.qs), qsketch.quantiles(self.qs))
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
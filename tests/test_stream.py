@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from basenji import dna_io
+from basenji import stream
+
+
+class TestPredStreamGen(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(13)
+    tf.random.set_seed(13)
+    seqs_dna = [''.join(np.random.choice(list('ACGT'), 32)) for si in range(11)]
+    cls.seqs_1hot = dna_io.dnas_1hot(seqs_dna)
+
+    sequence = tf.keras.Input(shape=(32, 4))
+    current = tf.keras.layers.Conv1D(3, 5, padding='same')(sequence)
+    current = tf.keras.layers.AveragePooling1D(4)(current)
+    cls.model = tf.keras.Model(inputs=sequence, outputs=current)
+
+  def test_stream(self):
+    preds = self.model.predict(self.seqs_1hot.astype('float32'), verbose=0)
+
+    # uneven chunks and a partial final batch
+    preds_stream = stream.PredStreamGen(self.model, iter(self.seqs_1hot),
+                                        batch_size=3, stream_seqs=5)
+    self.assertEqual(preds_stream.stream_seqs, 6)
+
+    # random access within chunks
+    for si in [1, 0, 5, 2, 7, 6, 10, 9, 8]:
+      np.testing.assert_allclose(preds_stream[si], preds[si], rtol=1e-5, atol=1e-6)
+
+    with self.assertRaises(IndexError):
+      preds_stream[11]
+
+  def test_multi_output(self):
+    model_multi = tf.keras.Model(inputs=self.model.inputs,
+      outputs=[self.model.output, tf.keras.layers.Dense(2)(self.model.output)])
+    preds = model_multi.predict(self.seqs_1hot.astype('float32'), verbose=0)
+
+    # list of outputs
+    preds_stream = stream.PredStreamGen(model_multi, iter(self.seqs_1hot),
+                                        batch_size=3, stream_seqs=5)
+    for si in [1, 0, 7, 10]:
+      self.assertEqual(len(preds_stream[si]), 2)
+      for oi in range(2):
+        np.testing.assert_allclose(preds_stream[si][oi], preds[oi][si], rtol=1e-5, atol=1e-6)
+
+    # outputs concatenated along targets
+    preds_stream = stream.PredStreamGen(model_multi, iter(self.seqs_1hot),
+                                        batch_size=3, concat_outputs=True)
+    for si in range(11):
+      preds_si = np.concatenate([preds[0][si], preds[1][si]], axis=-1)
+      np.testing.assert_allclose(preds_stream[si], preds_si, rtol=1e-5, atol=1e-6)
+
+  def test_generator_error(self):
+    def seqs_gen():
+      yield self.seqs_1hot[0]
+      raise ValueError('bad sequence')
+
+    preds_stream = stream.PredStreamGen(self.model, seqs_gen(), batch_size=2)
+    with self.assertRaises(ValueError):
+      preds_stream[0]
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
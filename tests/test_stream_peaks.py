@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import os
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+import basenji_test
+
+
+def read_peaks(peaks_file):
+  peaks = np.loadtxt(peaks_file)
+  return peaks[:,1].astype('int64'), peaks[:,2], peaks[:,3]
+
+
+class TestStreamPeaks(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(6)
+    num_seqs, target_length = 40, 256
+
+    # coverage around different means, with enriched regions
+    target_means = np.array([0.5, 5, 50, 300])
+    num_targets = len(target_means)
+    signal = np.random.gamma(0.3, 1/0.3, size=(num_seqs, target_length, num_targets))
+    cls.targets = np.random.poisson(signal * target_means).astype('float32')
+    cls.preds = (signal * target_means * np.random.lognormal(0, 0.5, size=signal.shape))
+    cls.preds = cls.preds.astype('float32')
+
+  def test_peaks(self):
+    peaks_fd, peaks_file = tempfile.mkstemp()
+    os.close(peaks_fd)
+    basenji_test.test_peaks(self.preds, self.targets, peaks_file)
+    exact_peaks, exact_aurocs, exact_auprcs = read_peaks(peaks_file)
+
+    # stream in batches, sampling bins as stream_test does
+    ds_indexes = np.arange(0, self.targets.shape[1], 8)
+    stream_peaks = basenji_test.StreamPeaks(self.targets.shape[2])
+    for bi in range(0, self.targets.shape[0], 3):
+      stream_peaks.update(self.targets[bi:bi+3,ds_indexes], self.preds[bi:bi+3,ds_indexes])
+    stream_peaks.write(peaks_file)
+    num_peaks, aurocs, auprcs = read_peaks(peaks_file)
+    os.remove(peaks_file)
+
+    self.assertTrue((exact_peaks > 0).all())
+    np.testing.assert_array_equal(num_peaks, exact_peaks)
+    np.testing.assert_allclose(aurocs, exact_aurocs, atol=0.02)
+    np.testing.assert_allclose(auprcs, exact_auprcs, atol=0.05)
+
+  def test_blocks(self):
+    # one target per block, or all in one
+    block_peaks = basenji_test.StreamPeaks(self.targets.shape[2], block_bins=1)
+    full_peaks = basenji_test.StreamPeaks(self.targets.shape[2], block_bins=2**30)
+    for bi in range(0, self.targets.shape[0], 7):
+      block_peaks.update(self.targets[bi:bi+7], self.preds[bi:bi+7])
+      full_peaks.update(self.targets[bi:bi+7], self.preds[bi:bi+7])
+    np.testing.assert_array_equal(block_peaks.value_counts, full_peaks.value_counts)
+    np.testing.assert_array_equal(block_peaks.hist, full_peaks.hist)
+    self.assertEqual(block_peaks.hist.sum(), self.targets.size)
+
+  def test_stream_dataset(self):
+    h5_fd, h5_file = tempfile.mkstemp(suffix='.h5')
+    os.close(h5_fd)
+    with h5py.File(h5_file, 'w') as h5_open:
+      dset = basenji_test.h5_stream_dataset(h5_open, 'preds', 1024, 5313)
+      self.assertLessEqual(np.prod(dset.chunks) * 2, 2**20)
+      basenji_test.h5_append(dset, np.ones((2, 1024, 5313), dtype='float16'))
+      self.assertEqual(dset.shape, (2, 1024, 5313))
+    os.remove(h5_file)
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from basenji import metrics
+from basenji import seqnn
+from basenji import trainer
+
+
+def make_params():
+  return {
+    'seq_length': 64,
+    'activation': 'gelu',
+    'trunk': [{'name': 'conv_block', 'filters': 8, 'kernel_size': 5, 'pool_size': 4}],
+    'head_human': {'name': 'dense', 'units': 3, 'activation': 'softplus'},
+    'head_mouse': {'name': 'dense', 'units': 2, 'activation': 'softplus'}
+  }
+
+
+class ArrayDataset:
+  """Minimal train dataset of repeated batches from arrays."""
+  def __init__(self, x, y, batch_size):
+    self.num_seqs = x.shape[0]
+    self.batch_size = batch_size
+    dataset = tf.data.Dataset.from_tensor_slices((x, y))
+    self.dataset = dataset.repeat().batch(batch_size)
+
+  def batches_per_epoch(self):
+    return self.num_seqs // self.batch_size
+
+
+class TestTrainer(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(19)
+    cls.x = np.eye(4, dtype='float32')[np.random.randint(0, 4, size=(4, 64))]
+    cls.y = np.random.poisson(2, size=(4, 16, 3)).astype('float32')
+    cls.y1 = np.random.poisson(2, size=(4, 16, 2)).astype('float32')
+
+  def train_weights(self, accumulate_steps, batch_size, epochs=3):
+    params_train = {'optimizer': 'sgd', 'learning_rate': 0.05, 'momentum': 0.9,
+                    'accumulate_steps': accumulate_steps,
+                    'warmup_steps': 2, 'decay_steps': 2, 'decay_rate': 0.5}
+    tf.keras.utils.set_random_seed(1)
+    seqnn_model = seqnn.SeqNN(make_params())
+    seqnn_trainer = trainer.Trainer(params_train, [], [], None)
+    train_step = seqnn_trainer.make_train_step(seqnn_model.model,
+      tf.keras.metrics.Mean(), metrics.PearsonR(3))
+    for ei in range(epochs):
+      for bi in range(0, len(self.x), batch_size):
+        train_step(self.x[bi:bi+batch_size], self.y[bi:bi+batch_size])
+    self.assertEqual(int(seqnn_trainer.optimizer.iterations), epochs)
+    return [w.numpy() for w in seqnn_model.model.trainable_weights]
+
+  def test_accumulate(self):
+    weights_full = self.train_weights(1, 4)
+    weights_accum = self.train_weights(2, 2)
+    for wf, wa in zip(weights_full, weights_accum):
+      np.testing.assert_allclose(wf, wa, rtol=1e-4, atol=1e-5)
+
+  def test_multi_step(self):
+    """Dispatching on the head index matches per-model train steps."""
+    params_train = {'optimizer': 'adam', 'learning_rate': 0.01}
+    y1_pad = np.concatenate([self.y1, np.zeros((4, 16, 1), dtype='float32')], axis=-1)
+
+    weights = []
+    for multi in [False, True]:
+      tf.keras.utils.set_random_seed(1)
+      seqnn_model = seqnn.SeqNN(make_params())
+      seqnn_trainer = trainer.Trainer(params_train, [], [], None)
+      train_metrics = [[tf.keras.metrics.Mean() for di in range(2)],
+                       [metrics.PearsonR(3), metrics.PearsonR(2)],
+                       [metrics.R2(3), metrics.R2(2)]]
+      if multi:
+        train_step = seqnn_trainer.make_multi_train_step(seqnn_model.models, *train_metrics)
+        train_step(self.x, self.y, tf.constant(0))
+        train_step(self.x, y1_pad, tf.constant(1))
+      else:
+        variables = {tv.ref(): tv for model in seqnn_model.models
+                     for tv in model.trainable_variables}
+        seqnn_trainer.optimizer.build([vr.deref() for vr in variables])
+        for di, y in enumerate([self.y, self.y1]):
+          train_step = seqnn_trainer.make_train_step(seqnn_model.models[di],
+            *[tm[di] for tm in train_metrics])
+          train_step(self.x, y)
+      weights.append([w.numpy() for w in seqnn_model.model.trainable_weights])
+      weights[-1] += [w.numpy() for w in seqnn_model.models[1].trainable_weights]
+
+    for wp, wm in zip(*weights):
+      np.testing.assert_allclose(wp, wm, rtol=1e-4, atol=1e-5)
+
+  def test_multi_dataset(self):
+    """The combined dataset follows the epoch proportions, padding targets."""
+    train_data = [ArrayDataset(self.x, self.y, 1), ArrayDataset(self.x[:2], self.y1[:2], 1)]
+    seqnn_model = seqnn.SeqNN(make_params())
+    seqnn_trainer = trainer.Trainer({}, train_data, [], None)
+    dataset = seqnn_trainer.make_multi_dataset(seqnn_model.models)
+
+    epoch_batches = len(seqnn_trainer.dataset_indexes)
+    self.assertEqual(epoch_batches, 6)
+    batches = list(dataset.take(2*epoch_batches).as_numpy_iterator())
+    for ei in range(2):
+      epoch_di = [di for x, y, di in batches[ei*epoch_batches:(ei+1)*epoch_batches]]
+      self.assertEqual(sorted(epoch_di), [0, 0, 0, 0, 1, 1])
+    for x, y, di in batches:
+      self.assertEqual(y.shape, (1, 16, 3))
+      if di == 1:
+        self.assertTrue((y[..., 2] == 0).all())
+
+  def test_warmup(self):
+    schedule = trainer.WarmUp(0.1, 4,
+      tf.keras.optimizers.schedules.ExponentialDecay(0.1, 2, 0.5, staircase=True))
+    lrs = [float(schedule(step)) for step in range(7)]
+    np.testing.assert_allclose(lrs, [0.025, 0.05, 0.075, 0.1, 0.1, 0.1, 0.05], rtol=1e-6)
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright 2020 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pysam
+
+from basenji import vcf
+
+
+def snp_tuple(snp):
+  return (snp.chr, snp.pos, snp.rsid, snp.ref_allele, snp.alt_alleles, snp.flipped)
+
+
+class TestVCF(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    np.random.seed(22)
+    cls.out_dir = tempfile.mkdtemp()
+
+    # genome
+    cls.genome = ''.join(np.random.choice(list('ACGT'), size=2000))
+    cls.fasta_file = '%s/genome.fa' % cls.out_dir
+    with open(cls.fasta_file, 'w') as fasta_out:
+      print('>chr1\n%s' % cls.genome, file=fasta_out)
+    pysam.faidx(cls.fasta_file)
+
+    # SNPs, with every third flipped relative to the genome
+    cls.vcf_lines = []
+    cls.expected = []
+    for si, pos in enumerate(range(10, 1990, 20)):
+      ref = cls.genome[pos-1]
+      alt = 'A' if ref != 'A' else 'C'
+      flip = (si % 3 == 0)
+      vcf_ref, vcf_alt = (alt, ref) if flip else (ref, alt)
+      chrom = '1' if si % 2 else 'chr1'
+      rsid = '.' if si % 5 == 0 else 'rs%d' % si
+      cls.vcf_lines.append('%s\t%d\t%s\t%s\t%s\t.\tPASS\t.' % (chrom, pos, rsid, vcf_ref, vcf_alt))
+      exp_rsid = 'chr1:%d' % pos if rsid == '.' else rsid
+      cls.expected.append(('chr1', pos, exp_rsid, vcf_ref, [vcf_alt], False))
+
+    cls.vcf_file = '%s/snps.vcf' % cls.out_dir
+    with open(cls.vcf_file, 'w') as vcf_out:
+      print('##fileformat=VCFv4.2', file=vcf_out)
+      print('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO', file=vcf_out)
+      print('\n'.join(cls.vcf_lines), file=vcf_out)
+
+    cls.vcf_gz_file = '%s/snps.vcf.gz' % cls.out_dir
+    with open(cls.vcf_file, 'rb') as vcf_in:
+      with gzip.open(cls.vcf_gz_file, 'wb') as vcf_out:
+        vcf_out.write(vcf_in.read())
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.out_dir)
+
+  def test_read(self):
+    self.assertEqual(vcf.vcf_count(self.vcf_file), len(self.expected))
+    for vcf_file in [self.vcf_file, self.vcf_gz_file]:
+      snp_arrays = vcf.vcf_arrays(vcf_file, chunk_bytes=100)
+      self.assertEqual(len(snp_arrays), len(self.expected))
+      self.assertEqual([snp_tuple(snp) for snp in snp_arrays.snps()], self.expected)
+
+    snps = vcf.vcf_snps(self.vcf_file, start_i=3, end_i=7)
+    self.assertEqual([snp_tuple(snp) for snp in snps], self.expected[3:7])
+
+    snp = vcf.SNP(self.vcf_lines[1])
+    self.assertEqual(snp_tuple(snp), self.expected[1])
+
+  def test_parts(self):
+    for vcf_file in [self.vcf_file, self.vcf_gz_file]:
+      for num_parts in [1, 4, 9]:
+        snps = []
+        for pi in range(num_parts):
+          snps += vcf.vcf_snps(vcf_file, part_i=pi, num_parts=num_parts)
+        self.assertEqual([snp_tuple(snp) for snp in snps], self.expected)
+
+  def test_flip(self):
+    snps = vcf.vcf_snps(self.vcf_file, require_sorted=True,
+                        validate_ref_fasta=self.fasta_file, flip_ref=True)
+    for si, snp in enumerate(snps):
+      self.assertEqual(snp.flipped, si % 3 == 0)
+      self.assertEqual(snp.ref_allele, self.genome[snp.pos-1])
+      if snp.flipped:
+        self.assertEqual(snp.alt_alleles, [self.expected[si][3]])
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  unittest.main()